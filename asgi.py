@@ -0,0 +1,6 @@
+from ffrelay.asgi import create_asgi_app
+from ffrelay.config import ProductionConfig
+
+# Serve with an ASGI server (`pip install ffrelay[async]`), e.g.:
+#   uvicorn asgi:app --host 127.0.0.1 --port 5012
+app = create_asgi_app(config_class=ProductionConfig)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Replays the proportion logic over historical transactions, e.g.:
+        python3 backfill.py --start 2024-01-01 --end 2024-06-30 --tag shared-p50
+"""
+import argparse
+import datetime
+
+from ffrelay.config import (
+    DevelopmentConfig,
+    ProductionConfig,
+)
+
+
+def parse_date(val: str) -> datetime.date:
+    return datetime.datetime.strptime(val, '%Y-%m-%d').date()
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Create or fix proportional transactions for past transactions')
+    parser.add_argument('--start', type=parse_date, help='First transaction date (YYYY-MM-DD)')
+    parser.add_argument('--end', type=parse_date, help='Last transaction date (YYYY-MM-DD)')
+    parser.add_argument('--tag', help='Only look at transactions with this tag')
+    parser.add_argument('--workers', type=int, default=4, help='Transactions processed concurrently')
+    parser.add_argument('--rate', type=float, default=5.0, help='Max transactions processed per second')
+    parser.add_argument('--page-size', type=int, default=100, help='Transactions fetched per page')
+    parser.add_argument('--checkpoint', default='backfill-checkpoint.json',
+                        help='Progress file - rerun with the same arguments to resume')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be done')
+    parser.add_argument('--rebuild-links', action='store_true',
+                        help='Only rebuild the link index from the transactions\' notes')
+    parser.add_argument('--dev', action='store_true', help='Use the development config')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from ffrelay.core.backfill import Backfiller
+    from ffrelay.core.ff_core import FireFlyRelayCore
+
+    args = get_args()
+    config_class = DevelopmentConfig if args.dev else ProductionConfig
+    config_class.load_secrets()
+
+    ffr_core = FireFlyRelayCore(props=dict(config_class.SECRETS))
+    if args.rebuild_links:
+        n_links = ffr_core.link_index.rebuild(ffr_core, start=args.start, end=args.end, page_size=args.page_size)
+        print(f'Indexed {n_links} link(s)')
+        raise SystemExit(0)
+
+    backfiller = Backfiller(
+        ffr_core=ffr_core,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        rate=args.rate,
+        page_size=args.page_size,
+        dry_run=args.dry_run,
+    )
+    print(backfiller.run(start=args.start, end=args.end, tag=args.tag))
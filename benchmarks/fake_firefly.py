@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    A stand-in for the Firefly III API, covering the endpoints the relay calls.
+    Latency, error rate and 429 behaviour are configurable. Run on its own with e.g.:
+        python3 -m benchmarks.fake_firefly --port 8090 --latency-ms 30 --error-rate 0.01
+"""
+import argparse
+from collections import Counter
+import datetime
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+import json
+import random
+import re
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import (
+    parse_qs,
+    urlparse,
+)
+
+TX_PATH_PATTERN = re.compile(r'^/api/v1/transactions(?:/(\d+))?$')
+
+
+def _now() -> str:
+    return datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for a burst of new connections (the default backlog of 5 drops them, costing a 1s SYN retry)
+    request_queue_size = 128
+
+
+class FakeFirefly:
+    """In-memory transaction store plus the knobs for how badly the API behaves"""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.groups: Dict[str, Dict] = {}
+        self._next_id = 10000
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.statuses = Counter()
+        self.server: Optional[_Server] = None
+
+    def _new_id(self) -> str:
+        with self._lock:
+            self._next_id += 1
+            return str(self._next_id)
+
+    def _group_body(self, group_id: str) -> Dict:
+        return {'data': {'type': 'transactions', 'id': group_id, 'attributes': self.groups[group_id]}}
+
+    def handle(self, method: str, path: str, body: Optional[Dict]) -> Tuple[int, Dict, Dict]:
+        """Returns (status, headers, body) for a call"""
+        url = urlparse(path)
+        match = TX_PATH_PATTERN.match(url.path)
+        endpoint = url.path if match is None else '/transactions' + ('/{id}' if match.group(1) else '')
+        with self._lock:
+            self.calls[f'{method} {endpoint}'] += 1
+            roll = self.random.random()
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        time.sleep(delay)
+        if roll < self.throttle_rate:
+            return 429, {'Retry-After': str(self.retry_after)}, {'message': 'Too many requests'}
+        if roll < self.throttle_rate + self.error_rate:
+            return 500, {}, {'message': 'Injected failure'}
+        if match is None:
+            return 404, {}, {'message': 'Not found'}
+
+        group_id = match.group(1)
+        if method == 'POST' and group_id is None:
+            group_id = self._new_id()
+            splits = [{**x, 'transaction_journal_id': int(self._new_id()), 'order': x.get('order', i)}
+                      for i, x in enumerate(body.get('transactions', []))]
+            self.groups[group_id] = {'group_title': body.get('group_title'), 'transactions': splits,
+                                     'created_at': (now := _now()), 'updated_at': now}
+            return 200, {}, self._group_body(group_id)
+        if method == 'GET' and group_id is None:
+            return 200, {}, self._list(parse_qs(url.query))
+        if method == 'GET':
+            if group_id not in self.groups:
+                return 404, {}, {'message': 'Resource not found'}
+            return 200, {}, self._group_body(group_id)
+        if method == 'PUT':
+            # Originals come from webhooks, not from us - take the first update of one as the whole record
+            group = self.groups.setdefault(group_id, {'group_title': None, 'transactions': []})
+            for change in body.get('transactions', []):
+                jrnl_id = str(change.get('transaction_journal_id'))
+                split = next((x for x in group['transactions'] if str(x['transaction_journal_id']) == jrnl_id), None)
+                if split is None:
+                    group['transactions'].append(dict(change))
+                else:
+                    split.update(change)
+            # Every write moves the update time on, as Firefly does
+            group['updated_at'] = _now()
+            return 200, {}, self._group_body(group_id)
+        return 405, {}, {'message': 'Method not allowed'}
+
+    def _list(self, query: Dict[str, List[str]]) -> Dict:
+        page = int(query.get('page', ['1'])[0])
+        limit = int(query.get('limit', ['100'])[0])
+        ids = sorted(self.groups, key=int, reverse=True)
+        total_pages = max(1, -(-len(ids) // limit))
+        page_ids = ids[(page - 1) * limit:page * limit]
+        return {
+            'data': [self._group_body(x)['data'] for x in page_ids],
+            'meta': {'pagination': {'total': len(ids), 'current_page': page, 'total_pages': total_pages}},
+        }
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Serves on a background thread. Returns the base url"""
+        self.server = _Server((host, port), _make_handler(self))
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, name='fake-firefly',
+                         daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'calls': sum(self.calls.values()),
+                'by_endpoint': dict(self.calls),
+                'by_status': {str(k): v for k, v in self.statuses.items()},
+            }
+
+
+def _make_handler(fake: FakeFirefly):
+    class _Handler(BaseHTTPRequestHandler):
+        # Keep-alive, like the real thing behind nginx
+        protocol_version = 'HTTP/1.1'
+        # Headers & body go out in separate writes - don't hold the body back for the client's (delayed) ACK
+        disable_nagle_algorithm = True
+
+        def _respond(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, headers, resp_body = fake.handle(self.command, self.path, body)
+            with fake._lock:
+                fake.statuses[status] += 1
+            raw = json.dumps(resp_body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/vnd.api+json')
+            self.send_header('Content-Length', str(len(raw)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(raw)
+
+        do_GET = do_POST = do_PUT = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Fake Firefly III API for load testing the relay')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Mean response time')
+    parser.add_argument('--jitter-ms', type=float, default=5.0, help='Response time spread (uniform, +/-)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of calls answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After sent with a 429 (seconds)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    fake_ff = FakeFirefly(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                          throttle_rate=args.throttle_rate, retry_after=args.retry_after)
+    print(f'Fake Firefly serving at {fake_ff.start(host=args.host, port=args.port)}')
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        fake_ff.stop()
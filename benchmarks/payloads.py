@@ -0,0 +1,67 @@
+import datetime
+import json
+import random
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from tests.mocks.transaction import make_new_transaction_event
+
+
+class WebhookMix:
+    """Generates a stream of (route, raw webhook body) pairs - new transactions, and later edits of them.
+
+        `tagged_ratio` of the transactions carry a proportion tag; each has 1 to `max_splits` splits.
+        `update_ratio` of the webhooks edit (change the amount of) a transaction sent earlier.
+    """
+
+    def __init__(self, update_ratio: float = 0.3, tagged_ratio: float = 0.8, max_splits: int = 1,
+                 seed: int = None):
+        self.update_ratio = update_ratio
+        self.tagged_ratio = tagged_ratio
+        self.max_splits = max(1, max_splits)
+        self.random = random.Random(seed)
+        self._sent: List[Dict] = []
+        self._next_id = 1
+        self._next_jrnl_id = 1
+        self._clock = datetime.datetime(2024, 6, 24, 12, tzinfo=datetime.timezone.utc)
+
+    def _tick(self) -> str:
+        self._clock += datetime.timedelta(seconds=1)
+        return self._clock.isoformat()
+
+    def _new(self) -> Dict:
+        txs = []
+        for _ in range(self.random.randint(1, self.max_splits)):
+            tags = [f'shared-p{self.random.choice([25, 33, 50])}'] if self.random.random() < self.tagged_ratio \
+                else ['not-shared']
+            txs.append({
+                'tjid': self._next_jrnl_id,
+                'amount': f'{self.random.uniform(5, 250):.2f}',
+                'desc': f'Bench tx {self._next_id}',
+                'tags': tags,
+            })
+            self._next_jrnl_id += 1
+        event = make_new_transaction_event(txs=txs, tid=self._next_id)
+        event['content']['updated_at'] = self._tick()
+        self._next_id += 1
+        self._sent.append(event)
+        return event
+
+    def _update(self) -> Dict:
+        event = self.random.choice(self._sent)
+        for split in event['content']['transactions']:
+            split['amount'] = f'{self.random.uniform(5, 250):.2f}'
+        event['content']['updated_at'] = self._tick()
+        event['trigger'] = 'UPDATE_TRANSACTION'
+        return event
+
+    def next(self) -> Tuple[str, bytes]:
+        if self._sent and self.random.random() < self.update_ratio:
+            return '/transaction/update', json.dumps(self._update()).encode()
+        return '/transaction/add', json.dumps(self._new()).encode()
+
+    def take(self, n: int) -> List[Tuple[str, bytes]]:
+        return [self.next() for _ in range(n)]
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Microbenchmark: the cost of deciding a webhook needs nothing done - the byte-level tag prefilter
+    vs. parsing the body and matching each split's tags. Prints the results as JSON, e.g.:
+        python3 -m benchmarks.prefilter --splits 3 --tag-rules 'rent:p=50,groceries:dest=15'
+"""
+import argparse
+import json
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+from benchmarks.payloads import WebhookMix
+from ffrelay.core.payload import parse_webhook
+from ffrelay.core.tag_rules import TagRuleEngine
+
+
+def time_per_call(func: Callable[[bytes], object], bodies: List[bytes], repeat: int) -> float:
+    """Best of `repeat` runs over all the bodies, in microseconds per body"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            func(body)
+        best = min(best, time.perf_counter() - start)
+    return best / len(bodies) * 1e6
+
+
+def bench(engine: TagRuleEngine, bodies: List[bytes], repeat: int) -> Dict:
+    def _prefilter(body: bytes):
+        return engine.may_match(body)
+
+    def _parse_and_match(body: bytes):
+        return [engine.match_tags(x.tags) for x in parse_webhook(body).transactions]
+
+    prefilter_us = time_per_call(_prefilter, bodies, repeat)
+    parse_us = time_per_call(_parse_and_match, bodies, repeat)
+    return {
+        'bodies': len(bodies),
+        'avg_body_bytes': round(sum(map(len, bodies)) / len(bodies)),
+        'passed_prefilter': sum(map(engine.may_match, bodies)),
+        'prefilter_us': round(prefilter_us, 3),
+        'parse_and_match_us': round(parse_us, 3),
+        'speedup': round(parse_us / prefilter_us, 1),
+    }
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Time the tag prefilter against parsing & tag matching')
+    parser.add_argument('--n', type=int, default=2000, help='Webhook bodies of each kind')
+    parser.add_argument('--splits', type=int, default=1, help='Max splits per transaction')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--tag-rules', default='', help='`tag-rules` prop')
+    parser.add_argument('--no-match-any', action='store_true', help='Set `tag-rules-match-any` to false')
+    parser.add_argument('--seed', type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    engine = TagRuleEngine.from_props({
+        'tag-rules': args.tag_rules,
+        'tag-rules-match-any': 'false' if args.no_match_any else 'true',
+    })
+    results = {}
+    for kind, tagged_ratio in [('untagged', 0.0), ('tagged', 1.0)]:
+        mix = WebhookMix(update_ratio=0.0, tagged_ratio=tagged_ratio, max_splits=args.splits, seed=args.seed)
+        results[kind] = bench(engine, [body for _, body in mix.take(args.n)], repeat=args.repeat)
+    print(json.dumps(results, indent=2))
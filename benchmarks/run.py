@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Load test: drives the app from `create_app` with webhooks at a fixed rate, against a fake Firefly.
+    Prints (or writes) the results as JSON; compare against an earlier run to catch regressions, e.g.:
+        python3 -m benchmarks.run --rate 50 --duration 20 --latency-ms 30 --out bench.json
+        python3 -m benchmarks.run --rate 50 --duration 20 --latency-ms 30 --baseline bench.json
+"""
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import pathlib
+import platform
+import resource
+import sys
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+from benchmarks.fake_firefly import FakeFirefly
+from benchmarks.payloads import WebhookMix
+from ffrelay.config import DevelopmentConfig
+
+# Results checked against a baseline run - True if higher is worse
+REGRESSION_CHECKS = {
+    ('latency_ms', 'p50'): True,
+    ('latency_ms', 'p95'): True,
+    ('latency_ms', 'p99'): True,
+    ('throughput_rps', ): False,
+    ('firefly', 'calls_per_webhook'): True,
+    ('rss_mb', 'peak'): True,
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered)))) - 1]
+
+
+def summarize(values: List[float]) -> Dict:
+    return {
+        'p50': round(percentile(values, 50), 3),
+        'p95': round(percentile(values, 95), 3),
+        'p99': round(percentile(values, 99), 3),
+        'max': round(max(values, default=0.0), 3),
+        'mean': round(sum(values) / len(values), 3) if values else 0.0,
+    }
+
+
+def rss_mb() -> Dict:
+    """Peak RSS of this process, plus the current RSS where /proc is available"""
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if platform.system() == 'Darwin':
+        peak_kb /= 1024
+    current = None
+    statm = pathlib.Path('/proc/self/statm')
+    if statm.exists():
+        current = int(statm.read_text().split()[1]) * resource.getpagesize() / 1024 ** 2
+    return {'peak': round(peak_kb / 1024, 1), 'current': round(current, 1) if current is not None else None}
+
+
+def make_config(ff_url: str, props: Dict) -> type:
+    """A config class pointing the app at the fake Firefly, with no secrets file needed"""
+    secrets = {
+        'ff-base-url': ff_url,
+        'token': 'bench-token',
+        'inc-acct-id': '1',
+        'owe-acct-id': '2',
+        **props,
+    }
+
+    class BenchConfig(DevelopmentConfig):
+        DEBUG = False
+        LOG_LEVEL = 'WARNING'
+
+        @classmethod
+        def load_secrets(cls):
+            cls.SECRETS = dict(secrets)
+
+    return BenchConfig
+
+
+def wait_until_idle(app, timeout: float):
+    """Waits for anything the app is still working on in the background"""
+    deadline = time.monotonic() + timeout
+    coalescer = app.extensions.get('webhook-coalescer')
+    wqueue = app.extensions.get('webhook-queue')
+    while time.monotonic() < deadline:
+        pending = coalescer.stats()['pending'] if coalescer is not None else 0
+        pending += wqueue.queue.unfinished_tasks if wqueue is not None else 0
+        if pending == 0:
+            return
+        time.sleep(0.05)
+
+
+def run(rate: float, duration: float, concurrency: int, mix: WebhookMix, ff_url: str, props: Dict,
+        fake_ff: Optional[FakeFirefly] = None, drain_timeout: float = 60.0) -> Dict:
+    from ffrelay.app import create_app
+
+    app = create_app(config_class=make_config(ff_url=ff_url, props=props))
+    client = app.test_client()
+    n_webhooks = int(rate * duration)
+    webhooks = mix.take(n_webhooks)
+    # Latency counts from when the webhook was due, so a backed-up relay can't hide it (coordinated omission)
+    latencies, service_times = [], []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def _send(i: int, due: float):
+        if (wait := due - time.perf_counter()) > 0:
+            time.sleep(wait)
+        route, body = webhooks[i]
+        start = time.perf_counter()
+        resp = client.post(route, data=body, content_type='application/json')
+        end = time.perf_counter()
+        with lock:
+            latencies.append((end - due) * 1000)
+            service_times.append((end - start) * 1000)
+            statuses[resp.status_code] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(n_webhooks):
+            executor.submit(_send, i, start + i / rate)
+    sent_secs = time.perf_counter() - start
+    wait_until_idle(app, timeout=drain_timeout)
+    total_secs = time.perf_counter() - start
+
+    ffr_core = app.extensions['ffr-core']
+    firefly = fake_ff.stats() if fake_ff is not None else {'calls': ffr_core.request_count}
+    firefly['calls_per_webhook'] = round(firefly['calls'] / n_webhooks, 3) if n_webhooks else 0.0
+    return {
+        'settings': {'rate': rate, 'duration': duration, 'concurrency': concurrency, 'props': props},
+        'webhooks': n_webhooks,
+        'status_codes': {str(k): v for k, v in statuses.items()},
+        'throughput_rps': round(n_webhooks / total_secs, 2),
+        'send_secs': round(sent_secs, 3),
+        'total_secs': round(total_secs, 3),
+        'latency_ms': summarize(latencies),
+        'service_ms': summarize(service_times),
+        'firefly': firefly,
+        'rss_mb': rss_mb(),
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Lists the results that got worse than the baseline by more than `tolerance` (a fraction)"""
+    regressions = []
+    for path, higher_is_worse in REGRESSION_CHECKS.items():
+        new, old = results, baseline
+        for key in path:
+            new, old = new.get(key) if new else None, old.get(key) if old else None
+        if not isinstance(new, (int, float)) or not isinstance(old, (int, float)) or old == 0:
+            continue
+        change = (new - old) / old
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append(f'{".".join(path)}: {old} -> {new} ({change:+.0%})')
+    return regressions
+
+
+def parse_prop(val: str) -> tuple:
+    k, v = val.split('=', 1)
+    return k, v
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test the relay against a fake Firefly')
+    parser.add_argument('--rate', type=float, default=20.0, help='Webhooks per second')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic')
+    parser.add_argument('--concurrency', type=int, default=16, help='Max webhooks in flight (like server threads)')
+    parser.add_argument('--update-ratio', type=float, default=0.3, help='Fraction of webhooks that are edits')
+    parser.add_argument('--tagged-ratio', type=float, default=0.8, help='Fraction of transactions with a -pNN tag')
+    parser.add_argument('--max-splits', type=int, default=1, help='Max splits per transaction')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Fake Firefly response time')
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of Firefly calls failing with 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of Firefly calls getting a 429')
+    parser.add_argument('--firefly-url', help='Use an already running (fake) Firefly instead of starting one')
+    parser.add_argument('--prop', type=parse_prop, action='append', default=[],
+                        help='Relay prop, as key=value (repeatable) - e.g. --prop async-mode=true')
+    parser.add_argument('--out', help='Write the results here instead of printing them')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed change vs. the baseline (fraction)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    fake_ff = None
+    ff_url = args.firefly_url
+    if ff_url is None:
+        fake_ff = FakeFirefly(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                              throttle_rate=args.throttle_rate, seed=args.seed)
+        ff_url = fake_ff.start()
+
+    results = run(
+        rate=args.rate,
+        duration=args.duration,
+        concurrency=args.concurrency,
+        mix=WebhookMix(update_ratio=args.update_ratio, tagged_ratio=args.tagged_ratio,
+                       max_splits=args.max_splits, seed=args.seed),
+        ff_url=ff_url,
+        props=dict(args.prop),
+        fake_ff=fake_ff,
+    )
+    if fake_ff is not None:
+        fake_ff.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        pathlib.Path(args.out).write_text(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        regressions = compare(results, json.loads(pathlib.Path(args.baseline).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,3 +1,11 @@
+import atexit
+import sys
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+)
+
 from flask import (
     Flask,
     jsonify,
@@ -5,18 +13,36 @@ from flask import (
 )
 from pukr import (
     InterceptHandler,
+    PukrLog,
     get_logger,
 )
 from werkzeug.exceptions import HTTPException
 from werkzeug.http import HTTP_STATUS_CODES
 
 from ffrelay.config import DevelopmentConfig
+from ffrelay.core.coalesce import WebhookCoalescer
 from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.journal import JobJournal
+from ffrelay.core.log_sink import QueuedJsonSink
+from ffrelay.core.metrics import (
+    METRICS,
+    QUEUE_DEPTH,
+)
+from ffrelay.core.profiling import SlowRequestProfiler
+from ffrelay.core.sync import SyncPoller
+from ffrelay.core.tracing import TRACER
+from ffrelay.core.utils import (
+    prop_bool,
+    prop_float,
+    prop_int,
+)
+from ffrelay.core.webhook_queue import WebhookQueue
 from ffrelay.routes.helpers import (
     clear_trailing_slash,
     get_app_logger,
     log_after,
     log_before,
+    track_teardown,
 )
 from ffrelay.routes.main import bp_main
 from ffrelay.routes.transaction import bp_trans
@@ -41,6 +67,57 @@ def handle_err(err):
     return jsonify(**err.kwargs), err.http_status_code
 
 
+def init_logger(config_class) -> Tuple[PukrLog, Optional[QueuedJsonSink]]:
+    """Sets up the logger; with `log-json-path` set, also the background JSON-lines sink (returned too)"""
+    props = config_class.SECRETS
+    json_log_path = props.get('log-json-path')
+    log_level = getattr(config_class, 'LOG_LEVEL', 'DEBUG')
+    logger = get_logger(getattr(config_class, 'NAME', None),
+                        log_dir_path=None if json_log_path else getattr(config_class, 'LOG_DIR', None),
+                        show_backtrace=config_class.DEBUG, base_level=log_level)
+    if not json_log_path:
+        return logger, None
+    # Log calls only queue the record - a background thread writes them out as JSON lines in batches.
+    #   The console is kept for warnings & up
+    log_sink = QueuedJsonSink(
+        path=json_log_path,
+        batch_size=prop_int(props, 'log-batch-size', 200),
+        flush_secs=prop_float(props, 'log-flush-secs', 0.5),
+        max_size=prop_int(props, 'log-queue-max-size', 10000),
+    )
+    log_sink.start()
+    logger.remove()
+    logger.add(sys.stderr, level=props.get('log-console-level', 'WARNING'))
+    logger.add(log_sink, level=log_level, format='{message}')
+    # Registered first so it runs last, after everything else has logged its shutdown
+    atexit.register(log_sink.shutdown)
+    return logger, log_sink
+
+
+def init_observability(props: Dict, profile: bool = True):
+    """Sets up the sharing of metrics between workers, tracing and (if `profile`) the slow request profiler"""
+    if metrics_dir := props.get('metrics-dir'):
+        # Several workers - each shares its metrics through a snapshot file so /metrics can add them up
+        METRICS.enable_multiprocess(path=metrics_dir, flush_secs=prop_float(props, 'metrics-flush-secs', 5.0))
+        atexit.register(METRICS.write_snapshot)
+
+    profiler = None
+    if profile and (slow_ms := prop_float(props, 'profile-slow-ms', 0.0)) > 0:
+        # Keep a profile of any request slower than this
+        profiler = SlowRequestProfiler(
+            out_dir=props.get('profile-dir', 'profiles'),
+            threshold_ms=slow_ms,
+            mode=props.get('profile-mode', 'stack'),
+            interval_ms=prop_float(props, 'profile-interval-ms', 5.0),
+            sample_rate=prop_float(props, 'profile-sample-rate', 0.1),
+        )
+    TRACER.configure(
+        path=props.get('trace-path'),
+        sample_rate=prop_float(props, 'trace-sample-rate', 1.0),
+        profiler=profiler,
+    )
+
+
 def create_app(*args, **kwargs) -> Flask:
     """Creates a Flask app instance"""
     # Config app, default to development if not provided
@@ -53,30 +130,92 @@ def create_app(*args, **kwargs) -> Flask:
     app.url_map.strict_slashes = False
 
     # Initialize logger
-    logger = get_logger(app.config.get('NAME'), log_dir_path=app.config.get('LOG_DIR'),
-                        show_backtrace=app.config.get('DEBUG'), base_level=app.config.get('LOG_LEVEL'))
+    logger, log_sink = init_logger(config_class)
+    if log_sink is not None:
+        app.extensions.setdefault('log-sink', log_sink)
     logger.info('Logger started. Binding to app handler...')
     app.logger.addHandler(InterceptHandler(logger=logger))
     # Bind logger so it's easy to call from app object in routes
     app.extensions.setdefault('logg', logger)
 
-    ffr_core = FireFlyRelayCore(props=config_class.SECRETS)
+    ffr_core = FireFlyRelayCore(props=dict(config_class.SECRETS))
     app.extensions.setdefault('ffr-core', ffr_core)
 
+    if prop_bool(ffr_core.props, 'async-mode'):
+        # Accept webhooks right away & process them on a background worker pool
+        journal = None
+        if journal_path := ffr_core.props.get('journal-path'):
+            journal = JobJournal(
+                path=journal_path,
+                checkpoint_every=prop_int(ffr_core.props, 'journal-checkpoint-every', 50),
+                retention_secs=prop_float(ffr_core.props, 'journal-retention-days', 7.0) * 86400,
+            )
+        wqueue = WebhookQueue(
+            handler=ffr_core.process_accepted,
+            max_size=prop_int(ffr_core.props, 'queue-max-size', 500),
+            workers=prop_int(ffr_core.props, 'queue-workers', 2),
+            journal=journal,
+        )
+        wqueue.start()
+        QUEUE_DEPTH.set_function(wqueue.queue.qsize)
+        if journal is not None:
+            wqueue.replay_journal()
+        atexit.register(wqueue.shutdown, prop_float(ffr_core.props, 'queue-drain-timeout', 30.0))
+        app.extensions.setdefault('webhook-queue', wqueue)
+
+    wqueue = app.extensions.get('webhook-queue')
+
+    def _dispatch(event, is_new):
+        """Hands an event already marked as seen to the queue, or processes it here when there isn't room"""
+        if wqueue is None or not wqueue.submit(data=event, is_new=is_new):
+            ffr_core.process_accepted(data=event, is_new=is_new)
+
+    if (window_secs := prop_float(ffr_core.props, 'coalesce-window-secs', 0.0)) > 0:
+        # Merge bursts of update webhooks for the same transaction, processing only the latest
+        def _process_coalesced(event, is_new):
+            if ffr_core.mark_seen(tx_id=event.id, is_new=is_new, updated_at=event.updated_at):
+                _dispatch(event, is_new)
+
+        coalescer = WebhookCoalescer(
+            handler=_process_coalesced,
+            window_secs=window_secs,
+            max_wait_secs=prop_float(ffr_core.props, 'coalesce-max-wait-secs', window_secs * 5),
+        )
+        coalescer.start()
+        # Registered after the queue's shutdown, so it runs first and the queue drains what it flushes
+        atexit.register(coalescer.shutdown)
+        app.extensions.setdefault('webhook-coalescer', coalescer)
+
+    if prop_bool(ffr_core.props, 'sync-poll'):
+        # Pick up changes whose webhooks never arrived by polling Firefly
+        poller = SyncPoller(
+            ffr_core=ffr_core,
+            handler=_dispatch,
+            state_path=ffr_core.props.get('sync-state-path'),
+            min_interval_secs=prop_float(ffr_core.props, 'sync-min-interval-secs', 15.0),
+            max_interval_secs=prop_float(ffr_core.props, 'sync-max-interval-secs', 300.0),
+            lookback_days=prop_int(ffr_core.props, 'sync-lookback-days', 7),
+            page_size=prop_int(ffr_core.props, 'sync-page-size', 200),
+            settle_secs=prop_float(ffr_core.props, 'sync-settle-secs', 30.0),
+        )
+        poller.start()
+        # Registered last, so it stops before the queue drains
+        atexit.register(poller.shutdown)
+        app.extensions.setdefault('sync-poller', poller)
+
+    init_observability(ffr_core.props)
+
     # Register routes
     logger.info('Registering routes...')
     for ruut in ROUTES:
         app.register_blueprint(ruut)
 
-    for err_code, name in HTTP_STATUS_CODES.items():
-        if err_code >= 400:
-            try:
-                app.register_error_handler(err_code, handle_err)
-            except ValueError:
-                pass
+    # One handler for every HTTP error - unhandled exceptions reach it too, as a 500 InternalServerError
+    app.register_error_handler(HTTPException, handle_err)
 
     app.before_request(log_before)
     app.before_request(clear_trailing_slash)
     app.after_request(log_after)
+    app.teardown_request(track_teardown)
 
     return app
@@ -0,0 +1,296 @@
+import asyncio
+import contextvars
+from functools import partial
+import json
+import random
+import time
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from loguru import logger
+from werkzeug.exceptions import (
+    MethodNotAllowed,
+    NotFound,
+)
+
+from ffrelay.core.async_core import AsyncFireFlyRelayCore
+from ffrelay.core.log_sink import QueuedJsonSink
+from ffrelay.core.metrics import (
+    HTTP_IN_FLIGHT,
+    HTTP_LATENCY,
+    METRICS,
+    QUEUE_DEPTH,
+    STAGE_LATENCY,
+    TRANSACTIONS,
+)
+from ffrelay.core.payload import (
+    PayloadError,
+    TransactionEvent,
+    parse_webhook,
+)
+from ffrelay.core.tracing import (
+    TRACER,
+    current_request_id,
+)
+from ffrelay.core.utils import (
+    prop_bool,
+    prop_float,
+    prop_int,
+)
+
+# (status, body, extra headers)
+Reply = Tuple[int, Union[str, Dict], List[Tuple[bytes, bytes]]]
+
+
+class RelayASGIApp:
+    """The relay's routes as a bare ASGI app, handling webhooks on the event loop with AsyncFireFlyRelayCore.
+
+        Answers the same as the Flask app. In async mode a webhook is answered right away (202) and
+        processed in a task of its own, with at most `max_pending` of them at once (503 past that).
+        On shutdown (ASGI lifespan) the tasks get `drain_timeout` seconds to finish.
+    """
+
+    def __init__(self, ffr_core: AsyncFireFlyRelayCore, version: str = None, async_mode: bool = False,
+                 max_pending: int = 500, drain_timeout: float = 30.0, log_sink: QueuedJsonSink = None):
+        self.ffr_core = ffr_core
+        self.version = version
+        self.async_mode = async_mode
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self.log_sink = log_sink
+        # path -> (methods, handler)
+        self.routes: Dict[str, Tuple[Set[str], Callable[[bytes], Awaitable[Reply]]]] = {
+            '/': ({'GET'}, self.index),
+            '/stats': ({'GET'}, self.stats),
+            '/metrics': ({'GET'}, self.metrics),
+            '/transaction/add': ({'GET', 'POST'}, partial(self.webhook, is_new=True)),
+            '/transaction/update': ({'GET', 'POST'}, partial(self.webhook, is_new=False)),
+        }
+        self._tasks: Set[asyncio.Task] = set()
+        self._accepting = True
+        if async_mode:
+            QUEUE_DEPTH.set_function(lambda: len(self._tasks))
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive: Callable, send: Callable):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope: Dict, receive: Callable, send: Callable):
+        start = time.perf_counter()
+        HTTP_IN_FLIGHT.inc()
+        # No strict slashes, same as the Flask app
+        path = scope['path'].rstrip('/') or '/'
+        method = scope['method']
+        methods, handler = self.routes.get(path, (None, None))
+        route = path if handler is not None else 'unmatched'
+        request_id = dict(scope['headers']).get(b'x-request-id')
+        span = TRACER.begin(f'{method} {route}', request_id=request_id.decode('latin-1') if request_id else None,
+                            path=path)
+        try:
+            if handler is None:
+                logger.error(f'404 Not Found - path requested: {path}')
+                status, body, headers = 404, {'message': NotFound.description}, []
+            elif method not in methods:
+                status, body, headers = 405, {'message': MethodNotAllowed.description}, []
+            else:
+                status, body, headers = await handler(await _read_body(receive))
+        except Exception as e:
+            logger.exception(e)
+            status, body, headers = 500, {'message': 'Server has encountered an error.'}, []
+        try:
+            if span is not None:
+                span.args['status'] = status
+                headers = headers + [(b'x-request-id', span.request_id.encode())]
+            await _respond(send, status, body, headers)
+        finally:
+            total_time = time.perf_counter() - start
+            logger.debug('Timing: {}ms [{}] -> {}', int(total_time * 1000), method, path)
+            HTTP_LATENCY.observe(total_time, method=method, route=route, status=status)
+            HTTP_IN_FLIGHT.dec()
+            TRACER.end(span)
+
+    async def index(self, body: bytes) -> Reply:
+        return 200, {'app_name': 'ffrelay', 'version': self.version}, []
+
+    async def stats(self, body: bytes) -> Reply:
+        ffrcore = self.ffr_core
+        stats_dict = {
+            'http_pool': ffrcore.pool_stats(),
+            'throttle': ffrcore.throttle_stats(),
+            'resilience': ffrcore.resilience_stats(),
+            'prop_cache': ffrcore.prop_cache.stats(),
+            'link_index': ffrcore.link_index.stats(),
+            'dedup': ffrcore.dedup_stats(),
+            'tx_locks': ffrcore.tx_lock_stats(),
+            'tag_rules': ffrcore.tag_rules.cache_info(),
+        }
+        if self.async_mode:
+            stats_dict['webhook_tasks'] = self.task_stats()
+        if TRACER.enabled:
+            stats_dict['tracing'] = TRACER.stats()
+        if self.log_sink is not None:
+            stats_dict['log_sink'] = self.log_sink.stats()
+        return 200, stats_dict, []
+
+    async def metrics(self, body: bytes) -> Reply:
+        return 200, METRICS.render(), [(b'content-type', b'text/plain; version=0.0.4')]
+
+    async def webhook(self, body: bytes, is_new: bool) -> Reply:
+        if not self.ffr_core.tag_rules.may_match(body):
+            # No proportion tag - nothing to do
+            TRANSACTIONS.inc(outcome='prefiltered')
+            return 200, 'OK', []
+        start = time.perf_counter()
+        try:
+            event = parse_webhook(body)
+        except PayloadError as e:
+            logger.warning(f'Unable to read webhook payload: {e} (body starts: {body[:200]!r})')
+            return 400, {'message': str(e)}, []
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage='parse')
+        if self.ffr_core.payload_log_rate and random.random() < self.ffr_core.payload_log_rate:
+            logger.info('Webhook payload for tx id {}: {}', event.id, body.decode(errors='replace'))
+
+        triggered_tx_id = event.id
+        if not self.ffr_core.mark_seen(tx_id=triggered_tx_id, is_new=is_new, updated_at=event.updated_at):
+            # Transaction already handled (possibly by another worker) - skip
+            logger.info(f'Skipping {"new" if is_new else "updated"} transaction - '
+                        f'already worked on tx id: {triggered_tx_id}')
+            TRANSACTIONS.inc(outcome='deduped')
+            return 200, 'OK', []
+
+        if self.async_mode:
+            # Let Firefly go and carry on in a task
+            if not self._accepting or len(self._tasks) >= self.max_pending:
+                logger.warning(f'Too many webhooks in progress - asking Firefly to retry tx id: {triggered_tx_id}')
+                self.ffr_core.release(tx_id=triggered_tx_id, is_new=is_new, updated_at=event.updated_at)
+                self.rejected += 1
+                return 503, 'Busy', [(b'retry-after', b'5')]
+            # A fresh context, so the task is traced on its own (under this request's id)
+            task = asyncio.create_task(self._process(event, is_new=is_new, request_id=current_request_id()),
+                                       context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self.accepted += 1
+            return 202, 'Accepted', []
+
+        await self.ffr_core.process_accepted(data=event, is_new=is_new)
+        return 200, 'OK', []
+
+    async def _process(self, event: TransactionEvent, is_new: bool, request_id: Optional[str]):
+        try:
+            with TRACER.span('asgi.task', request_id=request_id, is_new=is_new):
+                await self.ffr_core.process_accepted(data=event, is_new=is_new)
+        except Exception as e:
+            logger.exception(e)
+            self.failed += 1
+        else:
+            self.processed += 1
+
+    async def shutdown(self):
+        """Stops taking webhooks, gives the ones in progress time to finish and closes the connections"""
+        self._accepting = False
+        if self._tasks:
+            logger.info(f'Waiting on {len(self._tasks)} webhook task(s)...')
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+            if pending:
+                logger.warning(f'{len(pending)} webhook task(s) not done after {self.drain_timeout}s; abandoning them')
+                for task in pending:
+                    task.cancel()
+        await self.ffr_core.aclose()
+
+    def task_stats(self) -> Dict:
+        return {
+            'in_progress': len(self._tasks),
+            'max_pending': self.max_pending,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
+
+
+async def _read_body(receive: Callable) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _respond(send: Callable, status: int, body: Union[str, Dict], headers: List[Tuple[bytes, bytes]]):
+    if isinstance(body, dict):
+        raw = json.dumps(body).encode()
+        content_type = b'application/json'
+    else:
+        raw = body.encode()
+        content_type = b'text/html; charset=utf-8'
+    if not any(k == b'content-type' for k, _ in headers):
+        headers = headers + [(b'content-type', content_type)]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers + [(b'content-length', str(len(raw)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': raw})
+
+
+def create_asgi_app(config_class=None) -> RelayASGIApp:
+    """Creates the ASGI app - the counterpart of `create_app` for serving with e.g. uvicorn"""
+    # Not at the top - ffrelay.app brings in Flask, which serving over ASGI has no use for otherwise
+    from ffrelay.app import (
+        init_logger,
+        init_observability,
+    )
+    from ffrelay.config import (
+        DevelopmentConfig,
+        get_version,
+    )
+
+    config_class = config_class or DevelopmentConfig
+    config_class.load_secrets()
+    _, log_sink = init_logger(config_class)
+    logger.info('Logger started.')
+
+    ffr_core = AsyncFireFlyRelayCore(props=dict(config_class.SECRETS))
+    props = ffr_core.props
+    if prop_float(props, 'coalesce-window-secs', 0.0) > 0:
+        logger.warning('Webhook coalescing is not available when serving over ASGI - ignoring coalesce-window-secs')
+    if prop_bool(props, 'sync-poll'):
+        logger.warning('Sync polling is not available when serving over ASGI - ignoring sync-poll')
+    # One thread runs every request, so there's no telling one request's stack samples from another's
+    init_observability(props, profile=False)
+
+    return RelayASGIApp(
+        ffr_core,
+        version=get_version(),
+        async_mode=prop_bool(props, 'async-mode'),
+        max_pending=prop_int(props, 'queue-max-size', 500),
+        drain_timeout=prop_float(props, 'queue-drain-timeout', 30.0),
+        log_sink=log_sink,
+    )
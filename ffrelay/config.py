@@ -1,4 +1,5 @@
 """Configuration setup"""
+from functools import lru_cache
 from importlib import metadata
 import os
 import pathlib
@@ -21,6 +22,27 @@ def get_local_secret_key(path: pathlib.Path) -> str:
         return f.read().strip()
 
 
+def load_secret_key(path: pathlib.Path) -> str:
+    """Reads the locally-stored secret key, writing a new one first if there isn't one yet"""
+    if not path.exists():
+        logger.info('SECRET_KEY not detected. Writing a new one.')
+        secret_key = ''.join(random.choice(string.ascii_lowercase) for i in range(32))
+        with path.open('w') as f:
+            f.write(secret_key)
+        return secret_key
+    return get_local_secret_key(path)
+
+
+@lru_cache(maxsize=None)
+def get_version() -> str:
+    """The installed package's version, looked up once when first asked for"""
+    try:
+        return metadata.version('ffrelay')
+    except metadata.PackageNotFoundError:
+        # Running from a checkout that isn't installed
+        return 'unknown'
+
+
 def read_secrets(path_obj: pathlib.Path) -> Dict:
     secrets = {}
     with path_obj.open('r') as f:
@@ -38,30 +60,28 @@ class BaseConfig(object):
     DEBUG = False
     TESTING = False
 
-    VERSION = metadata.version('ffrelay')
     PORT = 5012
     # Stuff for frontend
     STATIC_DIR_PATH = '../static'
     TEMPLATE_DIR_PATH = '../templates'
 
     SECRETS = None
+    SECRET_KEY_PATH = KEY_DIR.joinpath('plant-tracker-secret')
+    SECRET_KEY = None
 
     @classmethod
     def load_secrets(cls):
+        """Reads the secrets & the secret key the first time it's called; after that it's a no-op.
+            Anything that changes the props should be handed a copy of SECRETS
+        """
+        if cls.SECRETS is not None:
+            return
         if cls.ENV == 'DEV':
             secrets_path = pathlib.Path(__file__).parent.parent.joinpath('secretprops.properties')
         else:
             secrets_path = KEY_DIR.joinpath('ffrelay-secretprops.properties')
         cls.SECRETS = read_secrets(secrets_path)
-
-    SECRET_KEY_PATH = KEY_DIR.joinpath('plant-tracker-secret')
-    if not SECRET_KEY_PATH.exists():
-        logger.info('SECRET_KEY not detected. Writing a new one.')
-        SECRET_KEY = ''.join(random.choice(string.ascii_lowercase) for i in range(32))
-        with SECRET_KEY_PATH.open('w') as f:
-            f.write(SECRET_KEY)
-    else:
-        SECRET_KEY = get_local_secret_key(SECRET_KEY_PATH)
+        cls.SECRET_KEY = load_secret_key(cls.SECRET_KEY_PATH)
 
 
 class DevelopmentConfig(BaseConfig):
@@ -80,7 +100,7 @@ class ProductionConfig(BaseConfig):
     ENV = 'PROD'
     DEBUG = False
     DB_SERVER = '0.0.0.0'
-    LOG_LEVEL = 'DEBUG'
+    LOG_LEVEL = 'INFO'
 
     def __init__(self):
         os.environ['PT_ENV'] = self.ENV
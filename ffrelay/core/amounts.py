@@ -0,0 +1,47 @@
+from decimal import (
+    ROUND_HALF_UP,
+    Decimal,
+    InvalidOperation,
+)
+from typing import (
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# Amounts are sent to Firefly in cents; it keeps them as decimal strings (e.g. '36.000000000000')
+CENTS = Decimal('0.01')
+Amount = Union[str, int, Decimal]
+
+
+def to_decimal(amount: Amount) -> Decimal:
+    """Reads an amount exactly - never through a binary float"""
+    try:
+        return Decimal(amount.strip() if isinstance(amount, str) else amount)
+    except (InvalidOperation, TypeError) as e:
+        raise ValueError(f'Not an amount: {amount!r}') from e
+
+
+def proportional_amounts(pairs: Iterable[Tuple[Amount, int]]) -> List[str]:
+    """Works out a batch of (amount, proportion %) pairs in one pass.
+        Each is rounded half-up to the cent, as Firefly would round it
+    """
+    return [str((to_decimal(amount) * proportion).scaleb(-2).quantize(CENTS, rounding=ROUND_HALF_UP))
+            for amount, proportion in pairs]
+
+
+def proportional_amount(amount: Amount, proportion: int) -> str:
+    return proportional_amounts([(amount, proportion)])[0]
+
+
+def same_amount(a: Optional[Amount], b: Optional[Amount]) -> bool:
+    """Whether two amounts are the same to the cent - e.g. Firefly's '36.000000000000' and our '36.00'"""
+    if a is None or b is None:
+        return a is b
+    try:
+        return to_decimal(a).quantize(CENTS, rounding=ROUND_HALF_UP) == to_decimal(b).quantize(CENTS,
+                                                                                               rounding=ROUND_HALF_UP)
+    except ValueError:
+        return False
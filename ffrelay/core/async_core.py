@@ -0,0 +1,366 @@
+import asyncio
+import datetime
+import time
+from typing import (
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from urllib.parse import (
+    quote,
+    urlencode,
+)
+
+import httpx
+from loguru import logger
+
+from ffrelay.core.ff_core import (
+    FireFlyRelayCore,
+    endpoint_label,
+)
+from ffrelay.core.metrics import (
+    FIREFLY_ERRORS,
+    FIREFLY_IN_FLIGHT,
+    FIREFLY_LATENCY,
+    STAGE_LATENCY,
+    TRANSACTIONS,
+)
+from ffrelay.core.payload import (
+    TransactionEvent,
+    as_event,
+)
+from ffrelay.core.prop_cache import PropTxRecord
+from ffrelay.core.tracing import (
+    TRACER,
+    Span,
+)
+from ffrelay.core.utils import (
+    prop_bool,
+    prop_int,
+)
+
+
+class AsyncFireFlyRelayCore(FireFlyRelayCore):
+    """FireFlyRelayCore for an event loop: webhooks are handled the same way, but the calls to Firefly go
+        through a pooled httpx.AsyncClient, so many webhooks can wait on Firefly at once without a thread each.
+
+        Tag matching, the link index, the caches, dedup, throttling and retries are the sync core's;
+        only the methods that call Firefly are coroutines here. The CLIs (backfill, link rebuilding)
+        stay on the sync core.
+    """
+    TRANSIENT_ERRORS = (httpx.TransportError, )
+
+    def _build_session(self) -> httpx.AsyncClient:
+        """Builds the client that's shared across all webhooks handled by this process"""
+        keep_alive = prop_bool(self.props, 'http-keep-alive', default=True)
+        pool_size = prop_int(self.props, 'http-pool-size', 10)
+        self.limits = httpx.Limits(max_connections=pool_size,
+                                   max_keepalive_connections=pool_size if keep_alive else 0)
+        headers = dict(self.headers)
+        if not keep_alive:
+            headers['Connection'] = 'close'
+        return httpx.AsyncClient(
+            headers=headers,
+            limits=self.limits,
+            timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+        )
+
+    def pool_stats(self) -> Dict:
+        return {
+            'pool_maxsize': self.limits.max_connections,
+            'keep_alive': self.limits.max_keepalive_connections > 0,
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            'requests_sent': self.request_count,
+        }
+
+    async def aclose(self):
+        """Releases the pooled connections"""
+        await self.session.aclose()
+
+    async def _send(self, method: str, endpoint: str, data: Dict = None) -> httpx.Response:
+        """Sends a single attempt of a call, under the rate & concurrency limits"""
+        await self.rate_limiter.acquire_async()
+        endpoint_name = endpoint_label(endpoint)
+        async with self.concurrency.async_slot() as outcome:
+            self.request_count += 1
+            FIREFLY_IN_FLIGHT.inc()
+            start = time.perf_counter()
+            try:
+                resp = await self.session.request(method, f'{self.api_url}{endpoint}', json=data)
+            except Exception as e:
+                FIREFLY_ERRORS.inc(method=method, endpoint=endpoint_name, status=type(e).__name__)
+                raise
+            finally:
+                FIREFLY_IN_FLIGHT.dec()
+                FIREFLY_LATENCY.observe(time.perf_counter() - start, method=method, endpoint=endpoint_name)
+            self._check_response(method, endpoint_name, resp, failed=resp.is_error, outcome=outcome)
+        return resp
+
+    async def _request(self, method: str, endpoint: str, data: Dict = None) -> httpx.Response:
+        """Calls Firefly through the circuit breaker, retrying transient failures of idempotent calls"""
+        self.retry_policy.record_call()
+        with TRACER.span(f'firefly {method} {endpoint_label(endpoint)}') as span:
+            return await self._request_with_retries(method, endpoint, data=data, span=span)
+
+    async def _request_with_retries(self, method: str, endpoint: str, data: Dict = None,
+                                    span: Optional[Span] = None) -> httpx.Response:
+        attempt = 1
+        while True:
+            self.breaker.before_call()
+            resp = None
+            try:
+                resp = await self._send(method, endpoint, data=data)
+                resp.raise_for_status()
+            except Exception as e:
+                if (delay := self._retry_delay(method, endpoint, attempt, resp=resp, error=e)) is not None:
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                self._give_up(attempt, data=data, error=e, span=span)
+                raise e
+            self.breaker.record_success()
+            if span is not None:
+                span.args.update(attempts=attempt, status=resp.status_code)
+            return resp
+
+    async def _get(self, endpoint: str) -> httpx.Response:
+        return await self._request('GET', endpoint)
+
+    async def _post(self, endpoint: str, data: Dict) -> httpx.Response:
+        return await self._request('POST', endpoint, data=data)
+
+    async def _put(self, endpoint: str, data: Dict) -> httpx.Response:
+        return await self._request('PUT', endpoint, data=data)
+
+    async def _new_transaction(self, title: str, splits: List[Dict]) -> httpx.Response:
+        resp = await self._post(
+            endpoint='/transactions',
+            data={
+                "error_if_duplicate_hash": True,
+                "apply_rules": False,
+                "fire_webhooks": False,
+                "group_title": title,
+                "transactions": splits
+            }
+        )
+        self._observe_prop_tx(resp)
+        return resp
+
+    async def new_single_transaction(
+            self,
+            title: str,
+            tx_type: str,
+            amount: float,
+            desc: str,
+            source_acct_id: int = None,
+            dest_acct_id: int = None,
+            tx_date: Union[datetime.datetime, datetime.date] = None,
+            notes: str = None,
+            tags: List[str] = None,
+            currency: str = 'USD'
+    ) -> httpx.Response:
+        return await self._new_transaction(title=title, splits=[self._tx_split(
+            tx_type=tx_type, amount=amount, desc=desc, source_acct_id=source_acct_id, dest_acct_id=dest_acct_id,
+            tx_date=tx_date, notes=notes, tags=tags, currency=currency,
+        )])
+
+    async def new_split_transaction(self, title: str, splits: List[Dict]) -> httpx.Response:
+        return await self._new_transaction(title=title, splits=[
+            self._tx_split(**split, order=i) for i, split in enumerate(splits)
+        ])
+
+    async def get_transaction(self, transaction_id: Union[int, str]) -> Dict:
+        logger.debug(f'Getting transaction info for transaction id {transaction_id}')
+        resp = await self._get(endpoint=f'/transactions/{transaction_id}')
+        data = resp.json()['data']
+        self.prop_cache.observe(data)
+        return data
+
+    async def list_transactions(self, start: datetime.date = None, end: datetime.date = None, page: int = 1,
+                                limit: int = 100, tag: str = None) -> Dict:
+        params = {'page': page, 'limit': limit}
+        if start is not None:
+            params['start'] = start.strftime('%F')
+        if end is not None:
+            params['end'] = end.strftime('%F')
+        endpoint = '/transactions' if tag is None else f'/tags/{quote(tag, safe="")}/transactions'
+        resp = await self._get(endpoint=f'{endpoint}?{urlencode(params)}')
+        return resp.json()
+
+    async def iter_transaction_pages(self, start: datetime.date = None, end: datetime.date = None,
+                                     first_page: int = 1, limit: int = 100,
+                                     tag: str = None) -> AsyncIterator[Tuple[int, int, List[Dict]]]:
+        page = first_page
+        while True:
+            body = await self.list_transactions(start=start, end=end, page=page, limit=limit, tag=tag)
+            total_pages = body.get('meta', {}).get('pagination', {}).get('total_pages', page)
+            data = body.get('data', [])
+            if len(data) > 0:
+                yield page, total_pages, data
+            if page >= total_pages or len(data) == 0:
+                break
+            page += 1
+
+    async def update_transaction(self, tx_id: Union[int, str], transactions: List[Dict],
+                                 tx_title: str = None) -> httpx.Response:
+        logger.debug(f'Updating transaction id ({tx_id})...')
+        resp = await self._put(
+            endpoint=f'/transactions/{tx_id}',
+            data={
+                "apply_rules": False,
+                "fire_webhooks": False,
+                "group_title": tx_title,
+                "transactions": transactions
+            }
+        )
+        self._observe_update(resp)
+        return resp
+
+    async def process_event(self, data: Union[Dict, TransactionEvent], is_new: bool) -> int:
+        """Runs a webhook payload through tag matching and proportional transaction handling.
+            Returns the number of splits acted upon"""
+        event = as_event(data)
+        async with self.tx_locks.hold_async(event.id) as waited:
+            if waited:
+                # Another webhook for this transaction was just handled - what we were sent may be out of date
+                event = await self.refresh_event(event)
+                if event is None:
+                    return 0
+            start = time.perf_counter()
+            new_txs = self.handle_incoming_transaction_data(data=event, is_new=is_new)
+            STAGE_LATENCY.observe(time.perf_counter() - start, stage='tag_match')
+            if len(new_txs) == 0:
+                logger.debug('No transactions with matching tags found!')
+                TRANSACTIONS.inc(outcome='skipped')
+                return 0
+            start = time.perf_counter()
+            await self.process_new_splits(
+                new_splits=new_txs,
+                transaction_data=event
+            )
+            STAGE_LATENCY.observe(time.perf_counter() - start, stage='sync')
+            return len(new_txs)
+
+    async def process_accepted(self, data: Union[Dict, TransactionEvent], is_new: bool) -> int:
+        """process_event for a webhook already marked as seen - if it fails the mark is released,
+            so Firefly's redelivery (or the sync poller) isn't dropped as a duplicate"""
+        event = as_event(data)
+        try:
+            return await self.process_event(data=event, is_new=is_new)
+        except Exception:
+            self.release(tx_id=event.id, is_new=is_new, updated_at=event.updated_at)
+            raise
+
+    async def refresh_event(self, event: TransactionEvent) -> Optional[TransactionEvent]:
+        try:
+            return TransactionEvent.from_group(await self.get_transaction(event.id))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 404:
+                logger.info(f'Transaction {event.id} is gone - nothing to do')
+                return None
+            raise
+
+    async def process_new_splits(self, new_splits: List[Dict], transaction_data: Union[Dict, TransactionEvent]):
+        transaction_data = as_event(transaction_data)
+        triggered_tx_id = transaction_data.id
+
+        batched = self.batch_splits and sum(1 for x in new_splits if not x.get('is_update')) > 1
+        if batched:
+            await self.process_new_transactions_batched(
+                triggered_tx_id=triggered_tx_id,
+                splits=[x for x in new_splits if not x.get('is_update')],
+                transaction_data=transaction_data
+            )
+
+        for splits in self._updates_by_prop_tx(new_splits).values():
+            await self.process_updated_transaction(
+                triggered_tx_id=triggered_tx_id,
+                splits=splits
+            )
+        for split in new_splits:
+            if not split.get('is_update') and not batched:
+                await self.process_new_transaction(
+                    triggered_tx_id=triggered_tx_id,
+                    split=split,
+                    transaction_data=transaction_data
+                )
+
+    @TRACER.wrap('process_new_transaction')
+    async def process_new_transaction(self, triggered_tx_id: int, split: Dict,
+                                      transaction_data: Union[Dict, TransactionEvent]):
+        logger.info('Creating new transaction...')
+        transaction_data = as_event(transaction_data)
+
+        org_tx = split['org_tx']
+        new_tx_id = self._resumable_prop_tx(triggered_tx_id, org_tx)
+        if new_tx_id is None:
+            new_tx_resp = await self.new_single_transaction(**split.get('new_tx'))
+            new_tx_data = new_tx_resp.json()['data']
+            new_tx_id = new_tx_data['id']
+            self.new_txs.add(new_tx_id)
+            prop_jrnl_ids = self._split_journal_ids(new_tx_data)
+            self._record_new_prop_tx(triggered_tx_id, org_tx, prop_tx_id=new_tx_id,
+                                     prop_journal_id=prop_jrnl_ids[0] if prop_jrnl_ids else None)
+
+        logger.info('Updating original transaction')
+        org_notes, modified_splits = self._link_update(transaction_data, split=split, new_tx_id=new_tx_id)
+        logger.info(f'Updating transaction id {triggered_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
+        await self.update_transaction(
+            tx_id=triggered_tx_id,
+            transactions=modified_splits
+        )
+        self._linked(transaction_data, notes={org_tx['index']: org_notes}, prop_tx_ids=[new_tx_id])
+
+    @TRACER.wrap('process_new_transactions_batched')
+    async def process_new_transactions_batched(self, triggered_tx_id: int, splits: List[Dict],
+                                               transaction_data: Union[Dict, TransactionEvent]):
+        transaction_data = as_event(transaction_data)
+        logger.info(f'Creating proportional transactions for {len(splits)} splits in one go...')
+
+        new_links, to_create = self._batch_groups(triggered_tx_id, splits)
+        for group in to_create:
+            new_tx_data = (await self.new_split_transaction(**self._group_request(group))).json()['data']
+            self._record_new_group(triggered_tx_id, group, new_tx_data=new_tx_data, new_links=new_links)
+
+        notes, modified_splits = self._batch_link_update(transaction_data, new_links)
+        logger.info(f'Updating transaction id {triggered_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
+        await self.update_transaction(
+            tx_id=triggered_tx_id,
+            transactions=modified_splits
+        )
+        self._linked(transaction_data, notes=notes, prop_tx_ids={x[1] for x in new_links})
+
+    @TRACER.wrap('process_updated_transaction')
+    async def process_updated_transaction(self, triggered_tx_id: int, splits: List[Dict]):
+        logger.info('Updating proportional transaction...')
+        prop_tx_id = splits[0]['org_tx']['prop_tx_id']
+        record = self.prop_cache.get(prop_tx_id)
+        from_cache = record is not None
+        if record is None:
+            record = PropTxRecord.from_api(await self.get_transaction(prop_tx_id))
+
+        modified_splits, changed = self._prop_tx_update(record, triggered_tx_id=triggered_tx_id, splits=splits)
+        if modified_splits is None and self._check_unchanged(from_cache):
+            record, from_cache = PropTxRecord.from_api(await self.get_transaction(prop_tx_id)), False
+            modified_splits, changed = self._prop_tx_update(record, triggered_tx_id=triggered_tx_id, splits=splits)
+        if modified_splits is None:
+            TRANSACTIONS.inc(outcome='unchanged')
+            return
+
+        logger.info(f'Updating transaction id {prop_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
+        try:
+            await self.update_transaction(
+                tx_id=prop_tx_id,
+                transactions=modified_splits
+            )
+        except httpx.HTTPStatusError as e:
+            if not self._is_stale_cache_error(e, prop_tx_id=prop_tx_id, from_cache=from_cache):
+                raise e
+            return await self.process_updated_transaction(triggered_tx_id=triggered_tx_id, splits=splits)
+        self._prop_tx_updated(prop_tx_id, changed=changed)
@@ -0,0 +1,155 @@
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+import datetime
+import json
+import pathlib
+import threading
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+
+from loguru import logger
+
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.throttle import TokenBucket
+from ffrelay.core.utils import parse_timestamp
+
+
+class Backfiller:
+    """Replays the proportion logic over historical transactions.
+
+        Pages through Firefly's transaction list, runs each transaction group through
+        the same handling as the webhook routes and creates (or fixes) proportional transactions
+        on a worker pool. Progress is checkpointed after each page, so an interrupted run
+        picks up where it left off - or at the first page where a group failed, so it's tried again.
+    """
+
+    def __init__(self, ffr_core: FireFlyRelayCore, checkpoint_path: Union[str, pathlib.Path],
+                 workers: int = 4, rate: float = 5.0, page_size: int = 100, dry_run: bool = False):
+        self.ffr_core = ffr_core
+        self.checkpoint_path = pathlib.Path(checkpoint_path)
+        self.workers = workers
+        self.limiter = TokenBucket(rate=rate, burst=1)
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.stats = {
+            'pages': 0,
+            'transactions': 0,
+            'matched': 0,
+            'created': 0,
+            'fixed': 0,
+            'errors': 0,
+        }
+        self._lock = threading.Lock()
+
+    def _run_key(self, start: Optional[datetime.date], end: Optional[datetime.date], tag: Optional[str]) -> Dict:
+        return {
+            'start': start.strftime('%F') if start else None,
+            'end': end.strftime('%F') if end else None,
+            'tag': tag,
+        }
+
+    def load_checkpoint(self, run_key: Dict) -> int:
+        """Returns the page to resume from - 1 unless there's a checkpoint for this same run"""
+        if not self.checkpoint_path.exists():
+            return 1
+        with self.checkpoint_path.open() as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('run') != run_key:
+            logger.warning(f'Checkpoint at {self.checkpoint_path} is for a different run - starting over')
+            return 1
+        self.stats.update(checkpoint.get('stats', {}))
+        return checkpoint['next_page']
+
+    def save_checkpoint(self, run_key: Dict, next_page: int, done: bool = False):
+        tmp_path = self.checkpoint_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({'run': run_key, 'next_page': next_page, 'done': done, 'stats': self.stats}, f)
+        tmp_path.replace(self.checkpoint_path)
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _plan_page(self, tx_groups: List[Dict]) -> List[Optional[List[Dict]]]:
+        """Works out a page's new transactions in one go. If that fails (say, on one unreadable group),
+            each group is left to be worked out on its own, so only the bad one fails"""
+        try:
+            events = [TransactionEvent.from_group(x) for x in tx_groups]
+            return self.ffr_core.plan_events(events, is_new=False, mark_seen=False)
+        except (KeyError, ValueError) as e:
+            logger.warning(f'Unable to work out the page in one go ({e}) - going group by group')
+            return [None] * len(tx_groups)
+
+    def _plan_group(self, event: TransactionEvent, new_splits: Optional[List[Dict]] = None) -> List[Dict]:
+        if new_splits is None:
+            new_splits = self.ffr_core.handle_incoming_transaction_data(data=event, is_new=False, mark_seen=False)
+        if len(new_splits) > 0:
+            self._count('matched')
+        return new_splits
+
+    @staticmethod
+    def _date_new_splits(event: TransactionEvent, new_splits: List[Dict]):
+        """Dates the proportional transactions to create like the splits they're made from, rather than today"""
+        for split in new_splits:
+            if not split.get('is_update'):
+                tx_date = parse_timestamp(event.transactions[split['org_tx']['index']].date)
+                if tx_date is not None:
+                    split['new_tx']['tx_date'] = tx_date
+
+    def _process_group(self, tx_group: Dict, new_splits: Optional[List[Dict]] = None):
+        event = TransactionEvent.from_group(tx_group)
+        if self.dry_run:
+            self._plan_group(event, new_splits)
+            return
+        with self.ffr_core.tx_locks.hold(event.id) as waited:
+            if waited:
+                # A webhook for it was handled meanwhile - plan from the transaction as it is now
+                event, new_splits = self.ffr_core.refresh_event(event), None
+                if event is None:
+                    return
+            new_splits = self._plan_group(event, new_splits)
+            if len(new_splits) == 0:
+                return
+            self._date_new_splits(event, new_splits)
+            self.limiter.acquire()
+            self.ffr_core.process_new_splits(new_splits=new_splits, transaction_data=event)
+        n_fixed = sum(1 for x in new_splits if x.get('is_update'))
+        self._count('fixed', n_fixed)
+        self._count('created', len(new_splits) - n_fixed)
+
+    def run(self, start: datetime.date = None, end: datetime.date = None, tag: str = None) -> Dict:
+        run_key = self._run_key(start=start, end=end, tag=tag)
+        first_page = self.load_checkpoint(run_key)
+        logger.info(f'Backfilling {run_key} from page {first_page}{" (dry run)" if self.dry_run else ""}...')
+        next_page = first_page
+        # The first page a group failed on - where the next run picks up
+        resume_page = None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ffr-backfill') as executor:
+            for page, total_pages, tx_groups in self.ffr_core.iter_transaction_pages(
+                    start=start, end=end, first_page=first_page, limit=self.page_size, tag=tag):
+                futures = [executor.submit(self._process_group, tx_group, new_splits)
+                           for tx_group, new_splits in zip(tx_groups, self._plan_page(tx_groups))]
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f'Failed to backfill transaction: {e}')
+                        self._count('errors')
+                        if resume_page is None:
+                            resume_page = page
+                self._count('pages')
+                self._count('transactions', len(tx_groups))
+                next_page = page + 1
+                self.save_checkpoint(run_key, next_page=resume_page or next_page)
+                logger.info(f'Page {page}/{total_pages} done - {self.stats}')
+        if resume_page is not None:
+            logger.warning(f'Some transactions failed - the next run picks up at page {resume_page}')
+        self.save_checkpoint(run_key, next_page=resume_page or next_page, done=resume_page is None)
+        return self.stats
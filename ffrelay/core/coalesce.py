@@ -0,0 +1,150 @@
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from loguru import logger
+
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.tracing import (
+    TRACER,
+    current_request_id,
+)
+
+
+class _Pending:
+    __slots__ = ('event', 'is_new', 'first_seen', 'due', 'merged', 'request_id')
+
+    def __init__(self, event: TransactionEvent, is_new: bool, now: float, due: float):
+        self.event = event
+        self.is_new = is_new
+        self.request_id = current_request_id()
+        self.first_seen = now
+        self.due = due
+        self.merged = 0
+
+
+class WebhookCoalescer:
+    """Holds webhook events for a short window, keeping only the latest one per transaction id.
+
+        Editing a transaction (or running rules over it) tends to fire a burst of update webhooks;
+        each new event for an id that's still pending replaces the one held and pushes its flush back
+        by `window_secs`, up to `max_wait_secs` after the first. Only the surviving event reaches
+        `handler`, so superseded states never cause a write to Firefly.
+    """
+
+    def __init__(self, handler: Callable[[TransactionEvent, bool], None], window_secs: float = 1.0,
+                 max_wait_secs: float = None, name: str = 'ffr-coalesce'):
+        self.handler = handler
+        self.window_secs = window_secs
+        self.max_wait_secs = max_wait_secs if max_wait_secs is not None else window_secs * 5
+        self.name = name
+        self._pending: Dict[str, _Pending] = {}
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        # Metrics
+        self.submitted = 0
+        self.merged = 0
+        self.out_of_order = 0
+        self.flushed = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def submit(self, event: TransactionEvent, is_new: bool) -> bool:
+        """Holds the event for the window. Returns True if it merged into one already held for the same id"""
+        key = f'{"new" if is_new else "updated"}:{event.id}'
+        now = time.monotonic()
+        with self._cond:
+            self.submitted += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = _Pending(event, is_new, now=now, due=now + self.window_secs)
+                self._cond.notify()
+                return False
+            self.merged += 1
+            pending.merged += 1
+            if _is_older(event, pending.event):
+                # Deliveries can arrive out of order - never go back to an earlier state
+                self.out_of_order += 1
+            else:
+                pending.event = event
+                pending.request_id = current_request_id()
+            pending.due = min(now + self.window_secs, pending.first_seen + self.max_wait_secs)
+            return True
+
+    def _take_due(self, flush_all: bool = False) -> Tuple[List[_Pending], Optional[float]]:
+        """Pops the events whose window has closed. Expects the lock to be held"""
+        now = time.monotonic()
+        due, next_due = [], None
+        for key, pending in list(self._pending.items()):
+            if flush_all or pending.due <= now:
+                due.append(self._pending.pop(key))
+            elif next_due is None or pending.due < next_due:
+                next_due = pending.due
+        return due, next_due
+
+    def _run(self):
+        while True:
+            with self._cond:
+                due, next_due = self._take_due(flush_all=self._stopping)
+                if not due:
+                    if self._stopping:
+                        break
+                    self._cond.wait(timeout=None if next_due is None else next_due - time.monotonic())
+                    continue
+            for pending in due:
+                self._flush(pending)
+
+    def _flush(self, pending: _Pending):
+        if pending.merged:
+            logger.info(f'Coalesced {pending.merged + 1} webhook(s) for tx id {pending.event.id}')
+        try:
+            # Traced under the id of the request that brought the surviving event
+            with TRACER.span('coalescer.flush', request_id=pending.request_id, merged=pending.merged):
+                self.handler(pending.event, pending.is_new)
+        except Exception as e:
+            logger.exception(e)
+            with self._cond:
+                self.failed += 1
+        else:
+            with self._cond:
+                self.flushed += 1
+
+    def shutdown(self, timeout: float = 10.0):
+        """Flushes everything still held, without waiting for the windows to close"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'window_secs': self.window_secs,
+                'pending': len(self._pending),
+                'submitted': self.submitted,
+                'merged': self.merged,
+                'out_of_order': self.out_of_order,
+                'flushed': self.flushed,
+                'failed': self.failed,
+            }
+
+
+def _is_older(event: TransactionEvent, than: TransactionEvent) -> bool:
+    """Whether `event` describes an earlier state of the transaction than `than` does"""
+    if event.updated_at is None or than.updated_at is None:
+        return False
+    return event.updated_at < than.updated_at
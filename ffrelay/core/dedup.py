@@ -0,0 +1,269 @@
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from collections import OrderedDict
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import (
+    Dict,
+    Type,
+    Union,
+)
+
+from ffrelay.core.utils import (
+    prop_float,
+    prop_int,
+)
+
+TxId = Union[int, str]
+
+
+def _ttl_secs(props: Dict, namespace: str) -> float:
+    """How long an id stays marked as seen. Updates are marked per update time, so a later edit is always handled;
+        their short window only has to absorb redelivery of the same webhook"""
+    if namespace == 'updated':
+        return prop_float(props, 'dedup-updated-ttl-secs', 60.0)
+    return prop_float(props, 'dedup-ttl-secs', 86400.0)
+
+
+class DedupStore(ABC):
+    """Set of transaction ids that have already been worked on.
+
+        Supports `tx_id in store` and `store.add(tx_id)`, like the plain sets it replaces, but `add`
+        reports whether the id was newly added so check & mark can be done in one atomic step.
+    """
+    backend: str
+    ttl_secs: float
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(tx_id: TxId) -> str:
+        return str(tx_id)
+
+    @abstractmethod
+    def _contains(self, key: str) -> bool:
+        """Whether the key is held & unexpired"""
+
+    @abstractmethod
+    def _add(self, key: str) -> bool:
+        """Holds the key. Returns True if it wasn't already held"""
+
+    @abstractmethod
+    def _discard(self, key: str):
+        """Stops holding the key, if held"""
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of keys held"""
+
+    def __contains__(self, tx_id: TxId) -> bool:
+        if self._contains(self._key(tx_id)):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, tx_id: TxId) -> bool:
+        """Marks the id as seen. Returns True if it wasn't already"""
+        if self._add(self._key(tx_id)):
+            self.misses += 1
+            return True
+        self.hits += 1
+        return False
+
+    def discard(self, tx_id: TxId):
+        self._discard(self._key(tx_id))
+
+    def hold_for_at_least(self, secs: float):
+        """Keeps ids marked from now on for no less than `secs`"""
+        self.ttl_secs = max(self.ttl_secs, secs)
+
+    def stats(self) -> Dict:
+        return {
+            'backend': self.backend,
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class MemoryDedupStore(DedupStore):
+    """Per-process store - each gunicorn worker has its own.
+
+        Bounded in both size and time: ids expire `ttl_secs` after being marked, and once `max_size`
+        ids are held the least recently used one is evicted. Ids are held as ints rather than strings.
+    """
+    backend = 'memory'
+
+    def __init__(self, namespace: str, props: Dict = None):
+        super().__init__(namespace=namespace)
+        props = props if props is not None else {}
+        self.max_size = prop_int(props, 'dedup-max-size', 10000)
+        self.ttl_secs = _ttl_secs(props, namespace)
+        # id -> expiry time, least recently used first
+        self._ids: OrderedDict[Union[int, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(tx_id: TxId) -> Union[int, str]:
+        try:
+            return int(tx_id)
+        except (TypeError, ValueError):
+            return str(tx_id)
+
+    def _contains(self, key: Union[int, str]) -> bool:
+        with self._lock:
+            return self._live(key, now=time.monotonic())
+
+    def _live(self, key: Union[int, str], now: float) -> bool:
+        """Whether the id is held & unexpired; refreshes its recency if so. Expects the lock to be held"""
+        expires_at = self._ids.get(key)
+        if expires_at is None:
+            return False
+        if expires_at <= now:
+            del self._ids[key]
+            self.expired += 1
+            return False
+        self._ids.move_to_end(key)
+        return True
+
+    def _add(self, key: Union[int, str]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if self._live(key, now=now):
+                return False
+            self._ids[key] = now + self.ttl_secs
+            # Drop anything expired at the cold end, then enforce the size bound
+            while self._ids:
+                oldest_key, oldest_expiry = next(iter(self._ids.items()))
+                if oldest_expiry > now:
+                    break
+                self._ids.popitem(last=False)
+                self.expired += 1
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+                self.evicted += 1
+            return True
+
+    def _discard(self, key: Union[int, str]):
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def stats(self) -> Dict:
+        return {
+            **super().stats(),
+            'max_size': self.max_size,
+            'ttl_secs': self.ttl_secs,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+
+class SqliteDedupStore(DedupStore):
+    """Store shared by all workers on the host through a SQLite (WAL) file, with entries expiring after a TTL.
+
+        Ids known to be seen are also kept in a local dict until they expire, so repeat lookups of a hot id
+        are a dict hit; only lookups this worker hasn't seen go to the file (a primary key probe).
+    """
+    backend = 'sqlite'
+
+    def __init__(self, namespace: str, props: Dict = None):
+        super().__init__(namespace=namespace)
+        props = props if props is not None else {}
+        self.path = pathlib.Path(props.get('dedup-path', pathlib.Path.home().joinpath('data', 'ffrelay-dedup.db')))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl_secs = _ttl_secs(props, namespace)
+        self._local: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._ops_since_purge = 0
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS seen_ids (
+                namespace TEXT NOT NULL,
+                tx_id TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (namespace, tx_id)
+            ) WITHOUT ROWID
+        ''')
+
+    def _contains(self, key: str) -> bool:
+        now = time.time()
+        if (expires_at := self._local.get(key)) is not None and expires_at > now:
+            return True
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT expires_at FROM seen_ids WHERE namespace = ? AND tx_id = ? AND expires_at > ?',
+                (self.namespace, key, now)
+            ).fetchone()
+        if row is None:
+            self._local.pop(key, None)
+            return False
+        self._local[key] = row[0]
+        return True
+
+    def _add(self, key: str) -> bool:
+        now = time.time()
+        expires_at = now + self.ttl_secs
+        with self._lock:
+            # Insert, or take over an expired entry - either way, this worker now owns the id
+            n_rows = self.conn.execute(
+                'INSERT INTO seen_ids (namespace, tx_id, expires_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (namespace, tx_id) DO UPDATE SET expires_at = excluded.expires_at '
+                'WHERE seen_ids.expires_at <= ?',
+                (self.namespace, key, expires_at, now)
+            ).rowcount
+            self._ops_since_purge += 1
+        if self._ops_since_purge >= 1000:
+            self.purge_expired()
+        if n_rows == 1:
+            self._local[key] = expires_at
+        return n_rows == 1
+
+    def _discard(self, key: str):
+        self._local.pop(key, None)
+        with self._lock:
+            self.conn.execute('DELETE FROM seen_ids WHERE namespace = ? AND tx_id = ?', (self.namespace, key))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        self._local = {k: v for k, v in self._local.items() if v > now}
+        with self._lock:
+            self._ops_since_purge = 0
+            return self.conn.execute(
+                'DELETE FROM seen_ids WHERE namespace = ? AND expires_at <= ?', (self.namespace, now)
+            ).rowcount
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM seen_ids WHERE namespace = ? AND expires_at > ?',
+                (self.namespace, time.time())
+            ).fetchone()[0]
+
+
+DEDUP_BACKENDS: Dict[str, Type[DedupStore]] = {
+    MemoryDedupStore.backend: MemoryDedupStore,
+    SqliteDedupStore.backend: SqliteDedupStore,
+}
+
+
+def make_dedup_store(props: Dict, namespace: str) -> DedupStore:
+    """Builds the dedup store selected by the `dedup-backend` prop (default: memory)"""
+    backend = props.get('dedup-backend', MemoryDedupStore.backend)
+    if backend not in DEDUP_BACKENDS:
+        raise ValueError(f'Unknown dedup backend "{backend}" - expected one of {", ".join(DEDUP_BACKENDS)}')
+    return DEDUP_BACKENDS[backend](namespace=namespace, props=props)
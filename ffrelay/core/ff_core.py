@@ -1,17 +1,92 @@
 import datetime
 import re
+import time
 from typing import (
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Optional,
+    Tuple,
     Union,
 )
+from urllib.parse import (
+    quote,
+    urlencode,
+)
 
 from loguru import logger
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    HTTPError,
+    Timeout,
+)
+from requests.exceptions import ConnectionError as RequestsConnectionError
+
+from ffrelay.core.amounts import (
+    proportional_amounts,
+    same_amount,
+)
+from ffrelay.core.dedup import make_dedup_store
+from ffrelay.core.link_index import LinkIndex
+from ffrelay.core.metrics import (
+    FIREFLY_ERRORS,
+    FIREFLY_IN_FLIGHT,
+    FIREFLY_LATENCY,
+    STAGE_LATENCY,
+    TRANSACTIONS,
+)
+from ffrelay.core.payload import (
+    TX_LINK_PATTERN,
+    TransactionEvent,
+    as_event,
+)
+from ffrelay.core.prop_cache import (
+    PropTxCache,
+    PropTxRecord,
+)
+from ffrelay.core.resilience import (
+    IDEMPOTENT_METHODS,
+    CircuitBreaker,
+    RetryPolicy,
+)
+from ffrelay.core.tag_rules import TagRuleEngine
+from ffrelay.core.throttle import (
+    AdaptiveConcurrencyLimiter,
+    TokenBucket,
+    _CallOutcome,
+)
+from ffrelay.core.tracing import (
+    TRACER,
+    Span,
+)
+from ffrelay.core.tx_lock import (
+    DEFAULT_LOCK_DIR,
+    KeyedLock,
+)
+from ffrelay.core.utils import (
+    parse_retry_after,
+    prop_bool,
+    prop_float,
+    prop_int,
+)
+
+# Statuses that mean Firefly is overloaded (or on its way to it)
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+# Ids in an endpoint - swapped out so each endpoint gets one set of metrics
+ENDPOINT_ID_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+
+def endpoint_label(endpoint: str) -> str:
+    """The endpoint with ids and query left out, e.g. '/transactions/{id}'"""
+    return ENDPOINT_ID_PATTERN.sub('/{id}', endpoint.split('?', 1)[0])
 
 
 class FireFlyRelayCore:
+    # Failures to reach Firefly at all - worth retrying, and counted by the circuit breaker
+    TRANSIENT_ERRORS = (RequestsConnectionError, Timeout)
 
     def __init__(self, props: Dict):
         url = props.get('ff-base-url')
@@ -26,53 +101,217 @@ class FireFlyRelayCore:
         }
         self.props = props
         # New transaction ids (original and proportion transaction)
-        self.new_txs = set()
+        self.new_txs = make_dedup_store(props, namespace='new')
         # Updated transaction ids (original and proportion transaction)
-        self.updated_txs = set()
+        self.updated_txs = make_dedup_store(props, namespace='updated')
+        # Compiled once - decides which tags call for a proportional transaction
+        self.tag_rules = TagRuleEngine.from_props(props)
+
+        # HTTP session - pooled & kept alive so consecutive calls to Firefly reuse the same connection
+        self.timeout = (
+            prop_float(props, 'http-connect-timeout', 3.05),
+            prop_float(props, 'http-read-timeout', 30.0),
+        )
+        self.request_count = 0
+        self.session = self._build_session()
+
+        # Shared by all calls to Firefly: a token bucket for the request rate, and an
+        #   AIMD limit on calls in flight that backs off when Firefly slows down or errors out
+        self.rate_limiter = TokenBucket(
+            rate=prop_float(props, 'ff-rate-limit', 10.0),
+            burst=prop_int(props, 'ff-rate-burst', 20),
+        )
+        self.concurrency = AdaptiveConcurrencyLimiter(
+            initial=prop_int(props, 'ff-concurrency', 4),
+            min_limit=prop_int(props, 'ff-concurrency-min', 1),
+            max_limit=prop_int(props, 'ff-concurrency-max', 16),
+            latency_target=prop_float(props, 'ff-latency-target', 2.0),
+        )
+        # Retries for idempotent calls & a breaker to stop calling while Firefly is down
+        self.retry_policy = RetryPolicy(
+            max_attempts=prop_int(props, 'ff-retry-max-attempts', 3),
+            base_delay=prop_float(props, 'ff-retry-base-delay', 0.5),
+            max_delay=prop_float(props, 'ff-retry-max-delay', 8.0),
+            budget_ratio=prop_float(props, 'ff-retry-budget', 0.2),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=prop_int(props, 'ff-breaker-threshold', 5),
+            reset_secs=prop_float(props, 'ff-breaker-reset-secs', 30.0),
+        )
+        # Which proportional transactions were made from which original splits (and whether the
+        #   original's notes link to them yet), persisted if a path is set
+        self.link_index = LinkIndex(path=props.get('link-index-path'))
+        # Create the proportional transactions for several tagged splits as one grouped transaction
+        self.batch_splits = prop_bool(props, 'batch-splits')
+        if self.batch_splits and self.link_index.path is None:
+            logger.warning('batch-splits is on without a link-index-path - the links to grouped proportional '
+                           'transactions are lost on restart and not shared between workers')
+        # Share of webhook payloads dumped to the log in full
+        self.payload_log_rate = prop_float(props, 'log-payload-sample-rate', 0.0)
+        # Proportional transactions we've created or updated, as Firefly last described them
+        self.prop_cache = PropTxCache(
+            max_size=prop_int(props, 'prop-cache-size', 2000),
+            ttl_secs=prop_float(props, 'prop-cache-ttl-secs', 3600.0),
+            sole_writer=prop_bool(props, 'prop-cache-sole-writer'),
+        )
+        # Serializes the handling of each transaction id, across gunicorn workers & the CLIs too
+        #   (unless tx-lock-dir is set empty)
+        self.tx_locks = KeyedLock(
+            lock_dir=props.get('tx-lock-dir', DEFAULT_LOCK_DIR),
+            timeout_secs=prop_float(props, 'tx-lock-timeout-secs', 30.0),
+        )
 
-    def _get(self, endpoint: str) -> requests.Response:
-        resp = requests.get(
-            f'{self.api_url}{endpoint}',
-            headers=self.headers,
+    def _build_session(self) -> requests.Session:
+        """Builds the session that's shared across all requests handled by this worker"""
+        session = requests.Session()
+        session.headers.update(self.headers)
+        if not prop_bool(self.props, 'http-keep-alive', default=True):
+            session.headers['Connection'] = 'close'
+        adapter = HTTPAdapter(
+            pool_connections=prop_int(self.props, 'http-pool-connections', 1),
+            pool_maxsize=prop_int(self.props, 'http-pool-size', 10),
+            pool_block=prop_bool(self.props, 'http-pool-block', default=False),
         )
-        try:
-            resp.raise_for_status()
-        except Exception as e:
-            logger.error(e)
-            raise e
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        self.adapter = adapter
+        return session
+
+    def pool_stats(self) -> Dict:
+        """Reports connection pool usage for the Firefly session"""
+        pools = []
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                'host': f'{pool.scheme}://{pool.host}:{pool.port}',
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': pool.pool.qsize() if pool.pool is not None else 0,
+            })
+        return {
+            'pool_maxsize': self.adapter._pool_maxsize,
+            'keep_alive': self.session.headers.get('Connection') != 'close',
+            'timeout': {'connect': self.timeout[0], 'read': self.timeout[1]},
+            'requests_sent': self.request_count,
+            'pools': pools,
+        }
+
+    def close(self):
+        """Releases the pooled connections"""
+        self.session.close()
+
+    def throttle_stats(self) -> Dict:
+        return {
+            'rate_limit': self.rate_limiter.stats(),
+            'concurrency': self.concurrency.stats(),
+        }
+
+    def resilience_stats(self) -> Dict:
+        return {
+            'retry': self.retry_policy.stats(),
+            'circuit_breaker': self.breaker.stats(),
+        }
+
+    def _send(self, method: str, endpoint: str, data: Dict = None) -> requests.Response:
+        """Sends a single attempt of a call, under the rate & concurrency limits"""
+        self.rate_limiter.acquire()
+        endpoint_name = endpoint_label(endpoint)
+        with self.concurrency.slot() as outcome:
+            self.request_count += 1
+            FIREFLY_IN_FLIGHT.inc()
+            start = time.perf_counter()
+            try:
+                resp = self.session.request(
+                    method,
+                    f'{self.api_url}{endpoint}',
+                    json=data,
+                    timeout=self.timeout,
+                )
+            except Exception as e:
+                FIREFLY_ERRORS.inc(method=method, endpoint=endpoint_name, status=type(e).__name__)
+                raise
+            finally:
+                FIREFLY_IN_FLIGHT.dec()
+                FIREFLY_LATENCY.observe(time.perf_counter() - start, method=method, endpoint=endpoint_name)
+            self._check_response(method, endpoint_name, resp, failed=not resp.ok, outcome=outcome)
         return resp
 
-    def _post(self, endpoint: str, data: Dict) -> requests.Response:
-        resp = requests.post(
-            f'{self.api_url}{endpoint}',
-            headers=self.headers,
-            json=data
-        )
-        try:
-            resp.raise_for_status()
-        except Exception as e:
-            logger.error(e)
+    def _check_response(self, method: str, endpoint_name: str, resp, failed: bool, outcome: _CallOutcome):
+        """Counts a failed call, and flags overload to the concurrency limiter (and rate limiter on a 429)"""
+        if failed:
+            FIREFLY_ERRORS.inc(method=method, endpoint=endpoint_name, status=resp.status_code)
+        if resp.status_code in OVERLOAD_STATUS_CODES:
+            outcome.overloaded = True
+            if resp.status_code == 429:
+                # Firefly asked us to back off - hold everyone for as long as it says
+                self.rate_limiter.pause(parse_retry_after(resp.headers.get('Retry-After'), default=1.0))
+
+    def _request(self, method: str, endpoint: str, data: Dict = None) -> requests.Response:
+        """Calls Firefly through the circuit breaker, retrying transient failures of idempotent calls"""
+        self.retry_policy.record_call()
+        with TRACER.span(f'firefly {method} {endpoint_label(endpoint)}') as span:
+            return self._request_with_retries(method, endpoint, data=data, span=span)
+
+    def _request_with_retries(self, method: str, endpoint: str, data: Dict = None,
+                              span: Optional[Span] = None) -> requests.Response:
+        attempt = 1
+        while True:
+            self.breaker.before_call()
+            resp = None
+            try:
+                resp = self._send(method, endpoint, data=data)
+                resp.raise_for_status()
+            except Exception as e:
+                if (delay := self._retry_delay(method, endpoint, attempt, resp=resp, error=e)) is not None:
+                    time.sleep(delay)
+                    attempt += 1
+                    continue
+                self._give_up(attempt, data=data, error=e, span=span)
+                raise e
+            self.breaker.record_success()
+            if span is not None:
+                span.args.update(attempts=attempt, status=resp.status_code)
+            return resp
+
+    def _retry_delay(self, method: str, endpoint: str, attempt: int, resp, error: Exception) -> Optional[float]:
+        """Records a failed attempt with the breaker. Returns how long to wait before retrying it, or None to give up"""
+        status = resp.status_code if resp is not None else None
+        is_transient = status in OVERLOAD_STATUS_CODES or isinstance(error, self.TRANSIENT_ERRORS)
+        if is_transient:
+            self.breaker.record_failure()
+        else:
+            # Firefly answered - it's up, the request itself was bad
+            self.breaker.record_success()
+        if not is_transient or method not in IDEMPOTENT_METHODS or attempt >= self.retry_policy.max_attempts \
+                or not self.retry_policy.try_spend():
+            return None
+        delay = self.retry_policy.delay(attempt)
+        if status == 429:
+            delay = max(delay, parse_retry_after(resp.headers.get('Retry-After'), default=0.0))
+        logger.warning(f'{method} {endpoint} failed ({error}) - retry {attempt} in {delay:.2f}s')
+        return delay
+
+    @staticmethod
+    def _give_up(attempt: int, data: Optional[Dict], error: Exception, span: Optional[Span]):
+        logger.error(error)
+        if data is not None:
             logger.warning(data)
-            raise e
-        return resp
+        if span is not None:
+            span.args.update(attempts=attempt, error=str(error))
+
+    def _get(self, endpoint: str) -> requests.Response:
+        return self._request('GET', endpoint)
+
+    def _post(self, endpoint: str, data: Dict) -> requests.Response:
+        return self._request('POST', endpoint, data=data)
 
     def _put(self, endpoint: str, data: Dict) -> requests.Response:
-        resp = requests.put(
-            f'{self.api_url}{endpoint}',
-            headers=self.headers,
-            json=data
-        )
-        try:
-            resp.raise_for_status()
-        except Exception as e:
-            logger.error(e)
-            logger.warning(data)
-            raise e
-        return resp
+        return self._request('PUT', endpoint, data=data)
 
-    def new_single_transaction(
-            self,
-            title: str,
+    @staticmethod
+    def _tx_split(
             tx_type: str,
             amount: float,
             desc: str,
@@ -81,15 +320,30 @@ class FireFlyRelayCore:
             tx_date: Union[datetime.datetime, datetime.date] = None,
             notes: str = None,
             tags: List[str] = None,
-            currency: str = 'USD'
-    ):
+            currency: str = 'USD',
+            order: int = 0
+    ) -> Dict:
+        """Builds a single split (journal) for a new transaction"""
         if tx_date is None:
             tx_date = datetime.datetime.now(tz=pytz.timezone("US/Central"))
-        elif isinstance(tx_date, datetime.date):
+        elif not isinstance(tx_date, datetime.datetime):
             tx_date = datetime.datetime.combine(tx_date, datetime.time.min, tzinfo=pytz.timezone("US/Central"))
 
-        tx_date_str = tx_date.strftime('%FT%T%z')
+        return {
+            "type": tx_type,
+            "date": tx_date.strftime('%FT%T%z'),
+            "amount": str(amount),
+            "description": desc,
+            "order": order,
+            "currency_code": currency,
+            "source_id": str(source_acct_id),
+            "destination_id": str(dest_acct_id),
+            "reconciled": False,
+            "tags": tags,
+            "notes": notes,
+        }
 
+    def _new_transaction(self, title: str, splits: List[Dict]) -> requests.Response:
         resp = self._post(
             endpoint='/transactions',
             data={
@@ -97,30 +351,71 @@ class FireFlyRelayCore:
                 "apply_rules": False,
                 "fire_webhooks": False,
                 "group_title": title,
-                "transactions": [
-                    {
-                        "type": tx_type,
-                        "date": tx_date_str,
-                        "amount": str(amount),
-                        "description": desc,
-                        "order": 0,
-                        "currency_code": currency,
-                        "source_id": str(source_acct_id),
-                        "destination_id": str(dest_acct_id),
-                        "reconciled": False,
-                        "tags": tags,
-                        "notes": notes,
-                    }
-                ]
+                "transactions": splits
             }
         )
+        self._observe_prop_tx(resp)
         return resp
 
+    def new_single_transaction(
+            self,
+            title: str,
+            tx_type: str,
+            amount: float,
+            desc: str,
+            source_acct_id: int = None,
+            dest_acct_id: int = None,
+            tx_date: Union[datetime.datetime, datetime.date] = None,
+            notes: str = None,
+            tags: List[str] = None,
+            currency: str = 'USD'
+    ):
+        return self._new_transaction(title=title, splits=[self._tx_split(
+            tx_type=tx_type, amount=amount, desc=desc, source_acct_id=source_acct_id, dest_acct_id=dest_acct_id,
+            tx_date=tx_date, notes=notes, tags=tags, currency=currency,
+        )])
+
+    def new_split_transaction(self, title: str, splits: List[Dict]) -> requests.Response:
+        """Creates one transaction group with a split for each of `splits`
+            (each a dict of `new_single_transaction`'s arguments, less the title)"""
+        return self._new_transaction(title=title, splits=[
+            self._tx_split(**split, order=i) for i, split in enumerate(splits)
+        ])
+
     def get_transaction(self, transaction_id: Union[int, str]) -> Dict:
         logger.debug(f'Getting transaction info for transaction id {transaction_id}')
         resp = self._get(endpoint=f'/transactions/{transaction_id}')
         resp.raise_for_status()
-        return resp.json()['data']
+        data = resp.json()['data']
+        self.prop_cache.observe(data)
+        return data
+
+    def list_transactions(self, start: datetime.date = None, end: datetime.date = None, page: int = 1,
+                          limit: int = 100, tag: str = None) -> Dict:
+        """Gets a page of transaction groups (newest first), optionally limited to a date range and/or tag.
+            Returns the raw response body - 'data' holds the page, 'meta' the pagination info"""
+        params = {'page': page, 'limit': limit}
+        if start is not None:
+            params['start'] = start.strftime('%F')
+        if end is not None:
+            params['end'] = end.strftime('%F')
+        endpoint = '/transactions' if tag is None else f'/tags/{quote(tag, safe="")}/transactions'
+        resp = self._get(endpoint=f'{endpoint}?{urlencode(params)}')
+        return resp.json()
+
+    def iter_transaction_pages(self, start: datetime.date = None, end: datetime.date = None, first_page: int = 1,
+                               limit: int = 100, tag: str = None) -> Iterator[Tuple[int, int, List[Dict]]]:
+        """Pages through transaction groups, yielding (page number, total pages, page data)"""
+        page = first_page
+        while True:
+            body = self.list_transactions(start=start, end=end, page=page, limit=limit, tag=tag)
+            total_pages = body.get('meta', {}).get('pagination', {}).get('total_pages', page)
+            data = body.get('data', [])
+            if len(data) > 0:
+                yield page, total_pages, data
+            if page >= total_pages or len(data) == 0:
+                break
+            page += 1
 
     def update_transaction(self, tx_id: Union[int, str], transactions: List[Dict],
                            tx_title: str = None) -> requests.Response:
@@ -141,35 +436,164 @@ class FireFlyRelayCore:
         )
 
         resp.raise_for_status()
+        self._observe_update(resp)
         return resp
 
-    def handle_incoming_transaction_data(self, data: Dict, is_new: bool) -> List[Dict]:
+    def _observe_prop_tx(self, resp: requests.Response):
+        """Feeds a transaction group we got back from Firefly into the proportional transaction cache"""
+        try:
+            self.prop_cache.observe(resp.json().get('data'))
+        except ValueError:
+            pass
+
+    def _observe_update(self, resp: requests.Response):
+        """Feeds a group we updated into the cache, and marks the update time our write gave it as seen -
+            so the change we made doesn't come back around as an edit to handle (e.g. from the sync poller)"""
+        try:
+            tx_group = resp.json().get('data')
+        except ValueError:
+            return
+        self.prop_cache.observe(tx_group)
+        if not isinstance(tx_group, dict) or tx_group.get('id') is None:
+            return
+        if updated_at := (tx_group.get('attributes') or {}).get('updated_at'):
+            self.mark_seen(tx_group['id'], is_new=False, updated_at=updated_at)
+
+    @staticmethod
+    def _seen_key(tx_id: Union[int, str], is_new: bool, updated_at: Optional[str]) -> Union[int, str]:
+        """What a webhook is deduplicated by: the id for a new transaction, the id & update time for an update -
+            so a redelivery of the same edit is skipped, but a later edit of the transaction never is"""
+        if is_new or not updated_at:
+            return tx_id
+        return f'{tx_id}@{updated_at}'
+
+    def is_seen(self, tx_id: Union[int, str], is_new: bool, updated_at: str = None) -> bool:
+        """Whether the webhook for this transaction id (and update time) has already been worked on"""
+        return self._seen_key(tx_id, is_new, updated_at) in (self.new_txs if is_new else self.updated_txs)
+
+    def mark_seen(self, tx_id: Union[int, str], is_new: bool, updated_at: str = None) -> bool:
+        """Marks the webhook for this transaction id (and update time) as worked on.
+            Returns False if it already was"""
+        return (self.new_txs if is_new else self.updated_txs).add(self._seen_key(tx_id, is_new, updated_at))
+
+    def release(self, tx_id: Union[int, str], is_new: bool, updated_at: str = None):
+        """Undoes mark_seen, e.g. when the webhook couldn't be accepted after all"""
+        (self.new_txs if is_new else self.updated_txs).discard(self._seen_key(tx_id, is_new, updated_at))
+
+    def tx_lock_stats(self) -> Dict:
+        return self.tx_locks.stats()
+
+    def dedup_stats(self) -> Dict:
+        return {
+            'new': self.new_txs.stats(),
+            'updated': self.updated_txs.stats(),
+        }
+
+    def process_event(self, data: Union[Dict, TransactionEvent], is_new: bool) -> int:
+        """Runs a webhook payload through tag matching and proportional transaction handling.
+            Returns the number of splits acted upon"""
+        event = as_event(data)
+        with self.tx_locks.hold(event.id) as waited:
+            if waited:
+                # Another webhook for this transaction was just handled - what we were sent may be out of date
+                event = self.refresh_event(event)
+                if event is None:
+                    return 0
+            start = time.perf_counter()
+            new_txs = self.handle_incoming_transaction_data(data=event, is_new=is_new)
+            STAGE_LATENCY.observe(time.perf_counter() - start, stage='tag_match')
+            if len(new_txs) == 0:
+                logger.debug('No transactions with matching tags found!')
+                TRANSACTIONS.inc(outcome='skipped')
+                return 0
+            start = time.perf_counter()
+            self.process_new_splits(
+                new_splits=new_txs,
+                transaction_data=event
+            )
+            STAGE_LATENCY.observe(time.perf_counter() - start, stage='sync')
+            return len(new_txs)
+
+    def process_accepted(self, data: Union[Dict, TransactionEvent], is_new: bool) -> int:
+        """process_event for a webhook already marked as seen - if it fails the mark is released,
+            so Firefly's redelivery (or the sync poller) isn't dropped as a duplicate"""
+        event = as_event(data)
+        try:
+            return self.process_event(data=event, is_new=is_new)
+        except Exception:
+            self.release(tx_id=event.id, is_new=is_new, updated_at=event.updated_at)
+            raise
+
+    def refresh_event(self, event: TransactionEvent) -> Optional[TransactionEvent]:
+        """The transaction as Firefly has it now - None if it's been deleted"""
+        try:
+            return TransactionEvent.from_group(self.get_transaction(event.id))
+        except HTTPError as e:
+            if getattr(e, 'response', None) is not None and e.response.status_code == 404:
+                logger.info(f'Transaction {event.id} is gone - nothing to do')
+                return None
+            raise
+
+    @TRACER.wrap('handle_incoming_transaction_data')
+    def handle_incoming_transaction_data(self, data: Union[Dict, TransactionEvent], is_new: bool,
+                                         mark_seen: bool = True) -> List[Dict]:
         """
             Takes in incoming transaction data, determines if any meet the tag criteria for
              proportion-based replication. Outputs a list of dicts of new transactions to make
              (and original transaction details to update)
         """
-        logger.info('Receiving data for transaction...')
-        logger.info(data)
-
-        content = data['content']
-        tx_id = content['id']
-        txs = content['transactions']
-        logger.info(f'Transaction id: {tx_id}')
-        if is_new:
-            self.new_txs.add(tx_id)
-        else:
-            self.updated_txs.add(tx_id)
+        return self.plan_events([data], is_new=is_new, mark_seen=mark_seen)[0]
+
+    def plan_events(self, events: Iterable[Union[Dict, TransactionEvent]], is_new: bool,
+                    mark_seen: bool = True) -> List[List[Dict]]:
+        """handle_incoming_transaction_data for a batch of transaction groups (e.g. a page of them, or an import):
+            one list of new transactions per group, with the proportional amounts all worked out in one pass
+        """
+        plans = []
+        # (amount, proportion) of each new transaction, in order
+        pairs = []
+        for data in events:
+            plans.append(self._plan_event(as_event(data), is_new=is_new, mark_seen=mark_seen, pairs=pairs))
+        amounts = iter(proportional_amounts(pairs))
+        for new_txs in plans:
+            for new_tx in new_txs:
+                new_tx['new_tx']['amount'] = next(amounts)
+        return plans
+
+    def _plan_event(self, event: TransactionEvent, is_new: bool, mark_seen: bool,
+                    pairs: List[Tuple[str, int]]) -> List[Dict]:
+        """The new transactions for one group - without their amounts, whose inputs are added to `pairs`"""
+        tx_id = event.id
+        logger.info(f'Receiving data for transaction id: {tx_id} ({len(event.transactions)} split(s))')
+        if mark_seen:
+            self.mark_seen(tx_id=tx_id, is_new=is_new, updated_at=event.updated_at)
 
         new_txs = []
+        group_title = event.group_title
 
         # Iterate through splits; for any transaction split containing the tag pattern,
         #   build the criteria needed to create a new transaction for it
-        for i, tx in enumerate(txs):
-            tags = tx.get('tags')
-            if not tags:
-                tags = []
-            for tag in tags:
+        for i, tx in enumerate(event.transactions):
+            if not tx.tags:
+                continue
+            tag_matches = self.tag_rules.match_tags(tx.tags)
+            if not tag_matches:
+                continue
+            links = [x for x in self.link_index.links_for(tx_id, tx.transaction_journal_id) if x.linked]
+            if not links and tx.notes and (current_notes := TX_LINK_PATTERN.search(tx.notes)):
+                # Linked before the index knew about it. Remember it for next time
+                links = [self.link_index.add(orig_tx_id=tx_id, journal_id=tx.transaction_journal_id, split_index=i,
+                                             prop_tx_id=current_notes.group(1))]
+            # Existing link to a proportional transaction - likely updated
+            if links:
+                logger.info('Transaction is an update that was previously handled by this process.')
+            desc = tx.description
+            title = f'Prop - {group_title if group_title else desc}'
+            for tag_match in tag_matches:
+                # The proportional transaction made for this tag - or an older link that doesn't record one.
+                #   A tag added since gets its own, rather than editing another tag's
+                link = next((x for x in links if x.tag == tag_match.tag), None) \
+                    or next((x for x in links if x.tag is None), None)
                 """
                     ⠀ ⣠⠴⠶⠦⣄⠀⠀⣠⠤⢤⡀⠀⢀⣀⣀⣀⠀⠀⠀⠀⠀⠀⠀⠀
                 ⠀⠀⠀⠀⢸⠱⠀⠀⠀⠈⢧⡞⠁⠀⠀⢹⡴⠋⠀⠀⠈⠳⡀⠀⠀⠀⠀⠀⠀
@@ -197,50 +621,37 @@ class FireFlyRelayCore:
                                              `-=``      `:    |   /-/-/`
                                                          `.__/
                 """
-                if tag_match := re.match(r'\w+-p(\d+)', tag):
-                    is_updated = False
-                    prop_tx_id = None
-                    tx_notes = tx.get('notes') if tx.get('notes') is not None else ''
-                    if current_notes := re.search(r'\w+\stx:\shttps?:\/\/.*\/show\/(\d+)', tx_notes):
-                        logger.info('Transaction is an update that was previously handled by this process.')
-                        # Existing note in transaction - likely updated
-                        is_updated = True
-                        prop_tx_id = current_notes.group(1)
-                    raw_proportion = tag_match.group(1)
-                    desc = tx.get('description')
-                    if not content.get("group_title"):
-                        title = f'Prop - {desc}'
-                    else:
-                        title = f'Prop - {content.get("group_title")}'
-                    if raw_proportion.isnumeric():
-                        proportion = float(raw_proportion) / 100
-                        amount = round(float(tx.get('amount')) * proportion, 2)
-                        new_txs.append({
-                            'is_update': is_updated,
-                            'new_tx': {
-                                'title': title,
-                                'tx_type': 'deposit' if tx.get('type') == 'withdrawal' else 'withdrawal',
-                                'amount': str(amount),
-                                'desc': desc,
-                                'source_acct_id': self.props.get('inc-acct-id'),
-                                'dest_acct_id': self.props.get('owe-acct-id'),
-                                'notes': f'From tx: {self.base_url}/transactions/show/{tx_id}'
-                            },
-                            'org_tx': {
-                                # The main transaction
-                                'id': tx_id,
-                                'tx_jrnl_id': str(tx.get('transaction_journal_id')),
-                                'prop_tx_id': prop_tx_id,
-                                # The index of the split that was used.
-                                #   For most transactions, this will always be 0
-                                'index': i
-                            }
-                        })
+                pairs.append((tx.amount, tag_match.proportion))
+                new_txs.append({
+                    'is_update': link is not None,
+                    'new_tx': {
+                        'title': title,
+                        'tx_type': 'deposit' if tx.type == 'withdrawal' else 'withdrawal',
+                        # Filled in with the rest of the batch
+                        'amount': None,
+                        'desc': desc,
+                        'source_acct_id': tag_match.source_acct_id or self.props.get('inc-acct-id'),
+                        'dest_acct_id': tag_match.dest_acct_id or self.props.get('owe-acct-id'),
+                        'notes': f'From tx: {self.base_url}/transactions/show/{tx_id}'
+                    },
+                    'org_tx': {
+                        # The main transaction
+                        'id': tx_id,
+                        'tx_jrnl_id': tx.transaction_journal_id,
+                        'prop_tx_id': link.prop_tx_id if link else None,
+                        'prop_jrnl_id': link.prop_journal_id if link else None,
+                        'tag': tag_match.tag,
+                        # The index of the split that was used.
+                        #   For most transactions, this will always be 0
+                        'index': i
+                    }
+                })
         logger.info(f'{len(new_txs)} new transactions to make from transaction id {tx_id}')
         return new_txs
 
-    def add_to_notes(self, transaction_data: Dict, split_index: int, new_transaction_id: int) -> str:
-        org_notes = transaction_data['transactions'][split_index]['notes']
+    def add_to_notes(self, transaction_data: Union[Dict, TransactionEvent], split_index: int,
+                     new_transaction_id: int) -> str:
+        org_notes = as_event(transaction_data).transactions[split_index].notes
         tx_note = f'Proportion tx: {self.base_url}/transactions/show/{new_transaction_id}'
         if org_notes is None:
             org_notes = tx_note
@@ -248,38 +659,58 @@ class FireFlyRelayCore:
             org_notes += f'\n{tx_note}'
         return org_notes
 
-    def process_new_splits(self, new_splits: List[Dict], transaction_data: Dict):
-        triggered_tx_id = transaction_data['id']
-
+    def process_new_splits(self, new_splits: List[Dict], transaction_data: Union[Dict, TransactionEvent]):
+        transaction_data = as_event(transaction_data)
+        triggered_tx_id = transaction_data.id
+
+        batched = self.batch_splits and sum(1 for x in new_splits if not x.get('is_update')) > 1
+        if batched:
+            self.process_new_transactions_batched(
+                triggered_tx_id=triggered_tx_id,
+                splits=[x for x in new_splits if not x.get('is_update')],
+                transaction_data=transaction_data
+            )
+
+        # The main transaction was updated. Find each proportion transaction and update its amounts
+        for splits in self._updates_by_prop_tx(new_splits).values():
+            self.process_updated_transaction(
+                triggered_tx_id=triggered_tx_id,
+                splits=splits
+            )
         for split in new_splits:
-            if split.get('is_update'):
-                # The main transaction was updated. Find the proportion transaction and update the amount
-                self.process_updated_transaction(
-                    triggered_tx_id=triggered_tx_id,
-                    split=split
-                )
-            else:
+            if not split.get('is_update') and not batched:
                 self.process_new_transaction(
                     triggered_tx_id=triggered_tx_id,
                     split=split,
                     transaction_data=transaction_data
                 )
 
-    def process_new_transaction(self, triggered_tx_id: int, split: Dict, transaction_data: Dict):
-        """Creates a new proportional transaction, then updated the original, new transaction
-            (that triggered this process) with that proportional transaction's details"""
-        logger.info('Creating new transaction...')
-
-        modified_splits = [{'transaction_journal_id': str(x['transaction_journal_id'])}
-                           for x in transaction_data['transactions']]
-
-        new_tx_resp = self.new_single_transaction(**split.get('new_tx'))
-        new_tx_id = new_tx_resp.json()['data']['id']
-        self.new_txs.add(new_tx_id)
-
-        logger.info('Updating original transaction')
-        split_tx_index = split['org_tx']['index']
-        org_notes = self.add_to_notes(transaction_data=transaction_data, split_index=split_tx_index,
+    @staticmethod
+    def _split_journal_ids(tx_group: Dict) -> List[str]:
+        """The journal ids of a transaction group's splits, in the order they were sent"""
+        splits = sorted(tx_group.get('attributes', {}).get('transactions', []), key=lambda x: x.get('order') or 0)
+        return [str(x['transaction_journal_id']) for x in splits]
+
+    def _record_new_prop_tx(self, triggered_tx_id: int, org_tx: Dict, prop_tx_id: str,
+                            prop_journal_id: Optional[str]):
+        """Notes a proportional transaction we just created - not yet linked in the original's notes"""
+        self.link_index.add(orig_tx_id=triggered_tx_id, journal_id=org_tx['tx_jrnl_id'], split_index=org_tx['index'],
+                            prop_tx_id=prop_tx_id, tag=org_tx.get('tag'), linked=False,
+                            prop_journal_id=prop_journal_id)
+
+    def _resumable_prop_tx(self, triggered_tx_id: int, org_tx: Dict) -> Optional[str]:
+        """A proportional transaction an earlier attempt created for the split but never linked, if any"""
+        prop_tx_id = self.link_index.unlinked_for(triggered_tx_id, org_tx['tx_jrnl_id'], tag=org_tx.get('tag'))
+        if prop_tx_id is not None:
+            logger.info(f'Resuming: proportional transaction {prop_tx_id} already exists, linking it')
+        return prop_tx_id
+
+    def _link_update(self, transaction_data: TransactionEvent, split: Dict, new_tx_id: str) -> Tuple[str, List[Dict]]:
+        """The split's notes with the link to its new proportional transaction, and the update of the
+            original's splits adding them"""
+        modified_splits = [{'transaction_journal_id': x.transaction_journal_id}
+                           for x in transaction_data.transactions]
+        org_notes = self.add_to_notes(transaction_data=transaction_data, split_index=split['org_tx']['index'],
                                       new_transaction_id=new_tx_id)
 
         # Go through modified splits, find the tx with the matching journal id:
@@ -287,46 +718,207 @@ class FireFlyRelayCore:
             if ms['transaction_journal_id'] == split['org_tx']['tx_jrnl_id']:
                 modified_splits[i]['notes'] = org_notes
 
-        logger.debug(f'Modified note of original transaction to: "{org_notes}"')
+        logger.debug('Modified note of original transaction to: "{}"', org_notes)
+        return org_notes, modified_splits
+
+    def _linked(self, transaction_data: TransactionEvent, notes: Dict[int, str], prop_tx_ids: Iterable[str]):
+        """Marks the original's update as done"""
+        for prop_tx_id in prop_tx_ids:
+            self.link_index.mark_linked(prop_tx_id)
+            TRANSACTIONS.inc(outcome='created')
+        # Keep the links for the next split of this same event (e.g., a split with two tags)
+        for i, org_notes in notes.items():
+            transaction_data.transactions[i].notes = org_notes
+
+    @TRACER.wrap('process_new_transaction')
+    def process_new_transaction(self, triggered_tx_id: int, split: Dict,
+                                transaction_data: Union[Dict, TransactionEvent]):
+        """Creates a new proportional transaction, then updated the original, new transaction
+            (that triggered this process) with that proportional transaction's details"""
+        logger.info('Creating new transaction...')
+        transaction_data = as_event(transaction_data)
+
+        org_tx = split['org_tx']
+        new_tx_id = self._resumable_prop_tx(triggered_tx_id, org_tx)
+        if new_tx_id is None:
+            new_tx_resp = self.new_single_transaction(**split.get('new_tx'))
+            new_tx_data = new_tx_resp.json()['data']
+            new_tx_id = new_tx_data['id']
+            self.new_txs.add(new_tx_id)
+            prop_jrnl_ids = self._split_journal_ids(new_tx_data)
+            self._record_new_prop_tx(triggered_tx_id, org_tx, prop_tx_id=new_tx_id,
+                                     prop_journal_id=prop_jrnl_ids[0] if prop_jrnl_ids else None)
 
-        logger.info(f'Updating transaction id {triggered_tx_id} such: \n\t{modified_splits}')
+        logger.info('Updating original transaction')
+        org_notes, modified_splits = self._link_update(transaction_data, split=split, new_tx_id=new_tx_id)
+        logger.info(f'Updating transaction id {triggered_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
         self.update_transaction(
             tx_id=triggered_tx_id,
             transactions=modified_splits
         )
+        self._linked(transaction_data, notes={org_tx['index']: org_notes}, prop_tx_ids=[new_tx_id])
+
+    def _batch_groups(self, triggered_tx_id: int, splits: List[Dict]) -> Tuple[List[Tuple], List[List[Dict]]]:
+        """Splits the new splits into the ones to resume (with their proportional transaction id)
+            and groups of the ones to create, each group fit for a single transaction"""
+        new_links = []
+        to_create: Dict[Tuple, List[Dict]] = {}
+        for split in splits:
+            if (prop_tx_id := self._resumable_prop_tx(triggered_tx_id, split['org_tx'])) is not None:
+                new_links.append((split, prop_tx_id))
+                continue
+            # A group's splits have to share their type, and the source (withdrawal) or destination (deposit)
+            new_tx = split['new_tx']
+            shared_acct = new_tx['source_acct_id'] if new_tx['tx_type'] == 'withdrawal' else new_tx['dest_acct_id']
+            to_create.setdefault((new_tx['tx_type'], shared_acct), []).append(split)
+        return new_links, list(to_create.values())
+
+    @staticmethod
+    def _group_request(group: List[Dict]) -> Dict:
+        """The arguments of `new_split_transaction` for a group"""
+        return {
+            'title': group[0]['new_tx']['title'],
+            'splits': [{k: v for k, v in x['new_tx'].items() if k != 'title'} for x in group],
+        }
 
-    def process_updated_transaction(self, triggered_tx_id: int, split: Dict,):
-        """Takes in an updated transaction's info and syncs it with
-        the proportional transaction it links to via notes"""
-        logger.info('Updating proportional transaction...')
-        prop_tx_id = split['org_tx']['prop_tx_id']
-        # Get proportional transaction data
-        prop_tx_data = self.get_transaction(prop_tx_id)
-        prop_txs = prop_tx_data['attributes']
-
-        # Collect transaction journal ids
+    def _record_new_group(self, triggered_tx_id: int, group: List[Dict], new_tx_data: Dict,
+                          new_links: List[Tuple]):
+        self.new_txs.add(new_tx_data['id'])
+        prop_jrnl_ids = self._split_journal_ids(new_tx_data)
+        for i, split in enumerate(group):
+            self._record_new_prop_tx(triggered_tx_id, split['org_tx'], prop_tx_id=new_tx_data['id'],
+                                     prop_journal_id=prop_jrnl_ids[i] if i < len(prop_jrnl_ids) else None)
+            new_links.append((split, new_tx_data['id']))
+
+    def _batch_link_update(self, transaction_data: TransactionEvent,
+                           new_links: List[Tuple]) -> Tuple[Dict[int, str], List[Dict]]:
+        """The notes of each linked split, and the update of the original's splits adding them"""
+        notes = {}
+        for split, prop_tx_id in new_links:
+            split_tx_index = split['org_tx']['index']
+            tx_note = f'Proportion tx: {self.base_url}/transactions/show/{prop_tx_id}'
+            org_notes = notes.get(split_tx_index, transaction_data.transactions[split_tx_index].notes)
+            if org_notes is None:
+                notes[split_tx_index] = tx_note
+            elif tx_note not in org_notes:
+                notes[split_tx_index] = f'{org_notes}\n{tx_note}'
         modified_splits = []
-        for ptx in prop_txs['transactions']:
-            t_split_data = {'transaction_journal_id': str(ptx['transaction_journal_id'])}
-            ptx_notes = ptx.get('notes') if ptx.get('notes') is not None else ''
-            if re.search(fr'\w+\stx:\shttp://.*/show/{triggered_tx_id}', ptx_notes):
-                # Notes had the link to our original transaction - this should be it.
-                new_amount = split['new_tx']['amount']
-                if ptx['amount'] == new_amount:
-                    logger.info('Split matching notes did not have a changed proportional amount. Aborting.')
-                    return
-                else:
-                    logger.info('Changing the amount for split matching notes...')
-                    t_split_data['amount'] = new_amount
-            else:
-                logger.debug(f'No notes found matching the link to '
-                             f'the original transaction id {triggered_tx_id}')
-            modified_splits.append(t_split_data)
-
-        self.updated_txs.add(prop_tx_id)
-
-        logger.info(f'Updating transaction id {prop_tx_id} such: \n\t{modified_splits}')
+        for i, tx in enumerate(transaction_data.transactions):
+            modified_splits.append({'transaction_journal_id': tx.transaction_journal_id})
+            if i in notes:
+                modified_splits[-1]['notes'] = notes[i]
+        return notes, modified_splits
+
+    @TRACER.wrap('process_new_transactions_batched')
+    def process_new_transactions_batched(self, triggered_tx_id: int, splits: List[Dict],
+                                         transaction_data: Union[Dict, TransactionEvent]):
+        """Creates the proportional transactions for several splits as one grouped transaction
+            (one per set of splits Firefly allows in a group), then links them all in the original
+            with a single update"""
+        transaction_data = as_event(transaction_data)
+        logger.info(f'Creating proportional transactions for {len(splits)} splits in one go...')
+
+        new_links, to_create = self._batch_groups(triggered_tx_id, splits)
+        for group in to_create:
+            new_tx_data = self.new_split_transaction(**self._group_request(group)).json()['data']
+            self._record_new_group(triggered_tx_id, group, new_tx_data=new_tx_data, new_links=new_links)
+
+        # Every new link goes into the original's notes in a single update
+        notes, modified_splits = self._batch_link_update(transaction_data, new_links)
+        logger.info(f'Updating transaction id {triggered_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
         self.update_transaction(
-            tx_id=prop_tx_id,
+            tx_id=triggered_tx_id,
             transactions=modified_splits
         )
+        self._linked(transaction_data, notes=notes, prop_tx_ids={x[1] for x in new_links})
+
+    @staticmethod
+    def _prop_tx_update(record: PropTxRecord, triggered_tx_id: int,
+                        splits: List[Dict]) -> Tuple[Optional[List[Dict]], Dict[str, str]]:
+        """The update of the proportional transaction's splits for the new amounts, and the new amount of
+            each split that changes. No update if no amount has changed"""
+        # Known if we created the proportional transaction - it might be one of several splits made from the original
+        matches = record.match_splits(triggered_tx_id, [x['org_tx'].get('prop_jrnl_id') for x in splits])
+        changed: Dict[str, str] = {}
+        for split, ptx in zip(splits, matches):
+            new_amount = split['new_tx']['amount']
+            if ptx is None:
+                logger.warning(f'Could not tell which split of proportional transaction {record.prop_tx_id} was '
+                               f'made for tx id {triggered_tx_id} ({split["org_tx"]["tag"]}) - leaving it')
+            elif same_amount(ptx.amount, new_amount):
+                logger.info(f'Split {ptx.journal_id} did not have a changed proportional amount.')
+            else:
+                logger.info(f'Changing the amount for split {ptx.journal_id}...')
+                changed[ptx.journal_id] = new_amount
+        if not changed:
+            return None, changed
+        modified_splits = []
+        for ptx in record.splits:
+            t_split_data = {'transaction_journal_id': ptx.journal_id}
+            if ptx.journal_id in changed:
+                t_split_data['amount'] = changed[ptx.journal_id]
+            modified_splits.append(t_split_data)
+        return modified_splits, changed
+
+    def _is_stale_cache_error(self, e: Exception, prop_tx_id: str, from_cache: bool) -> bool:
+        """Whether a failed update was down to our cached copy being out of date - if so, it's dropped"""
+        if not from_cache or getattr(e, 'response', None) is None or e.response.status_code not in (404, 422):
+            return False
+        # Our copy was stale (e.g., the transaction was edited or deleted by hand) - check with Firefly
+        logger.warning(f'Cached copy of proportional transaction {prop_tx_id} was stale - refetching')
+        self.prop_cache.invalidate(prop_tx_id)
+        return True
+
+    def _prop_tx_updated(self, prop_tx_id: str, changed: Dict[str, str]):
+        TRANSACTIONS.inc(outcome='updated')
+        for journal_id, amount in changed.items():
+            self.prop_cache.set_amount(prop_tx_id, journal_id=journal_id, amount=amount)
+
+    def _check_unchanged(self, from_cache: bool) -> bool:
+        """Whether amounts our cached copy holds as unchanged need checking with Firefly -
+            another worker may have written them since, unless we're the only one writing"""
+        return from_cache and not self.prop_cache.sole_writer
+
+    @staticmethod
+    def _updates_by_prop_tx(new_splits: List[Dict]) -> Dict[str, List[Dict]]:
+        """The update splits, grouped by the proportional transaction they're in"""
+        by_prop_tx: Dict[str, List[Dict]] = {}
+        for split in new_splits:
+            if split.get('is_update'):
+                by_prop_tx.setdefault(str(split['org_tx']['prop_tx_id']), []).append(split)
+        return by_prop_tx
+
+    @TRACER.wrap('process_updated_transaction')
+    def process_updated_transaction(self, triggered_tx_id: int, splits: List[Dict]):
+        """Takes in an updated transaction's info and syncs it with the proportional transaction
+        its splits link to via notes - one update for all of them"""
+        logger.info('Updating proportional transaction...')
+        prop_tx_id = splits[0]['org_tx']['prop_tx_id']
+        # Use what we already know of the proportional transaction; only ask Firefly if we don't
+        record = self.prop_cache.get(prop_tx_id)
+        from_cache = record is not None
+        if record is None:
+            record = PropTxRecord.from_api(self.get_transaction(prop_tx_id))
+
+        modified_splits, changed = self._prop_tx_update(record, triggered_tx_id=triggered_tx_id, splits=splits)
+        if modified_splits is None and self._check_unchanged(from_cache):
+            record, from_cache = PropTxRecord.from_api(self.get_transaction(prop_tx_id)), False
+            modified_splits, changed = self._prop_tx_update(record, triggered_tx_id=triggered_tx_id, splits=splits)
+        if modified_splits is None:
+            TRANSACTIONS.inc(outcome='unchanged')
+            return
+
+        logger.info(f'Updating transaction id {prop_tx_id} ({len(modified_splits)} split(s))')
+        logger.opt(lazy=True).debug('Modified splits: {}', lambda: modified_splits)
+        try:
+            self.update_transaction(
+                tx_id=prop_tx_id,
+                transactions=modified_splits
+            )
+        except HTTPError as e:
+            if not self._is_stale_cache_error(e, prop_tx_id=prop_tx_id, from_cache=from_cache):
+                raise e
+            return self.process_updated_transaction(triggered_tx_id=triggered_tx_id, splits=splits)
+        self._prop_tx_updated(prop_tx_id, changed=changed)
@@ -0,0 +1,195 @@
+import json
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from loguru import logger
+
+from ffrelay.core.payload import (
+    TransactionEvent,
+    as_event,
+)
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def make_job_key(data: Union[Dict, TransactionEvent], is_new: bool) -> str:
+    """Builds the key a webhook job is journaled under.
+        A retried delivery of the same webhook maps to the same key, a later edit of the transaction does not."""
+    event = as_event(data)
+    return f'{"add" if is_new else "update"}:{event.id}:{event.updated_at}'
+
+
+def _process_started(pid: int) -> Optional[int]:
+    """When the process started (clock ticks since boot, from /proc) - None where that can't be read"""
+    try:
+        stat = pathlib.Path(f'/proc/{pid}/stat').read_text()
+    except OSError:
+        return None
+    # The command name (2nd field) may hold spaces - the start time is the 20th field after it
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if pid is None:
+        return False
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_alive(pid: Optional[int], started: Optional[int]) -> bool:
+    """Whether the worker that owns a job is still running - not just some later process given its pid"""
+    if not _pid_alive(pid):
+        return False
+    if started is None:
+        return True
+    current = _process_started(pid)
+    return current is None or current == started
+
+
+class JobJournal:
+    """Append-only SQLite (WAL) journal of accepted webhook jobs and their completion state.
+
+        Every gunicorn worker opens the same file: a job key can only be accepted once across
+        all of them, and on startup a worker replays the pending jobs left behind by workers that died.
+        Commits don't fsync (synchronous=NORMAL); the WAL is checkpointed - and synced - every
+        `checkpoint_every` writes, so fsyncs are batched rather than paid per webhook.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], checkpoint_every: int = 50,
+                 retention_secs: float = 7 * 86400, compact_every: int = 1000):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.checkpoint_every = checkpoint_every
+        self.retention_secs = retention_secs
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._writes_since_checkpoint = 0
+        self._completions_since_compact = 0
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_key TEXT PRIMARY KEY,
+                is_new INTEGER NOT NULL,
+                payload TEXT,
+                status TEXT NOT NULL,
+                owner_pid INTEGER,
+                owner_started INTEGER,
+                accepted_at REAL NOT NULL,
+                finished_at REAL
+            )
+        ''')
+        if 'owner_started' not in {x[1] for x in self.conn.execute('PRAGMA table_info(jobs)')}:
+            # Journal from before the owner's start time was kept
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN owner_started INTEGER')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, finished_at)')
+        # Told apart from a later process given the same pid (e.g. in a restarted container)
+        self.owner = (os.getpid(), _process_started(os.getpid()))
+
+    def _write(self, sql: str, params: Tuple) -> int:
+        with self._lock:
+            cur = self.conn.execute(sql, params)
+            self._writes_since_checkpoint += 1
+            if self._writes_since_checkpoint >= self.checkpoint_every:
+                self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+                self._writes_since_checkpoint = 0
+            return cur.rowcount
+
+    def record(self, job_key: str, data: Union[Dict, TransactionEvent], is_new: bool) -> bool:
+        """Journals an accepted job. Returns False if the job key was already journaled (i.e., a duplicate)
+            - unless that job failed, in which case the redelivery is taken on again"""
+        if isinstance(data, TransactionEvent):
+            data = data.to_webhook()
+        payload = json.dumps(data, separators=(',', ':'))
+        n_rows = self._write(
+            'INSERT INTO jobs (job_key, is_new, payload, status, owner_pid, owner_started, accepted_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (job_key) DO UPDATE SET payload = excluded.payload, status = excluded.status, '
+            'owner_pid = excluded.owner_pid, owner_started = excluded.owner_started, '
+            'accepted_at = excluded.accepted_at, finished_at = NULL WHERE jobs.status = ?',
+            (job_key, int(is_new), payload, PENDING, *self.owner, time.time(), FAILED)
+        )
+        return n_rows == 1
+
+    def discard(self, job_key: str):
+        """Removes a pending job that was never handed off (e.g., the queue refused it)"""
+        self._write('DELETE FROM jobs WHERE job_key = ? AND status = ?', (job_key, PENDING))
+
+    def complete(self, job_key: str, ok: bool = True):
+        # The payload isn't needed once the job's done - only the key, for duplicate detection.
+        #   A failed job keeps it, to look into or take on again
+        self._write(
+            'UPDATE jobs SET status = ?, finished_at = ?, payload = CASE WHEN ? THEN NULL ELSE payload END '
+            'WHERE job_key = ?',
+            (DONE if ok else FAILED, time.time(), ok, job_key)
+        )
+        self._completions_since_compact += 1
+        if self._completions_since_compact >= self.compact_every:
+            self.compact()
+
+    def claim_pending(self) -> List[Tuple[str, Dict, bool]]:
+        """Claims pending jobs whose owning worker is no longer alive, for replay in this worker"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT job_key, is_new, payload, owner_pid, owner_started FROM jobs WHERE status = ? '
+                'ORDER BY accepted_at',
+                (PENDING, )
+            ).fetchall()
+        claimed = []
+        for job_key, is_new, payload, owner_pid, owner_started in rows:
+            if _owner_alive(owner_pid, owner_started):
+                continue
+            n_rows = self._write(
+                'UPDATE jobs SET owner_pid = ?, owner_started = ? '
+                'WHERE job_key = ? AND status = ? AND owner_pid IS ? AND owner_started IS ?',
+                (*self.owner, job_key, PENDING, owner_pid, owner_started)
+            )
+            if n_rows == 1:
+                claimed.append((job_key, json.loads(payload), bool(is_new)))
+        if claimed:
+            logger.info(f'Claimed {len(claimed)} pending job(s) from the journal for replay')
+        return claimed
+
+    def compact(self) -> int:
+        """Drops finished jobs past the retention window and truncates the WAL"""
+        cutoff = time.time() - self.retention_secs
+        with self._lock:
+            n_rows = self.conn.execute(
+                'DELETE FROM jobs WHERE status != ? AND finished_at < ?', (PENDING, cutoff)
+            ).rowcount
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._writes_since_checkpoint = 0
+            self._completions_since_compact = 0
+        if n_rows > 0:
+            logger.debug(f'Compacted {n_rows} finished job(s) from the journal')
+        return n_rows
+
+    def stats(self) -> Dict:
+        with self._lock:
+            rows = self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: n for status, n in rows}
+
+    def close(self):
+        with self._lock:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self.conn.close()
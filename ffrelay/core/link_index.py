@@ -0,0 +1,209 @@
+import datetime
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from ffrelay.core.ff_core import FireFlyRelayCore
+
+# The notes line an original transaction's split gets for each proportional transaction made from it
+PROP_LINK_PATTERN = re.compile(r'Proportion\stx:\shttps?:\/\/\S*\/show\/(\d+)')
+
+TxId = Union[int, str]
+
+
+class LinkEntry(NamedTuple):
+    orig_tx_id: str
+    journal_id: str
+    split_index: int
+    prop_tx_id: str
+    tag: Optional[str]
+    # Whether the link has been written to the original transaction's notes yet
+    linked: bool
+    # The split of the proportional transaction made for this original split, when known
+    prop_journal_id: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, str, str, str]:
+        return self.orig_tx_id, self.journal_id, self.prop_tx_id, self.tag or ''
+
+
+_COLUMNS = 'orig_tx_id, journal_id, split_index, prop_tx_id, tag, linked, prop_journal_id'
+
+
+def _row_to_entry(row: Tuple) -> LinkEntry:
+    orig_tx_id, journal_id, split_index, prop_tx_id, tag, linked, prop_journal_id = row
+    return LinkEntry(orig_tx_id, journal_id, split_index, prop_tx_id, tag or None, bool(linked), prop_journal_id)
+
+
+class LinkIndex:
+    """Bidirectional index between original transaction splits and their proportional transactions.
+
+        (original tx id, journal id) -> proportional tx ids, and proportional tx id -> the original splits
+        it was made from (more than one if it was created as a grouped transaction).
+        Lookups are dict hits; every change is written through to SQLite (WAL) so the index survives
+        restarts and is seen by the other workers. Without a path it lives in memory only - set one with
+        `batch-splits`, as the per-split journal ids of grouped proportional transactions are only kept here.
+        The notes links stay the human-readable copy - `rebuild` recreates the index from them.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path] = None):
+        self.path = pathlib.Path(path) if path is not None else None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._by_orig: Dict[Tuple[str, str], List[LinkEntry]] = {}
+        self._by_prop: Dict[str, List[LinkEntry]] = {}
+        self.conn = sqlite3.connect(str(self.path) if self.path else ':memory:', check_same_thread=False,
+                                    isolation_level=None, timeout=10)
+        if self.path is not None:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tx_links (
+                orig_tx_id TEXT NOT NULL,
+                journal_id TEXT NOT NULL,
+                prop_tx_id TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                split_index INTEGER NOT NULL,
+                prop_journal_id TEXT,
+                linked INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (orig_tx_id, journal_id, prop_tx_id, tag)
+            ) WITHOUT ROWID
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS tx_links_prop ON tx_links (prop_tx_id)')
+        self._load()
+
+    def _load(self):
+        rows = self.conn.execute(f'SELECT {_COLUMNS} FROM tx_links').fetchall()
+        for row in rows:
+            self._remember(_row_to_entry(row))
+        if rows:
+            logger.debug(f'Loaded {len(rows)} transaction link(s)')
+
+    def _remember(self, entry: LinkEntry):
+        """Puts an entry in the in-memory maps. Expects the lock to be held (or to be loading)"""
+        self._forget(entry)
+        self._by_prop.setdefault(entry.prop_tx_id, []).append(entry)
+        self._by_orig.setdefault((entry.orig_tx_id, entry.journal_id), []).append(entry)
+
+    def _forget(self, entry: LinkEntry):
+        for entries in (self._by_prop.get(entry.prop_tx_id, []),
+                        self._by_orig.get((entry.orig_tx_id, entry.journal_id), [])):
+            entries[:] = [x for x in entries if x.key != entry.key]
+
+    def _fetch_orig(self, key: Tuple[str, str]) -> List[LinkEntry]:
+        """Replaces what we hold for a split with what's stored - picking up links another worker
+            wrote (or removed) since we loaded"""
+        rows = self.conn.execute(
+            f'SELECT {_COLUMNS} FROM tx_links WHERE orig_tx_id = ? AND journal_id = ?', key
+        ).fetchall()
+        for entry in list(self._by_orig.get(key, [])):
+            self._forget(entry)
+        for row in rows:
+            self._remember(_row_to_entry(row))
+        return self._by_orig.get(key, [])
+
+    def add(self, orig_tx_id: TxId, journal_id: TxId, split_index: int, prop_tx_id: TxId, tag: str = None,
+            linked: bool = True, prop_journal_id: TxId = None) -> LinkEntry:
+        entry = LinkEntry(str(orig_tx_id), str(journal_id), split_index, str(prop_tx_id), tag, linked,
+                          str(prop_journal_id) if prop_journal_id is not None else None)
+        with self._lock:
+            if prop_journal_id is None:
+                # Don't lose a journal id we already know about (e.g., when rebuilding from notes)
+                for known in self._by_prop.get(entry.prop_tx_id, []):
+                    if known.key == entry.key:
+                        entry = entry._replace(prop_journal_id=known.prop_journal_id)
+            self.conn.execute(
+                'INSERT OR REPLACE INTO tx_links '
+                '(orig_tx_id, journal_id, prop_tx_id, tag, split_index, prop_journal_id, linked, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (*entry.key, split_index, entry.prop_journal_id, int(linked), time.time())
+            )
+            self._remember(entry)
+        return entry
+
+    def mark_linked(self, prop_tx_id: TxId):
+        with self._lock:
+            entries = list(self._by_prop.get(str(prop_tx_id), []))
+            if not entries:
+                return
+            self.conn.execute('UPDATE tx_links SET linked = 1, updated_at = ? WHERE prop_tx_id = ?',
+                              (time.time(), str(prop_tx_id)))
+            for entry in entries:
+                self._remember(entry._replace(linked=True))
+
+    def remove(self, prop_tx_id: TxId):
+        with self._lock:
+            for entry in self._by_prop.pop(str(prop_tx_id), []):
+                self._forget(entry)
+            self.conn.execute('DELETE FROM tx_links WHERE prop_tx_id = ?', (str(prop_tx_id), ))
+
+    def links_for(self, orig_tx_id: TxId, journal_id: TxId) -> List[LinkEntry]:
+        """The proportional transactions made from a split of an original transaction.
+            With a path, read from SQLite every time - other workers write to it too"""
+        key = (str(orig_tx_id), str(journal_id))
+        with self._lock:
+            if self.path is None:
+                return list(self._by_orig.get(key, []))
+            return list(self._fetch_orig(key))
+
+    def unlinked_for(self, orig_tx_id: TxId, journal_id: TxId, tag: Optional[str]) -> Optional[str]:
+        """A proportional transaction that was created for this split & tag, but never linked in its notes"""
+        for entry in self.links_for(orig_tx_id, journal_id):
+            if not entry.linked and entry.tag == tag:
+                return entry.prop_tx_id
+        return None
+
+    def links_to(self, prop_tx_id: TxId) -> List[LinkEntry]:
+        """The original splits a proportional transaction was made from"""
+        with self._lock:
+            return list(self._by_prop.get(str(prop_tx_id), []))
+
+    def orig_for(self, prop_tx_id: TxId) -> Optional[LinkEntry]:
+        entries = self.links_to(prop_tx_id)
+        return entries[0] if entries else None
+
+    def rebuild(self, ffr_core: 'FireFlyRelayCore', start: datetime.date = None, end: datetime.date = None,
+                page_size: int = 100) -> int:
+        """Recreates the index from the notes links of the transactions in the date range"""
+        n_links = 0
+        for page, total_pages, tx_groups in ffr_core.iter_transaction_pages(start=start, end=end, limit=page_size):
+            for tx_group in tx_groups:
+                for i, split in enumerate(tx_group['attributes']['transactions']):
+                    journal_id = split['transaction_journal_id']
+                    known = {x.prop_tx_id: x for x in self.links_for(tx_group['id'], journal_id)}
+                    for prop_tx_id in PROP_LINK_PATTERN.findall(split.get('notes') or ''):
+                        # The notes don't say which tag a link is for - keep the one we know of, if any
+                        tag = known[prop_tx_id].tag if prop_tx_id in known else None
+                        self.add(orig_tx_id=tx_group['id'], journal_id=journal_id, split_index=i,
+                                 prop_tx_id=prop_tx_id, tag=tag)
+                        n_links += 1
+            logger.info(f'Link index rebuild: page {page}/{total_pages}, {n_links} link(s) so far')
+        return n_links
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self._by_prop.values())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries = [x for prop_entries in self._by_prop.values() for x in prop_entries]
+            return {
+                'links': len(entries),
+                'unlinked': sum(1 for x in entries if not x.linked),
+                'persistent': self.path is not None,
+            }
@@ -0,0 +1,124 @@
+import json
+import pathlib
+import queue
+import threading
+import traceback
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+
+from ffrelay.core.tracing import current_request_id
+
+# Placed on the queue to tell the writer thread to exit
+_STOP = object()
+
+
+class QueuedJsonSink:
+    """A loguru sink that only queues the record on the logging thread; a background thread writes
+        the records out as JSON lines, `batch_size` at a time (or every `flush_secs`).
+
+        A full queue drops the record (and counts it) rather than hold up a request.
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path], batch_size: int = 200, flush_secs: float = 0.5,
+                 max_size: int = 10000, name: str = 'ffr-log'):
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+        self.flush_secs = flush_secs
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_size)
+        self._thread: Optional[threading.Thread] = None
+        # Metrics
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        """Called by loguru with the formatted message; the record it carries is what gets written"""
+        try:
+            self.queue.put_nowait((message.record, current_request_id()))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.flush_secs)
+            except queue.Empty:
+                continue
+            batch = []
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List):
+        lines = ''.join(json.dumps(to_json(record, request_id), default=str) + '\n' for record, request_id in batch)
+        try:
+            with self.path.open('a') as f:
+                f.write(lines)
+        except OSError:
+            # Nowhere left to log this to
+            self.failed += len(batch)
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def shutdown(self, timeout: float = 5.0):
+        """Writes out whatever is still queued"""
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def stats(self) -> Dict:
+        return {
+            'path': str(self.path),
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+def to_json(record: Dict, request_id: Optional[str] = None) -> Dict:
+    """The fields of a loguru record worth keeping"""
+    line = {
+        'time': record['time'].isoformat(),
+        'level': record['level'].name,
+        'message': record['message'],
+        'logger': record['name'],
+        'function': record['function'],
+        'line': record['line'],
+        'thread': record['thread'].name,
+    }
+    if request_id is not None:
+        line['request_id'] = request_id
+    if record['extra']:
+        line['extra'] = record['extra']
+    if (exc := record['exception']) is not None:
+        line['exception'] = ''.join(traceback.format_exception(exc.type, exc.value, exc.traceback))
+    return line
@@ -0,0 +1,307 @@
+from bisect import bisect_left
+import fcntl
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from loguru import logger
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[str, ...]
+# A counter/gauge sample is a number; a histogram sample is [count per bucket..., +Inf count, sum]
+Sample = Union[float, List[float]]
+
+
+class _Metric:
+    """A metric family. Each thread records into its own shard, so recording takes no lock;
+        the shards are only added up when the metric is collected."""
+    kind = ''
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[LabelKey, Sample]]] = []
+        # What's left of the shards of threads that have since exited
+        self._retired: Dict[LabelKey, Sample] = {}
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> Dict[LabelKey, Sample]:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._shards_lock:
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _key(self, labels: Dict) -> LabelKey:
+        return tuple(str(labels.get(x, '')) for x in self.labelnames)
+
+    def collect(self) -> Dict[LabelKey, Sample]:
+        with self._shards_lock:
+            live = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    live.append((thread, values))
+                else:
+                    merge_samples(self._retired, values)
+            self._shards = live
+            merged = {}
+            merge_samples(merged, self._retired)
+            for _, values in live:
+                merge_samples(merged, dict(values))
+            return merged
+
+
+class Counter(_Metric):
+    kind = COUNTER
+
+    def inc(self, amount: float = 1.0, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    """Goes up and down (e.g., calls in flight), or reads its value from a function when collected"""
+    kind = GAUGE
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, doc, labelnames)
+        self._function: Optional[Callable[[], float]] = None
+
+    def inc(self, amount: float = 1.0, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        self._function = function
+
+    def collect(self) -> Dict[LabelKey, Sample]:
+        if self._function is not None:
+            return {(): float(self._function())}
+        return super().collect()
+
+
+class Histogram(_Metric):
+    kind = HISTOGRAM
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = None):
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets or DEFAULT_BUCKETS))
+
+    def observe(self, value: float, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        if (sample := shard.get(key)) is None:
+            sample = shard[key] = [0.0] * (len(self.buckets) + 2)
+        sample[bisect_left(self.buckets, value)] += 1
+        sample[-1] += value
+
+
+def merge_samples(target: Dict[LabelKey, Sample], source: Dict[LabelKey, Sample]):
+    """Adds the samples of one collection to another"""
+    for key, sample in source.items():
+        if isinstance(sample, list):
+            if (existing := target.get(key)) is None:
+                target[key] = list(sample)
+            else:
+                for i, val in enumerate(sample):
+                    existing[i] += val
+        else:
+            target[key] = target.get(key, 0.0) + sample
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsRegistry:
+    """The metrics of this process, rendered in the Prometheus text format.
+
+        With several (gunicorn) workers, each one writes a snapshot of its metrics to `path` every
+        `flush_secs`, and whichever worker serves the scrape adds them all up. Counters & histograms
+        of exited workers are folded into a single file so they keep counting; their gauges are dropped.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self.path: Optional[pathlib.Path] = None
+        self._flush_thread: Optional[threading.Thread] = None
+
+    def _register(self, metric: _Metric) -> _Metric:
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, doc, labelnames))
+
+    def gauge(self, name: str, doc: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, doc, labelnames))
+
+    def histogram(self, name: str, doc: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = None) -> Histogram:
+        return self._register(Histogram(name, doc, labelnames, buckets=buckets))
+
+    def collect(self) -> Dict[str, Dict[LabelKey, Sample]]:
+        return {name: metric.collect() for name, metric in self._metrics.items()}
+
+    # Multiple workers
+    # ------------------------------------------------------------------
+
+    def enable_multiprocess(self, path: Union[str, pathlib.Path], flush_secs: float = 5.0):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.write_snapshot()
+
+        def _flush():
+            while True:
+                time.sleep(flush_secs)
+                try:
+                    self.write_snapshot()
+                except OSError as e:
+                    logger.warning(f'Unable to write metrics snapshot: {e}')
+
+        self._flush_thread = threading.Thread(target=_flush, name='ffr-metrics', daemon=True)
+        self._flush_thread.start()
+
+    def _snapshot_path(self, pid: int) -> pathlib.Path:
+        return self.path.joinpath(f'metrics-{pid}.json')
+
+    def write_snapshot(self):
+        """Writes this worker's metrics where the other workers can read them"""
+        snapshot = {name: [[list(k), v] for k, v in samples.items()] for name, samples in self.collect().items()}
+        target = self._snapshot_path(os.getpid())
+        tmp = target.with_suffix('.tmp')
+        tmp.write_text(json.dumps(snapshot))
+        os.replace(tmp, target)
+
+    @staticmethod
+    def _read(path: pathlib.Path) -> Dict[str, Dict[LabelKey, Sample]]:
+        try:
+            raw = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return {}
+        return {name: {tuple(k): v for k, v in samples} for name, samples in raw.items()}
+
+    def collect_all(self) -> Dict[str, Dict[LabelKey, Sample]]:
+        """This worker's metrics, added to the latest snapshots of all the others"""
+        if self.path is None:
+            return self.collect()
+        self.write_snapshot()
+        merged = {name: {} for name in self._metrics}
+        with self.path.joinpath('.lock').open('w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            exited_path = self.path.joinpath('metrics-exited.json')
+            exited = self._read(exited_path)
+            n_exited = 0
+            for snapshot_path in self.path.glob('metrics-[0-9]*.json'):
+                pid = int(snapshot_path.stem.split('-')[1])
+                snapshot = self._read(snapshot_path)
+                alive = _pid_alive(pid)
+                for name, samples in snapshot.items():
+                    if (metric := self._metrics.get(name)) is None:
+                        continue
+                    if alive:
+                        merge_samples(merged[name], samples)
+                    elif metric.kind != GAUGE:
+                        merge_samples(exited.setdefault(name, {}), samples)
+                if not alive:
+                    n_exited += 1
+                    snapshot_path.unlink(missing_ok=True)
+            if n_exited:
+                exited_path.write_text(json.dumps({
+                    name: [[list(k), v] for k, v in samples.items()] for name, samples in exited.items()
+                }))
+        for name, samples in exited.items():
+            if name in merged:
+                merge_samples(merged[name], samples)
+        return merged
+
+    # Exposition
+    # ------------------------------------------------------------------
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format"""
+        collected = self.collect_all()
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f'# HELP {name} {metric.doc}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, sample in sorted(collected.get(name, {}).items()):
+                labels = list(zip(metric.labelnames, key))
+                if metric.kind != HISTOGRAM:
+                    lines.append(f'{name}{_labels(labels)} {_num(sample)}')
+                    continue
+                cumulative = 0.0
+                for bound, count in zip((*metric.buckets, '+Inf'), sample[:-1]):
+                    cumulative += count
+                    le = bound if isinstance(bound, str) else repr(float(bound))
+                    lines.append(f'{name}_bucket{_labels(labels + [("le", le)])} {_num(cumulative)}')
+                lines.append(f'{name}_sum{_labels(labels)} {_num(sample[-1])}')
+                lines.append(f'{name}_count{_labels(labels)} {_num(cumulative)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(val: str) -> str:
+    return val.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _num(val: float) -> str:
+    return str(int(val)) if float(val).is_integer() else repr(float(val))
+
+
+# The relay's metrics
+# ----------------------------------------------------------------------
+
+METRICS = MetricsRegistry()
+
+HTTP_LATENCY = METRICS.histogram('ffrelay_http_request_duration_seconds', 'Time to answer a request, by route',
+                                 labelnames=('method', 'route', 'status'))
+HTTP_IN_FLIGHT = METRICS.gauge('ffrelay_http_requests_in_flight', 'Requests being answered')
+STAGE_LATENCY = METRICS.histogram('ffrelay_stage_duration_seconds', 'Time spent in each stage of handling a webhook',
+                                  labelnames=('stage', ))
+FIREFLY_LATENCY = METRICS.histogram('ffrelay_firefly_request_duration_seconds', 'Time taken by calls to Firefly',
+                                    labelnames=('method', 'endpoint'))
+FIREFLY_IN_FLIGHT = METRICS.gauge('ffrelay_firefly_requests_in_flight', 'Calls to Firefly awaiting an answer')
+FIREFLY_ERRORS = METRICS.counter('ffrelay_firefly_errors_total', 'Failed calls to Firefly, by status (or exception)',
+                                 labelnames=('method', 'endpoint', 'status'))
+TRANSACTIONS = METRICS.counter('ffrelay_transactions_total',
+                               'Transactions by outcome: prefiltered, deduped, skipped, created, updated, unchanged',
+                               labelnames=('outcome', ))
+TX_LOCK_WAIT = METRICS.histogram('ffrelay_tx_lock_wait_seconds',
+                                 'Time spent waiting for the per-transaction lock before handling a webhook')
+QUEUE_DEPTH = METRICS.gauge('ffrelay_webhook_queue_depth', 'Webhooks waiting on the background queue')
@@ -0,0 +1,111 @@
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+import json
+import re
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# A link to another transaction left in a split's notes - e.g., 'Proportion tx: <url>/transactions/show/123'
+#   in an original transaction, 'From tx: <url>/transactions/show/122' in a proportional one
+TX_LINK_PATTERN = re.compile(r'\w+\stx:\shttps?:\/\/.*\/show\/(\d+)')
+
+
+class PayloadError(ValueError):
+    """Raised when a webhook body can't be read as a Firefly transaction event"""
+
+
+@dataclass(slots=True)
+class SplitRecord:
+    """The fields of a transaction split (journal) the relay actually uses"""
+    transaction_journal_id: str
+    type: Optional[str]
+    amount: Optional[str]
+    description: Optional[str]
+    notes: Optional[str]
+    tags: Tuple[str, ...]
+    date: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, split: Dict) -> 'SplitRecord':
+        tags = split.get('tags')
+        return cls(
+            transaction_journal_id=str(split.get('transaction_journal_id')),
+            type=split.get('type'),
+            amount=split.get('amount'),
+            description=split.get('description'),
+            notes=split.get('notes'),
+            tags=tuple(tags) if tags else (),
+            date=split.get('date'),
+        )
+
+
+@dataclass(slots=True)
+class TransactionEvent:
+    """Compact, typed record of a transaction group - from a webhook or the transactions API"""
+    id: Union[int, str]
+    group_title: Optional[str]
+    updated_at: Optional[str]
+    transactions: List[SplitRecord]
+
+    @classmethod
+    def from_content(cls, content: Dict) -> 'TransactionEvent':
+        """Builds the record from a webhook's 'content' (a transaction group with its id)"""
+        if not isinstance(content, dict) or 'id' not in content:
+            raise PayloadError('Webhook content is missing the transaction id')
+        splits = content.get('transactions')
+        if not isinstance(splits, list):
+            raise PayloadError(f'Webhook content for tx id {content["id"]} has no transactions list')
+        try:
+            transactions = [SplitRecord.from_dict(x) for x in splits]
+        except (AttributeError, TypeError) as e:
+            raise PayloadError(f'Unreadable split in tx id {content["id"]}: {e}') from e
+        return cls(
+            id=content['id'],
+            group_title=content.get('group_title'),
+            updated_at=content.get('updated_at'),
+            transactions=transactions,
+        )
+
+    @classmethod
+    def from_webhook(cls, data: Dict) -> 'TransactionEvent':
+        if not isinstance(data, dict) or 'content' not in data:
+            raise PayloadError('Webhook body has no content')
+        return cls.from_content(data['content'])
+
+    @classmethod
+    def from_group(cls, tx_group: Dict) -> 'TransactionEvent':
+        """Builds the record from a transaction group as returned by the transactions API"""
+        return cls.from_content({'id': tx_group['id'], **tx_group['attributes']})
+
+    def to_webhook(self) -> Dict:
+        """The record in webhook form (only the fields kept), e.g. for journaling"""
+        content = asdict(self)
+        for split in content['transactions']:
+            split['tags'] = list(split['tags'])
+        return {'content': content}
+
+
+def as_event(data: Union[Dict, TransactionEvent]) -> TransactionEvent:
+    """Accepts a parsed record, a webhook body or a webhook's content"""
+    if isinstance(data, TransactionEvent):
+        return data
+    if isinstance(data, dict) and 'content' in data:
+        return TransactionEvent.from_webhook(data)
+    return TransactionEvent.from_content(data)
+
+
+def parse_webhook(raw: Union[bytes, str]) -> TransactionEvent:
+    """Parses a raw webhook body straight into a TransactionEvent.
+        The full decoded body is only held long enough to pull out the fields the relay needs."""
+    try:
+        data = json.loads(raw)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise PayloadError(f'Webhook body is not valid JSON: {e}') from e
+    return TransactionEvent.from_webhook(data)
@@ -0,0 +1,127 @@
+from collections import Counter
+import pathlib
+import random
+import sys
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Optional,
+    Union,
+)
+
+from loguru import logger
+
+from ffrelay.core.utils import clean_request_id
+
+if TYPE_CHECKING:
+    import cProfile
+
+STACK = 'stack'
+CPROFILE = 'cprofile'
+
+
+class SlowRequestProfiler:
+    """Keeps a profile of any request (or background job) that takes longer than `threshold_ms`.
+
+        In `stack` mode a background thread samples the stacks of the threads working on a request every
+        `interval_ms`; a slow request's samples are written as collapsed stacks (`<file>:<func>;... <count>`,
+        ready for flamegraph.pl or speedscope). In `cprofile` mode, `sample_rate` of the requests run under
+        cProfile and the slow ones are dumped as .prof files (cProfile itself slows the request down).
+    """
+
+    def __init__(self, out_dir: Union[str, pathlib.Path], threshold_ms: float = 1000.0, mode: str = STACK,
+                 interval_ms: float = 5.0, sample_rate: float = 0.1):
+        if mode not in (STACK, CPROFILE):
+            raise ValueError(f'Unknown profile mode: {mode} - expected one of {STACK}, {CPROFILE}')
+        self.out_dir = pathlib.Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.threshold_ms = threshold_ms
+        self.mode = mode
+        self.interval_ms = interval_ms
+        self.sample_rate = sample_rate
+        # thread ident -> stack sample counts for the request it's working on
+        self._active: Dict[int, Counter] = {}
+        self._profiles: Dict[int, 'cProfile.Profile'] = {}
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        # Metrics
+        self.profiled = 0
+        self.dumped = 0
+
+    def _ensure_sampler(self):
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample, name='ffr-profiler', daemon=True)
+            self._sampler.start()
+
+    def _sample(self):
+        own_ident = threading.get_ident()
+        while True:
+            time.sleep(self.interval_ms / 1000)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in self._active.items():
+                    if ident == own_ident or (frame := frames.get(ident)) is None:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{pathlib.Path(code.co_filename).name}:{code.co_name}')
+                        frame = frame.f_back
+                    samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """Starts profiling the request the calling thread is about to work on"""
+        ident = threading.get_ident()
+        if self.mode == STACK:
+            with self._lock:
+                self._active[ident] = Counter()
+            self._ensure_sampler()
+        elif random.random() < self.sample_rate:
+            # Only imported in this mode
+            import cProfile
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Newer Pythons allow one active profiler per process - another request has it
+                return
+            self._profiles[ident] = profile
+        else:
+            return
+        self.profiled += 1
+
+    def finish(self, request_id: str, duration_ms: float) -> Optional[pathlib.Path]:
+        """Stops profiling the calling thread's request; keeps the profile if it was slow"""
+        ident = threading.get_ident()
+        with self._lock:
+            samples = self._active.pop(ident, None)
+        profile = self._profiles.pop(ident, None)
+        if profile is not None:
+            profile.disable()
+        if duration_ms < self.threshold_ms or (samples is None and profile is None):
+            return None
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        # Goes into the file name
+        request_id = clean_request_id(request_id) or 'request'
+        if profile is not None:
+            path = self.out_dir.joinpath(f'{stamp}-{request_id}.prof')
+            profile.dump_stats(str(path))
+        else:
+            path = self.out_dir.joinpath(f'{stamp}-{request_id}.folded')
+            path.write_text(''.join(f'{stack} {n}\n' for stack, n in samples.most_common()))
+        self.dumped += 1
+        logger.warning(f'Slow request {request_id} ({duration_ms:.0f}ms) - profile written to {path}')
+        return path
+
+    def stats(self) -> Dict:
+        return {
+            'mode': self.mode,
+            'threshold_ms': self.threshold_ms,
+            'profiled': self.profiled,
+            'dumped': self.dumped,
+        }
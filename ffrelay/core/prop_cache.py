@@ -0,0 +1,149 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+import re
+import threading
+import time
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+# The note a proportional transaction carries, linking back to its original transaction
+BACK_LINK_PATTERN = re.compile(r'From\stx:\shttps?:\/\/.*\/show\/(\d+)')
+
+
+@dataclass(slots=True)
+class PropSplit:
+    journal_id: str
+    amount: Optional[str]
+    # The original transaction this split's notes link back to, if any
+    orig_tx_id: Optional[str]
+
+
+@dataclass(slots=True)
+class PropTxRecord:
+    prop_tx_id: str
+    splits: Tuple[PropSplit, ...]
+    cached_at: float
+
+    @classmethod
+    def from_api(cls, tx_group: Dict) -> 'PropTxRecord':
+        """Builds the record from a transaction group as returned by the API"""
+        splits = []
+        # In the order they were sent, which is the order of the original splits they were made from
+        for ptx in sorted(tx_group['attributes']['transactions'], key=lambda x: x.get('order') or 0):
+            link = BACK_LINK_PATTERN.search(ptx.get('notes') or '')
+            splits.append(PropSplit(
+                journal_id=str(ptx['transaction_journal_id']),
+                amount=ptx.get('amount'),
+                orig_tx_id=link.group(1) if link else None,
+            ))
+        return cls(prop_tx_id=str(tx_group['id']), splits=tuple(splits), cached_at=time.monotonic())
+
+    def split_for(self, orig_tx_id: Union[int, str]) -> Optional[PropSplit]:
+        """The split that links back to the given original transaction"""
+        for split in self.splits:
+            if split.orig_tx_id == str(orig_tx_id):
+                return split
+        return None
+
+    def match_splits(self, orig_tx_id: Union[int, str],
+                     prop_journal_ids: List[Optional[str]]) -> List[Optional[PropSplit]]:
+        """The split made for each of an original's splits, given the journal ids we know of (None where
+            we don't). The others are told apart by their order among the splits linking back to the original -
+            left unmatched (None) if the counts don't add up, rather than guessed"""
+        by_journal_id = {x.journal_id: x for x in self.splits}
+        matches = [by_journal_id.get(str(x)) if x else None for x in prop_journal_ids]
+        unknown = [i for i, x in enumerate(prop_journal_ids) if not x]
+        claimed = {x.journal_id for x in matches if x is not None}
+        candidates = [x for x in self.splits if x.orig_tx_id == str(orig_tx_id) and x.journal_id not in claimed]
+        if unknown and len(unknown) == len(candidates):
+            for i, split in zip(unknown, candidates):
+                matches[i] = split
+        return matches
+
+
+class PropTxCache:
+    """Write-through LRU cache of the proportional transactions this relay created.
+
+        Filled from Firefly's own responses to the calls we make (create, update, get), so an update
+        webhook doesn't need to read the proportional transaction first. Each process has its own cache, so
+        another gunicorn worker may have changed an amount since it was cached: a changed amount is written
+        on the cache's word, but one that looks unchanged is checked with Firefly unless this process is the
+        `sole_writer`.
+        Entries go stale after `ttl_secs`, in case someone edits a proportional transaction by hand.
+    """
+
+    def __init__(self, max_size: int = 2000, ttl_secs: float = 3600.0, sole_writer: bool = False):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self.sole_writer = sole_writer
+        self._records: OrderedDict[str, PropTxRecord] = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def get(self, prop_tx_id: Union[int, str]) -> Optional[PropTxRecord]:
+        key = str(prop_tx_id)
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None and time.monotonic() - record.cached_at > self.ttl_secs:
+                del self._records[key]
+                record = None
+            if record is None:
+                self.misses += 1
+                return None
+            self._records.move_to_end(key)
+            self.hits += 1
+            return record
+
+    def put(self, record: PropTxRecord):
+        with self._lock:
+            self._records[record.prop_tx_id] = record
+            self._records.move_to_end(record.prop_tx_id)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+                self.evicted += 1
+
+    def observe(self, tx_group: Optional[Dict]) -> Optional[PropTxRecord]:
+        """Caches a transaction group from an API response if it's a proportional transaction
+            (i.e., one of its splits links back to an original transaction)"""
+        try:
+            record = PropTxRecord.from_api(tx_group)
+        except (KeyError, TypeError):
+            return None
+        if not any(x.orig_tx_id is not None for x in record.splits):
+            return None
+        self.put(record)
+        return record
+
+    def set_amount(self, prop_tx_id: Union[int, str], journal_id: str, amount: str):
+        """Writes a changed amount through to a cached record"""
+        with self._lock:
+            if (record := self._records.get(str(prop_tx_id))) is None:
+                return
+            for split in record.splits:
+                if split.journal_id == journal_id:
+                    split.amount = amount
+
+    def invalidate(self, prop_tx_id: Union[int, str]):
+        with self._lock:
+            self._records.pop(str(prop_tx_id), None)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def stats(self) -> Dict:
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'sole_writer': self.sole_writer,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+        }
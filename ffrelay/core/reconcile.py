@@ -0,0 +1,284 @@
+from concurrent.futures import (
+    Executor,
+    ThreadPoolExecutor,
+)
+from contextlib import ExitStack
+import datetime
+import json
+import pathlib
+import threading
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+
+from loguru import logger
+from requests.exceptions import HTTPError
+
+from ffrelay.core.amounts import same_amount
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.prop_cache import (
+    PropSplit,
+    PropTxRecord,
+)
+from ffrelay.core.throttle import TokenBucket
+from ffrelay.core.utils import parse_timestamp
+
+
+class Reconciler:
+    """Finds and fixes drift between original transactions and their proportional transactions -
+        e.g. after an update webhook was missed, or skipped as a duplicate.
+
+        Pages through Firefly's transaction list and works out what each linked proportional transaction
+        should hold (the same way as for a webhook). The proportional transactions are fetched on a worker
+        pool under a rate limit and compared in memory; each drifted one gets a single update fixing all its
+        drifted splits - made holding the originals' transaction locks, after reading both sides again so a webhook
+        handled meanwhile isn't undone. Everything found is written to a JSON report.
+        Runs are incremental: only groups updated since the last clean run are compared, unless `full`.
+    """
+
+    def __init__(self, ffr_core: FireFlyRelayCore, state_path: Union[str, pathlib.Path],
+                 report_path: Union[str, pathlib.Path] = None, workers: int = 4, rate: float = 5.0,
+                 page_size: int = 100, dry_run: bool = False, full: bool = False):
+        self.ffr_core = ffr_core
+        self.state_path = pathlib.Path(state_path)
+        self.report_path = pathlib.Path(report_path) if report_path else None
+        self.workers = workers
+        self.limiter = TokenBucket(rate=rate, burst=max(1, workers))
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.full = full
+        self.stats = {
+            'pages': 0,
+            'transactions': 0,
+            'changed': 0,
+            'checked': 0,
+            'in_sync': 0,
+            'drifted': 0,
+            'fixed': 0,
+            'unlinked': 0,
+            'dangling': 0,
+            'errors': 0,
+        }
+        # Everything that wasn't in sync, for the report
+        self.findings: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _find(self, status: str, **kwargs):
+        with self._lock:
+            self.stats[status] += 1
+            self.findings.append({'status': status, **kwargs})
+
+    @staticmethod
+    def _run_key(start: Optional[datetime.date], end: Optional[datetime.date], tag: Optional[str]) -> str:
+        return json.dumps({
+            'start': start.strftime('%F') if start else None,
+            'end': end.strftime('%F') if end else None,
+            'tag': tag,
+        }, sort_keys=True)
+
+    def _load_state(self) -> Dict:
+        if not self.state_path.exists():
+            return {}
+        with self.state_path.open() as f:
+            state = json.load(f)
+        if 'runs' not in state:
+            # From before watermarks were kept per run - only unfiltered runs were expected then
+            return {self._run_key(None, None, None): state}
+        return state['runs']
+
+    def load_watermark(self, run_key: str) -> Optional[datetime.datetime]:
+        """The last-updated time of the newest group seen by the last clean run with the same date range & tag.
+            A filtered run doesn't cover what's outside its filter, so each gets its own watermark"""
+        if self.full:
+            return None
+        return parse_timestamp(self._load_state().get(run_key, {}).get('last_updated_at'))
+
+    def save_watermark(self, run_key: str, watermark: Optional[datetime.datetime]):
+        runs = self._load_state()
+        runs[run_key] = {
+            'last_updated_at': watermark.isoformat() if watermark else None,
+            'run_at': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        }
+        tmp_path = self.state_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({'runs': runs}, f)
+        tmp_path.replace(self.state_path)
+
+    def _fetch(self, prop_tx_id: str) -> Optional[PropTxRecord]:
+        """The proportional transaction as Firefly has it now - None if it's gone"""
+        self.limiter.acquire()
+        try:
+            return PropTxRecord.from_api(self.ffr_core.get_transaction(prop_tx_id))
+        except HTTPError as e:
+            if getattr(e, 'response', None) is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    @staticmethod
+    def _expected_splits(record: PropTxRecord, splits: List[Dict]) -> List[Optional[PropSplit]]:
+        """The proportional split made for each original split"""
+        matches: List[Optional[PropSplit]] = [None] * len(splits)
+        by_orig: Dict[str, List[int]] = {}
+        for i, split in enumerate(splits):
+            by_orig.setdefault(str(split['org_tx']['id']), []).append(i)
+        for orig_tx_id, indexes in by_orig.items():
+            prop_jrnl_ids = [splits[i]['org_tx'].get('prop_jrnl_id') for i in indexes]
+            for i, ptx in zip(indexes, record.match_splits(orig_tx_id, prop_jrnl_ids)):
+                matches[i] = ptx
+        return matches
+
+    def _drift(self, record: PropTxRecord, splits: List[Dict], report: bool = True) -> Dict[str, str]:
+        """The amount each drifted split of the proportional transaction should have, by journal id"""
+        drifted: Dict[str, str] = {}
+        for split, ptx in zip(splits, self._expected_splits(record, splits)):
+            expected = split['new_tx']['amount']
+            if ptx is None:
+                if report:
+                    self._find('dangling', **_describe(split))
+            elif same_amount(ptx.amount, expected):
+                if report:
+                    self._count('in_sync')
+            else:
+                drifted[ptx.journal_id] = expected
+                if report:
+                    self._find('drifted', **_describe(split), journal_id=ptx.journal_id, actual=ptx.amount)
+        return drifted
+
+    def _replan(self, orig_tx_ids: List[str], prop_tx_id: str) -> List[Dict]:
+        """The original splits linking to the proportional transaction, as Firefly has them now"""
+        events = []
+        for orig_tx_id in orig_tx_ids:
+            self.limiter.acquire()
+            events.append(TransactionEvent.from_group(self.ffr_core.get_transaction(orig_tx_id)))
+        return [split for new_splits in self.ffr_core.plan_events(events, is_new=False, mark_seen=False)
+                for split in new_splits if split['is_update'] and str(split['org_tx']['prop_tx_id']) == prop_tx_id]
+
+    def _reconcile_prop_tx(self, prop_tx_id: str, splits: List[Dict]):
+        """Compares one proportional transaction against all the original splits linking to it; fixes any drift"""
+        record = self._fetch(prop_tx_id)
+        if record is None:
+            for split in splits:
+                self._find('dangling', **_describe(split))
+            return
+        self._count('checked', len(splits))
+        drifted = self._drift(record, splits)
+        if not drifted or self.dry_run:
+            return
+        orig_tx_ids = sorted({str(x['org_tx']['id']) for x in splits})
+        with ExitStack() as stack:
+            for orig_tx_id in orig_tx_ids:
+                stack.enter_context(self.ffr_core.tx_locks.hold(orig_tx_id))
+            # A webhook may have been handled (or the original edited again) since we read them
+            splits = self._replan(orig_tx_ids, prop_tx_id)
+            record = self._fetch(prop_tx_id)
+            drifted = self._drift(record, splits, report=False) if record else {}
+            if not drifted:
+                logger.info(f'Proportional transaction {prop_tx_id} was brought in sync meanwhile')
+                return
+            # One update for all the drifted splits
+            modified_splits = []
+            for ptx in record.splits:
+                t_split_data = {'transaction_journal_id': ptx.journal_id}
+                if ptx.journal_id in drifted:
+                    t_split_data['amount'] = drifted[ptx.journal_id]
+                modified_splits.append(t_split_data)
+            self.limiter.acquire()
+            self.ffr_core.update_transaction(tx_id=prop_tx_id, transactions=modified_splits)
+        for journal_id, amount in drifted.items():
+            self.ffr_core.prop_cache.set_amount(prop_tx_id, journal_id=journal_id, amount=amount)
+        self._count('fixed', len(drifted))
+
+    def _changed_since(self, event: TransactionEvent, watermark: Optional[datetime.datetime]) -> bool:
+        if watermark is None:
+            return True
+        updated_at = parse_timestamp(event.updated_at)
+        return updated_at is None or updated_at > watermark
+
+    def _reconcile_page(self, executor: Executor, tx_groups: List[Dict],
+                        watermark: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+        """Reconciles the groups of a page changed since the watermark. Returns the page's newest update time"""
+        events = [TransactionEvent.from_group(x) for x in tx_groups]
+        newest = max(filter(None, (parse_timestamp(x.updated_at) for x in events)), default=None)
+        changed = [x for x in events if self._changed_since(x, watermark)]
+        self._count('changed', len(changed))
+        # The expected amounts of the whole page at once, grouped by the proportional transaction they're in
+        by_prop_tx: Dict[str, List[Dict]] = {}
+        for new_splits in self.ffr_core.plan_events(changed, is_new=False, mark_seen=False):
+            for split in new_splits:
+                if not split['is_update']:
+                    # No proportional transaction yet - backfill.py creates those
+                    self._find('unlinked', **_describe(split))
+                    continue
+                by_prop_tx.setdefault(str(split['org_tx']['prop_tx_id']), []).append(split)
+
+        futures = {prop_tx_id: executor.submit(self._reconcile_prop_tx, prop_tx_id, splits)
+                   for prop_tx_id, splits in by_prop_tx.items()}
+        for prop_tx_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f'Failed to reconcile proportional transaction {prop_tx_id}: {e}')
+                self._find('errors', prop_tx_id=prop_tx_id, error=str(e))
+        return newest
+
+    def run(self, start: datetime.date = None, end: datetime.date = None, tag: str = None) -> Dict:
+        run_key = self._run_key(start=start, end=end, tag=tag)
+        watermark = self.load_watermark(run_key)
+        logger.info(f'Reconciling transactions updated since {watermark or "ever"}'
+                    f'{" (dry run)" if self.dry_run else ""}...')
+        newest = watermark
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ffr-reconcile') as executor:
+            for page, total_pages, tx_groups in self.ffr_core.iter_transaction_pages(
+                    start=start, end=end, limit=self.page_size, tag=tag):
+                try:
+                    page_newest = self._reconcile_page(executor, tx_groups, watermark=watermark)
+                except Exception as e:
+                    logger.error(f'Failed to reconcile page {page}: {e}')
+                    self._find('errors', page=page, error=str(e))
+                    continue
+                if page_newest is not None and (newest is None or page_newest > newest):
+                    newest = page_newest
+                self._count('pages')
+                self._count('transactions', len(tx_groups))
+                logger.info(f'Page {page}/{total_pages} done - {self.stats}')
+        # Anything that failed is looked at again next time
+        if self.stats['errors'] == 0 and not self.dry_run:
+            self.save_watermark(run_key, newest)
+        self.write_report(watermark=watermark, start=start, end=end, tag=tag)
+        return self.stats
+
+    def write_report(self, watermark: Optional[datetime.datetime], start: datetime.date = None,
+                     end: datetime.date = None, tag: str = None):
+        if self.report_path is None:
+            return
+        with self.report_path.open('w') as f:
+            json.dump({
+                'run': {
+                    'since': watermark.isoformat() if watermark else None,
+                    'start': start.strftime('%F') if start else None,
+                    'end': end.strftime('%F') if end else None,
+                    'tag': tag,
+                    'dry_run': self.dry_run,
+                },
+                'stats': self.stats,
+                'findings': self.findings,
+            }, f, indent=2)
+
+
+def _describe(split: Dict) -> Dict:
+    """The report's view of a planned proportional split"""
+    return {
+        'orig_tx_id': str(split['org_tx']['id']),
+        'orig_journal_id': split['org_tx']['tx_jrnl_id'],
+        'tag': split['org_tx']['tag'],
+        'prop_tx_id': split['org_tx']['prop_tx_id'],
+        'expected': split['new_tx']['amount'],
+    }
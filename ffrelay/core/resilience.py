@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from typing import Dict
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Methods that can be sent again without side effects piling up
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Firefly while the circuit breaker is open"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f'Firefly circuit breaker is open - not calling for another {retry_in:.1f}s')
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Fails fast while Firefly is down.
+
+        After `failure_threshold` consecutive transient failures the breaker opens and calls fail
+        immediately with CircuitOpenError. Once `reset_secs` have passed a single probe call is let through
+        (half open): success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_secs: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        # Metrics
+        self.opened = 0
+        self.short_circuited = 0
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call shouldn't go out"""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            retry_in = self._opened_at + self.reset_secs - time.monotonic()
+            if self.state == OPEN and retry_in <= 0:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            self.short_circuited += 1
+        raise CircuitOpenError(retry_in=max(retry_in, 0.0))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self.state = CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'opened': self.opened,
+                'short_circuited': self.short_circuited,
+            }
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter, bounded by a retry budget.
+
+        The budget keeps retries to a fraction of overall traffic: every call adds `budget_ratio`
+        of a token (up to `budget_max`), every retry spends a whole one. When Firefly is struggling,
+        retries dry up instead of multiplying the load.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 budget_ratio: float = 0.2, budget_max: float = 10.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self._budget = budget_max
+        self._lock = threading.Lock()
+        # Metrics
+        self.retries = 0
+        self.budget_exhausted = 0
+
+    def record_call(self):
+        with self._lock:
+            self._budget = min(self.budget_max, self._budget + self.budget_ratio)
+
+    def try_spend(self) -> bool:
+        """Takes a retry from the budget, if there's one left"""
+        with self._lock:
+            if self._budget >= 1:
+                self._budget -= 1
+                self.retries += 1
+                return True
+            self.budget_exhausted += 1
+            return False
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before retry number `attempt` (1-based)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'max_attempts': self.max_attempts,
+                'retries': self.retries,
+                'budget_left': round(self._budget, 2),
+                'budget_exhausted': self.budget_exhausted,
+            }
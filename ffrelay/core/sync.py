@@ -0,0 +1,256 @@
+import datetime
+import fcntl
+import json
+import pathlib
+import threading
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from loguru import logger
+
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.payload import (
+    PayloadError,
+    TransactionEvent,
+)
+from ffrelay.core.utils import parse_timestamp
+
+# (updated at, tx id) - the order changes are worked through in
+ChangeKey = Tuple[datetime.datetime, str]
+
+
+class SyncPoller:
+    """Polls Firefly for transactions changed since the last poll and runs them through the same handling
+        as webhooks - for when webhooks get lost, or can't reach the relay at all.
+
+        The high-water mark is the newest update time handled (plus the ids handled at exactly that time),
+        persisted to `state_path`. Firefly's list filters by transaction date, not update time, so each poll
+        pages through the last `lookback_days` in large pages and keeps the groups updated past the mark.
+        Changes younger than `settle_secs` are left for the next poll, giving their webhook the first go;
+        anything a webhook (or our own write) already handled is skipped through the same dedup marks the routes
+        use - held for as long as a change can take to reach a poll.
+        The interval halves while changes keep turning up and doubles while idle, within its bounds.
+        Only one process polls at a time (the one holding `<state_path>.lock`), so the path is required:
+        without it every worker would poll, and changes made while the relay was down would never be picked up.
+    """
+
+    def __init__(self, ffr_core: FireFlyRelayCore, handler: Callable[[TransactionEvent, bool], None],
+                 state_path: Union[str, pathlib.Path], min_interval_secs: float = 15.0,
+                 max_interval_secs: float = 300.0, lookback_days: int = 7, page_size: int = 200,
+                 settle_secs: float = 30.0, max_attempts: int = 3, name: str = 'ffr-sync'):
+        self.ffr_core = ffr_core
+        self.handler = handler
+        if not state_path:
+            raise ValueError('Sync polling needs a sync-state-path to keep its mark & leader lock in')
+        self.state_path = pathlib.Path(state_path)
+        self.min_interval_secs = min_interval_secs
+        self.max_interval_secs = max(min_interval_secs, max_interval_secs)
+        self.interval_secs = min_interval_secs
+        self.lookback_days = lookback_days
+        self.page_size = page_size
+        self.settle_secs = settle_secs
+        self.max_attempts = max_attempts
+        self.name = name
+        self.mark: Optional[datetime.datetime] = None
+        self.mark_ids: Set[str] = set()
+        self._attempts: Dict[str, int] = {}
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._mutex = threading.Lock()
+        self.load_state()
+        # A change is polled at most settle_secs + max_interval_secs after it's made - its mark has to outlast that
+        self.ffr_core.updated_txs.hold_for_at_least(self.settle_secs + self.max_interval_secs)
+        if self.ffr_core.updated_txs.backend == 'memory':
+            logger.warning('Sync polling with the memory dedup backend - changes the webhooks of another worker '
+                           'handled will be handled again (dedup-backend=sqlite shares the marks)')
+        # Metrics
+        self.polls = 0
+        self.changed = 0
+        self.dispatched = 0
+        self.deduped = 0
+        self.untagged = 0
+        self.failed = 0
+        self.gave_up = 0
+        self.errors = 0
+
+    def load_state(self):
+        if not self.state_path.exists():
+            return
+        with self.state_path.open() as f:
+            state = json.load(f)
+        self.mark = parse_timestamp(state.get('updated_at'))
+        self.mark_ids = set(state.get('ids', []))
+
+    def save_state(self):
+        tmp_path = self.state_path.with_suffix('.tmp')
+        with tmp_path.open('w') as f:
+            json.dump({
+                'updated_at': self.mark.isoformat() if self.mark else None,
+                'ids': sorted(self.mark_ids),
+            }, f)
+        tmp_path.replace(self.state_path)
+
+    def _advance(self, key: ChangeKey):
+        """Moves the mark past a change"""
+        updated_at, tx_id = key
+        if self.mark is None or updated_at > self.mark:
+            self.mark, self.mark_ids = updated_at, {tx_id}
+        else:
+            self.mark_ids.add(tx_id)
+        self._attempts.pop(tx_id, None)
+
+    def _is_past_mark(self, key: ChangeKey) -> bool:
+        updated_at, tx_id = key
+        return self.mark is None or updated_at > self.mark or (updated_at == self.mark and tx_id not in self.mark_ids)
+
+    def fetch_changes(self) -> List[Tuple[ChangeKey, Dict]]:
+        """Transaction groups updated past the mark, oldest change first"""
+        start = datetime.date.today() - datetime.timedelta(days=self.lookback_days)
+        changes = []
+        for _, _, tx_groups in self.ffr_core.iter_transaction_pages(start=start, limit=self.page_size):
+            for tx_group in tx_groups:
+                updated_at = parse_timestamp(tx_group.get('attributes', {}).get('updated_at'))
+                if updated_at is None:
+                    # Can't be ordered against the mark - left to the webhooks & reconcile.py
+                    continue
+                key = (updated_at, str(tx_group['id']))
+                if self._is_past_mark(key):
+                    changes.append((key, tx_group))
+        changes.sort(key=lambda x: x[0])
+        return changes
+
+    def poll_once(self) -> int:
+        """Works through the changes since the last poll. Returns how many were handed to the handler"""
+        with self._mutex:
+            first_poll = self.mark is None
+            changes = self.fetch_changes()
+            self.polls += 1
+            self.changed += len(changes)
+            if first_poll:
+                # Nothing to compare against yet - start from now rather than replaying the whole window
+                if changes:
+                    self._advance(changes[-1][0])
+                    self.save_state()
+                logger.info(f'Sync poller starting from {self.mark}')
+                return 0
+            settled_before = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+                seconds=self.settle_secs)
+            dispatched = 0
+            for key, tx_group in changes:
+                if key[0] > settled_before:
+                    # Its webhook may still be on the way; everything after it is newer still
+                    break
+                outcome = self._handle(tx_group)
+                if outcome is None:
+                    # Failed - retried from here next time
+                    break
+                dispatched += outcome
+                self._advance(key)
+            self.save_state()
+            self.dispatched += dispatched
+            return dispatched
+
+    def _handle(self, tx_group: Dict) -> Optional[int]:
+        """Hands a changed group to the handler unless a webhook beat us to it.
+            Returns 1 if handed over, 0 if skipped, None if it failed and should be retried"""
+        tx_id = str(tx_group['id'])
+        try:
+            event = TransactionEvent.from_group(tx_group)
+        except (KeyError, PayloadError) as e:
+            logger.error(f'Sync poller skipping unreadable tx id {tx_id}: {e}')
+            return 0
+        if not any(self.ffr_core.tag_rules.match_tags(x.tags) for x in event.transactions):
+            self.untagged += 1
+            return 0
+        # Never edited since it was made -> it's the 'new transaction' webhook we'd have missed
+        attributes = tx_group.get('attributes', {})
+        is_new = attributes.get('created_at') is not None and attributes.get('created_at') == event.updated_at
+        if not self.ffr_core.mark_seen(tx_id, is_new=is_new, updated_at=event.updated_at):
+            self.deduped += 1
+            return 0
+        try:
+            self.handler(event, is_new)
+        except Exception as e:
+            self.ffr_core.release(tx_id, is_new=is_new, updated_at=event.updated_at)
+            self.failed += 1
+            attempts = self._attempts[tx_id] = self._attempts.get(tx_id, 0) + 1
+            if attempts < self.max_attempts:
+                logger.warning(f'Sync poller failed on tx id {tx_id} (attempt {attempts}): {e}')
+                return None
+            logger.error(f'Sync poller giving up on tx id {tx_id} after {attempts} attempts: {e}')
+            self.gave_up += 1
+            return 0
+        return 1
+
+    def _next_interval(self, dispatched: Optional[int]) -> float:
+        """Shorter while changes keep coming (edits come in bursts), longer when idle or failing"""
+        if dispatched:
+            return max(self.min_interval_secs, self.interval_secs / 2)
+        return min(self.max_interval_secs, self.interval_secs * 2)
+
+    def _try_lead(self) -> bool:
+        """Whether this process is the one polling"""
+        if self._lock_file is not None:
+            return True
+        lock_file = self.state_path.with_suffix('.lock').open('a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        # Another process may have moved the mark while it held the lock
+        self.load_state()
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._try_lead():
+                self._stop.wait(self.max_interval_secs)
+                continue
+            dispatched = None
+            try:
+                dispatched = self.poll_once()
+            except Exception as e:
+                logger.error(f'Sync poll failed: {e}')
+                self.errors += 1
+            self.interval_secs = self._next_interval(dispatched)
+            self._stop.wait(self.interval_secs)
+
+    def shutdown(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def stats(self) -> Dict:
+        return {
+            'leader': self._lock_file is not None,
+            'interval_secs': self.interval_secs,
+            'mark': self.mark.isoformat() if self.mark else None,
+            'polls': self.polls,
+            'changed': self.changed,
+            'dispatched': self.dispatched,
+            'deduped': self.deduped,
+            'untagged': self.untagged,
+            'failed': self.failed,
+            'gave_up': self.gave_up,
+            'errors': self.errors,
+        }
@@ -0,0 +1,173 @@
+from functools import lru_cache
+import re
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Tuple,
+)
+
+from ffrelay.core.utils import prop_bool
+
+# Generic proportion tag, e.g. 'shared-p36' -> 36%
+PROPORTION_TAG_PATTERN = re.compile(r'(\w+)-p(\d+)')
+# Characters a JSON encoder may escape (Firefly's escapes '/' and anything non-ASCII)
+JSON_ESCAPED_CHARS = set('"\\/')
+
+
+class TagRule(NamedTuple):
+    """A configured tag rule.
+
+        With a proportion, the rule matches the tag name exactly ('rent' -> 50%).
+        Without one, it matches '<name>-pNN' tags, taking the proportion from the tag.
+        The account ids, when set, override the default income/owed accounts.
+    """
+    name: str
+    proportion: Optional[int] = None
+    dest_acct_id: Optional[str] = None
+    source_acct_id: Optional[str] = None
+
+
+class TagMatch(NamedTuple):
+    tag: str
+    proportion: int
+    dest_acct_id: Optional[str] = None
+    source_acct_id: Optional[str] = None
+
+
+def parse_tag_rules(spec: str) -> List[TagRule]:
+    """Parses the `tag-rules` prop: comma-separated `<tag>[:p=<NN>][:dest=<acct id>][:src=<acct id>]`
+
+        e.g. 'rent:p=50:dest=12, groceries:dest=15' -> 'rent' is always 50% to account 12,
+            'groceries-pNN' is NN% to account 15
+    """
+    rules = []
+    for raw_rule in spec.split(','):
+        raw_rule = raw_rule.strip()
+        if raw_rule == '':
+            continue
+        name, *options = [x.strip() for x in raw_rule.split(':')]
+        kwargs = {}
+        for opt in options:
+            key, _, val = opt.partition('=')
+            if key == 'p' and val.isnumeric():
+                kwargs['proportion'] = int(val)
+            elif key == 'dest' and val != '':
+                kwargs['dest_acct_id'] = val
+            elif key == 'src' and val != '':
+                kwargs['source_acct_id'] = val
+            else:
+                raise ValueError(f'Unable to parse option "{opt}" of tag rule "{raw_rule}"')
+        rules.append(TagRule(name=name, **kwargs))
+    return rules
+
+
+class TagRuleEngine:
+    """Decides which of a split's tags call for a proportional transaction.
+
+        Rules are indexed once, at startup: exact-tag rules by tag name, '-pNN' rules by prefix.
+        The decision for each distinct tag, and for each distinct set of tags, is memoized,
+        so a split whose tags were seen before costs one cache hit.
+        With `prefilter`, `may_match` scans a raw webhook body for anything a matching tag would leave in it,
+        so most webhooks (no proportion tags) can be answered without parsing them.
+    """
+
+    def __init__(self, rules: Iterable[TagRule] = None, match_any_prefix: bool = True, cache_size: int = 4096,
+                 prefilter: bool = True):
+        self.exact_rules: Dict[str, TagRule] = {}
+        self.prefix_rules: Dict[str, TagRule] = {}
+        for rule in (rules or []):
+            if rule.proportion is not None:
+                self.exact_rules[rule.name] = rule
+            else:
+                self.prefix_rules[rule.name] = rule
+        # Whether '-pNN' tags without a configured rule still count (the original behavior)
+        self.match_any_prefix = match_any_prefix
+        self._match_tag = lru_cache(maxsize=cache_size)(self._build_tag_match)
+        self.match_tags = lru_cache(maxsize=cache_size)(self._match_tags)
+        self.prefilter_patterns = self._build_prefilter() if prefilter else None
+        # Metrics
+        self.prefilter_checked = 0
+        self.prefilter_skipped = 0
+
+    @classmethod
+    def from_props(cls, props: Dict) -> 'TagRuleEngine':
+        return cls(
+            rules=parse_tag_rules(props.get('tag-rules', '')),
+            match_any_prefix=prop_bool(props, 'tag-rules-match-any', default=True),
+            prefilter=prop_bool(props, 'tag-prefilter', default=True),
+        )
+
+    def _build_prefilter(self) -> Optional[Tuple[Pattern[bytes], ...]]:
+        """Builds bytes patterns, one of which is in any JSON body with a matching tag (and in a few without).
+            Each starts with a literal, which `re` scans for quickly - joined into one alternation, it's much slower.
+            None if a rule's tag might be escaped in the JSON - there's no telling then
+        """
+        needles = []
+        if self.match_any_prefix:
+            # Any '<word>-pNN' tag - which covers the prefix rules too
+            needles.append(rb'-p\d')
+        else:
+            for name in self.prefix_rules:
+                if not _is_plain(name):
+                    return None
+                needles.append(re.escape(name.encode()) + rb'-p\d')
+        for name in self.exact_rules:
+            if not _is_plain(name):
+                return None
+            needles.append(b'"' + re.escape(name.encode()) + b'"')
+        return tuple(re.compile(x) for x in needles)
+
+    def may_match(self, body: bytes) -> bool:
+        """False if a raw webhook body surely has no matching tag, so there's nothing to do for it"""
+        if self.prefilter_patterns is None:
+            return True
+        self.prefilter_checked += 1
+        if any(x.search(body) is not None for x in self.prefilter_patterns):
+            return True
+        self.prefilter_skipped += 1
+        return False
+
+    def _build_tag_match(self, tag: str) -> Optional[TagMatch]:
+        if (rule := self.exact_rules.get(tag)) is not None:
+            return TagMatch(tag=tag, proportion=rule.proportion, dest_acct_id=rule.dest_acct_id,
+                            source_acct_id=rule.source_acct_id)
+        if '-p' not in tag:
+            return None
+        tag_match = PROPORTION_TAG_PATTERN.match(tag)
+        if tag_match is None:
+            return None
+        prefix, raw_proportion = tag_match.groups()
+        if (rule := self.prefix_rules.get(prefix)) is not None:
+            return TagMatch(tag=tag, proportion=int(raw_proportion), dest_acct_id=rule.dest_acct_id,
+                            source_acct_id=rule.source_acct_id)
+        if self.match_any_prefix:
+            return TagMatch(tag=tag, proportion=int(raw_proportion))
+        return None
+
+    def _match_tags(self, tags: Tuple[str, ...]) -> Tuple[TagMatch, ...]:
+        """Returns the matches for a split's tags, in tag order. Call with a tuple (so it can be cached)"""
+        return tuple(m for m in map(self._match_tag, tags) if m is not None)
+
+    def cache_info(self) -> Dict:
+        tag_info = self._match_tag.cache_info()
+        set_info = self.match_tags.cache_info()
+        return {
+            'exact_rules': len(self.exact_rules),
+            'prefix_rules': len(self.prefix_rules),
+            'tag_cache': {'hits': tag_info.hits, 'misses': tag_info.misses, 'size': tag_info.currsize},
+            'tag_set_cache': {'hits': set_info.hits, 'misses': set_info.misses, 'size': set_info.currsize},
+            'prefilter': {
+                'enabled': self.prefilter_patterns is not None,
+                'checked': self.prefilter_checked,
+                'skipped': self.prefilter_skipped,
+            },
+        }
+
+
+def _is_plain(tag: str) -> bool:
+    """Whether a tag appears as-is in the JSON of a webhook"""
+    return tag.isascii() and tag.isprintable() and JSON_ESCAPED_CHARS.isdisjoint(tag)
@@ -0,0 +1,231 @@
+import asyncio
+from contextlib import (
+    asynccontextmanager,
+    contextmanager,
+)
+import threading
+import time
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterator,
+    List,
+)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens a second, holding at most `burst`. A rate of 0 means unlimited."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        # Metrics
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_secs = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self) -> float:
+        """Takes a token if there is one (returns 0), otherwise returns how long to wait for one"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.rate <= 0:
+                return 0.0
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _acquired(self, waited: float) -> float:
+        with self._lock:
+            self.acquired += 1
+            if waited > 0:
+                self.throttled += 1
+                self.wait_secs += waited
+        return waited
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until one is available. Returns the time spent waiting"""
+        if self.rate <= 0 and self._paused_until == 0.0:
+            self.acquired += 1
+            return 0.0
+        waited = 0.0
+        while (delay := self._take()) > 0:
+            time.sleep(delay)
+            waited += delay
+        return self._acquired(waited)
+
+    async def acquire_async(self) -> float:
+        """`acquire` for coroutines - waits without blocking the event loop"""
+        if self.rate <= 0 and self._paused_until == 0.0:
+            self.acquired += 1
+            return 0.0
+        waited = 0.0
+        while (delay := self._take()) > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        return self._acquired(waited)
+
+    def pause(self, secs: float):
+        """Hands out no tokens for the next `secs` seconds (e.g., Firefly answered 429 with a Retry-After)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + secs)
+            self._tokens = 0.0
+
+    def stats(self) -> Dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'acquired': self.acquired,
+            'throttled': self.throttled,
+            'wait_secs': round(self.wait_secs, 3),
+        }
+
+
+class AdaptiveConcurrencyLimiter:
+    """Caps the number of calls in flight, adjusting the cap AIMD-style.
+
+        Every `window` calls that finish fine and faster than `latency_target` raise the limit by one
+        (additive increase); an overload signal - 429, 5xx, connection failure or a slow call - multiplies it
+        by `backoff` (multiplicative decrease), at most once per window so one bad burst doesn't collapse it.
+    """
+
+    def __init__(self, initial: int = 4, min_limit: int = 1, max_limit: int = 16, latency_target: float = 2.0,
+                 backoff: float = 0.5, window: int = 10):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.window = window
+        self.in_flight = 0
+        self._successes = 0
+        self._calls_since_decrease = window
+        self._cond = threading.Condition()
+        self._async_waiters: List[asyncio.Future] = []
+        # Metrics
+        self.increases = 0
+        self.decreases = 0
+        self.throttled = 0
+        self.wait_secs = 0.0
+
+    def _try_take(self) -> bool:
+        """Takes a slot if one is free. Expects the lock to be held"""
+        if self.in_flight >= self.limit:
+            return False
+        self.in_flight += 1
+        return True
+
+    def _acquired(self, start: float, waited: bool) -> float:
+        wait_secs = time.perf_counter() - start
+        if waited:
+            self.throttled += 1
+            self.wait_secs += wait_secs
+        return wait_secs
+
+    def acquire(self) -> float:
+        start = time.perf_counter()
+        waited = False
+        with self._cond:
+            while not self._try_take():
+                waited = True
+                self._cond.wait()
+            return self._acquired(start, waited)
+
+    async def acquire_async(self) -> float:
+        """`acquire` for coroutines - waits on a future that `release` resolves, not on the lock"""
+        start = time.perf_counter()
+        waited = False
+        while True:
+            with self._cond:
+                if self._try_take():
+                    return self._acquired(start, waited)
+                waiter = asyncio.get_running_loop().create_future()
+                self._async_waiters.append(waiter)
+            waited = True
+            await waiter
+
+    def release(self, latency: float, overloaded: bool):
+        with self._cond:
+            self.in_flight -= 1
+            self._calls_since_decrease += 1
+            if overloaded or latency > self.latency_target:
+                self._successes = 0
+                if self._calls_since_decrease >= self.window and self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, int(self.limit * self.backoff))
+                    self.decreases += 1
+                    self._calls_since_decrease = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.window and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.increases += 1
+                    self._successes = 0
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for waiter in waiters:
+            # Released from whichever thread - resolve the future on its own loop
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    @contextmanager
+    def slot(self) -> Iterator['_CallOutcome']:
+        """Holds a slot for the length of the block; set `outcome.overloaded` inside it if the call signalled overload"""
+        self.acquire()
+        outcome = _CallOutcome()
+        start = time.perf_counter()
+        try:
+            yield outcome
+        except Exception:
+            outcome.overloaded = True
+            raise
+        finally:
+            self.release(latency=time.perf_counter() - start, overloaded=outcome.overloaded)
+
+    @asynccontextmanager
+    async def async_slot(self) -> AsyncIterator['_CallOutcome']:
+        """`slot` for coroutines"""
+        await self.acquire_async()
+        outcome = _CallOutcome()
+        start = time.perf_counter()
+        try:
+            yield outcome
+        except Exception:
+            outcome.overloaded = True
+            raise
+        finally:
+            self.release(latency=time.perf_counter() - start, overloaded=outcome.overloaded)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'limit': self.limit,
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'in_flight': self.in_flight,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'throttled': self.throttled,
+                'wait_secs': round(self.wait_secs, 3),
+            }
+
+
+class _CallOutcome:
+    __slots__ = ('overloaded', )
+
+    def __init__(self):
+        self.overloaded = False
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,197 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import json
+import os
+import pathlib
+import random
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
+import uuid
+
+from loguru import logger
+
+from ffrelay.core.profiling import SlowRequestProfiler
+from ffrelay.core.utils import clean_request_id
+
+
+class _Trace:
+    """The spans of one request (or background job) - everything under one root span"""
+    __slots__ = ('request_id', 'sampled', 'events')
+
+    def __init__(self, request_id: str, sampled: bool):
+        self.request_id = request_id
+        self.sampled = sampled
+        self.events: List[Dict] = []
+
+
+class Span:
+    __slots__ = ('name', 'trace', 'is_root', 'args', 'start_us', 'start', '_token')
+
+    def __init__(self, name: str, trace: _Trace, is_root: bool, args: Dict):
+        self.name = name
+        self.trace = trace
+        self.is_root = is_root
+        self.args = args
+        self.start_us = time.time_ns() // 1000
+        self.start = time.perf_counter()
+        self._token = None
+
+    @property
+    def request_id(self) -> str:
+        return self.trace.request_id
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar('ffr_trace', default=None)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id() -> Optional[str]:
+    """The request id of the trace the caller is running under, if any"""
+    trace = _current_trace.get()
+    return trace.request_id if trace is not None else None
+
+
+class Tracer:
+    """Lightweight spans, tied together by a request id and written in the Chrome trace event format
+        (open the file in chrome://tracing or ui.perfetto.dev).
+
+        A span started with no trace running becomes a root; the rest nest under it, on the same
+        thread or context. A root's events are written in one go when it finishes, and only for
+        `sample_rate` of the roots. If a profiler is attached, it watches every root span.
+        Until configured, spans cost next to nothing.
+    """
+
+    def __init__(self):
+        self.path: Optional[pathlib.Path] = None
+        self.sample_rate = 1.0
+        self.profiler: Optional[SlowRequestProfiler] = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # Metrics
+        self.traces = 0
+        self.spans = 0
+
+    def configure(self, path: Union[str, pathlib.Path] = None, sample_rate: float = 1.0,
+                  profiler: SlowRequestProfiler = None):
+        self.path = pathlib.Path(path) if path is not None else None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.sample_rate = sample_rate
+        self.profiler = profiler
+        self._pid = os.getpid()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None or self.profiler is not None
+
+    def begin(self, name: str, request_id: str = None, **args) -> Optional[Span]:
+        """Starts a span, under the running trace or as a new root. `end` it in the same context.
+            A root takes on `request_id` (e.g. the client's X-Request-ID, made safe) or gets a new one"""
+        if not self.enabled:
+            return None
+        trace = _current_trace.get()
+        is_root = trace is None
+        if is_root:
+            trace = _Trace(request_id=clean_request_id(request_id) or new_request_id(),
+                           sampled=self.path is not None and random.random() < self.sample_rate)
+        span = Span(name, trace=trace, is_root=is_root, args=args)
+        if is_root:
+            span._token = _current_trace.set(trace)
+            if self.profiler is not None:
+                self.profiler.start()
+        return span
+
+    def end(self, span: Optional[Span], **args):
+        if span is None:
+            return
+        dur = time.perf_counter() - span.start
+        trace = span.trace
+        if trace.sampled:
+            trace.events.append({
+                'name': span.name,
+                'cat': 'ffrelay',
+                'ph': 'X',
+                'ts': span.start_us,
+                'dur': int(dur * 1_000_000),
+                'pid': self._pid,
+                'tid': threading.get_ident(),
+                'args': {'request_id': trace.request_id, **span.args, **args},
+            })
+        if not span.is_root:
+            return
+        _current_trace.reset(span._token)
+        if self.profiler is not None:
+            try:
+                self.profiler.finish(request_id=trace.request_id, duration_ms=dur * 1000)
+            except OSError as e:
+                logger.warning(f'Unable to write profile: {e}')
+        if trace.sampled:
+            self._write(trace.events)
+
+    @contextmanager
+    def span(self, name: str, request_id: str = None, **args) -> Iterator[Optional[Span]]:
+        span = self.begin(name, request_id=request_id, **args)
+        try:
+            yield span
+        finally:
+            self.end(span)
+
+    def wrap(self, name: str) -> Callable:
+        """Decorator version of `span` - for coroutine functions too"""
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    if not self.enabled:
+                        return await func(*args, **kwargs)
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _write(self, events: List[Dict]):
+        # The array format allows leaving off the closing bracket, so events can just be appended
+        lines = ''.join(json.dumps(x) + ',\n' for x in events)
+        try:
+            with self._lock:
+                with self.path.open('a') as f:
+                    if f.tell() == 0:
+                        f.write('[\n')
+                    f.write(lines)
+                self.traces += 1
+                self.spans += len(events)
+        except OSError as e:
+            logger.warning(f'Unable to write trace: {e}')
+
+    def stats(self) -> Dict:
+        return {
+            'path': str(self.path) if self.path is not None else None,
+            'sample_rate': self.sample_rate,
+            'traces': self.traces,
+            'spans': self.spans,
+            'profiler': self.profiler.stats() if self.profiler is not None else None,
+        }
+
+
+TRACER = Tracer()
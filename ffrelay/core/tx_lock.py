@@ -0,0 +1,208 @@
+import asyncio
+from contextlib import (
+    asynccontextmanager,
+    contextmanager,
+)
+import fcntl
+import os
+import pathlib
+import re
+import tempfile
+import threading
+import time
+from typing import (
+    IO,
+    AsyncIterator,
+    Dict,
+    Iterator,
+    Optional,
+    Union,
+)
+
+from ffrelay.core.metrics import TX_LOCK_WAIT
+
+Key = Union[int, str]
+# Keys are transaction ids - anything else is kept out of the lock file names
+UNSAFE_KEY_CHARS = re.compile(r'[^\w.-]')
+# Where the relay's processes (gunicorn workers, reconcile.py, backfill.py) share their locks unless told otherwise
+DEFAULT_LOCK_DIR = pathlib.Path(tempfile.gettempdir()).joinpath('ffrelay-tx-locks')
+
+
+class TxLockTimeout(TimeoutError):
+    """Raised when a transaction stays locked by someone else for longer than the timeout"""
+
+
+class _Entry:
+    __slots__ = ('lock', 'users', 'file', 'path')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Threads holding or waiting on the lock - the entry goes once there are none
+        self.users = 0
+        self.file: Optional[IO] = None
+        self.path: Optional[pathlib.Path] = None
+
+
+class KeyedLock:
+    """One lock per key (a Firefly transaction id), so work on the same transaction is serialized
+        while unrelated transactions run fully in parallel.
+
+        Within a process each key gets a threading.Lock, made on first use and dropped once nobody holds or
+        waits on it. With a `lock_dir`, the holder also takes an flock on `<lock_dir>/tx-<key>.lock`, serializing
+        gunicorn workers too; the file is removed on release, so the directory only holds the locks in use
+        (and is only made once one is first taken).
+        Waits are timed into the `ffrelay_tx_lock_wait_seconds` histogram.
+    """
+
+    def __init__(self, lock_dir: Union[str, pathlib.Path] = None, timeout_secs: float = 30.0):
+        self.lock_dir = pathlib.Path(lock_dir) if lock_dir else None
+        self.timeout_secs = timeout_secs
+        self._entries: Dict[str, _Entry] = {}
+        self._mutex = threading.Lock()
+        # Metrics
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.wait_secs_total = 0.0
+        self.wait_secs_max = 0.0
+
+    def _enter(self, key: str) -> _Entry:
+        with self._mutex:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+            entry.users += 1
+            return entry
+
+    def _leave(self, key: str, entry: _Entry):
+        with self._mutex:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._entries[key]
+
+    def _lock_file(self, key: str, entry: _Entry, deadline: float) -> bool:
+        """Takes the key's file lock for the entry held. Returns whether another process had it"""
+        path = self.lock_dir.joinpath(f'tx-{UNSAFE_KEY_CHARS.sub("_", key)}.lock')
+        waited, delay = False, 0.001
+        while True:
+            try:
+                f = path.open('a')
+            except FileNotFoundError:
+                # Made on first use (or removed since)
+                self.lock_dir.mkdir(parents=True, exist_ok=True)
+                continue
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    waited = True
+                    if time.monotonic() >= deadline:
+                        f.close()
+                        raise TxLockTimeout(f'Transaction {key} is locked by another process')
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+            # The last holder removes the file on release - make sure ours wasn't removed after we opened it
+            try:
+                is_current = os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                is_current = False
+            if is_current:
+                entry.file, entry.path = f, path
+                return waited
+            f.close()
+
+    def acquire(self, key: Key, blocking: bool = True) -> Optional[bool]:
+        """Locks the key. Returns whether it had to wait for it - or None if not `blocking` and it's taken"""
+        key = str(key)
+        start = time.monotonic()
+        deadline = start + self.timeout_secs
+        entry = self._enter(key)
+        waited = False
+        if not entry.lock.acquire(blocking=False):
+            if not blocking:
+                self._leave(key, entry)
+                return None
+            waited = True
+            if not entry.lock.acquire(timeout=self.timeout_secs):
+                self._leave(key, entry)
+                self._timed_out()
+                raise TxLockTimeout(f'Transaction {key} is locked by another thread')
+        if self.lock_dir is not None:
+            try:
+                waited = self._lock_file(key, entry, deadline if blocking else start) or waited
+            except TxLockTimeout:
+                entry.lock.release()
+                self._leave(key, entry)
+                if not blocking:
+                    return None
+                self._timed_out()
+                raise
+        wait_secs = time.monotonic() - start
+        TX_LOCK_WAIT.observe(wait_secs)
+        with self._mutex:
+            self.acquired += 1
+            self.contended += waited
+            self.wait_secs_total += wait_secs
+            self.wait_secs_max = max(self.wait_secs_max, wait_secs)
+        return waited
+
+    def _timed_out(self):
+        with self._mutex:
+            self.timeouts += 1
+
+    def release(self, key: Key):
+        key = str(key)
+        with self._mutex:
+            entry = self._entries[key]
+        if entry.file is not None:
+            # Removed while still locked, so nobody can lock it between the unlink and the close
+            entry.path.unlink(missing_ok=True)
+            entry.file.close()
+            entry.file, entry.path = None, None
+        entry.lock.release()
+        self._leave(key, entry)
+
+    @contextmanager
+    def hold(self, key: Key) -> Iterator[bool]:
+        """Holds the key's lock for the block, yielding whether it had to wait for it"""
+        waited = self.acquire(key)
+        try:
+            yield waited
+        finally:
+            self.release(key)
+
+    @asynccontextmanager
+    async def hold_async(self, key: Key) -> AsyncIterator[bool]:
+        """hold() for an event loop: an uncontended key is locked right away, a taken one is waited on
+            in a worker thread so the loop carries on meanwhile"""
+        waited = self.acquire(key, blocking=False)
+        if waited is None:
+            acquiring = asyncio.ensure_future(asyncio.to_thread(self.acquire, key))
+            try:
+                await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # The thread can't be stopped and still takes the lock once it's free - hand it straight back
+                acquiring.add_done_callback(lambda x: self._release_acquired(key, x))
+                raise
+            waited = True
+        try:
+            yield waited
+        finally:
+            self.release(key)
+
+    def _release_acquired(self, key: Key, acquiring: asyncio.Future):
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self.release(key)
+
+    def stats(self) -> Dict:
+        with self._mutex:
+            return {
+                'file_locks': self.lock_dir is not None,
+                'active_keys': len(self._entries),
+                'acquired': self.acquired,
+                'contended': self.contended,
+                'timeouts': self.timeouts,
+                'wait_secs_total': round(self.wait_secs_total, 6),
+                'wait_secs_max': round(self.wait_secs_max, 6),
+            }
@@ -1,3 +1,13 @@
+import datetime
+import re
+from typing import (
+    Dict,
+    Optional,
+)
+
+# What a request id may hold - it ends up in file names and response headers
+_REQUEST_ID_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+
 
 def default_if_prop_none(obj, prop_name: str, default: str = '') -> str:
     """Simple one-liner for logic if empty object property shouldn't be empty for form"""
@@ -9,3 +19,56 @@ def default_if_prop_none(obj, prop_name: str, default: str = '') -> str:
         else:
             return default_if_prop_none(sub_obj, prop_name_split[1])
     return default if getattr(obj, prop_name) is None else getattr(obj, prop_name)
+
+
+def prop_int(props: Dict, key: str, default: int) -> int:
+    """Reads an integer setting from the secrets properties, falling back to the default when missing"""
+    val = props.get(key)
+    if val is None or str(val).strip() == '':
+        return default
+    return int(val)
+
+
+def prop_float(props: Dict, key: str, default: float) -> float:
+    """Reads a float setting from the secrets properties, falling back to the default when missing"""
+    val = props.get(key)
+    if val is None or str(val).strip() == '':
+        return default
+    return float(val)
+
+
+def prop_bool(props: Dict, key: str, default: bool = False) -> bool:
+    """Reads a boolean setting (true/yes/1/on) from the secrets properties"""
+    val = props.get(key)
+    if val is None or str(val).strip() == '':
+        return default
+    if isinstance(val, bool):
+        return val
+    return str(val).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def clean_request_id(val: Optional[str]) -> Optional[str]:
+    """A client-sent request id (X-Request-ID) with anything but letters, digits, '_', '.' & '-' replaced,
+        cut to 64 characters. None if there's nothing to it"""
+    if not val:
+        return None
+    return _REQUEST_ID_UNSAFE.sub('_', val)[:64]
+
+
+def parse_retry_after(val: Optional[str], default: float) -> float:
+    """Reads a Retry-After header given in seconds (the HTTP-date form falls back to the default)"""
+    try:
+        return max(0.0, float(val))
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_timestamp(val: Optional[str]) -> Optional[datetime.datetime]:
+    """Reads Firefly's ISO 8601 timestamps (e.g. '2024-06-24T12:00:00+00:00'); without an offset, UTC is assumed"""
+    if not val:
+        return None
+    try:
+        timestamp = datetime.datetime.fromisoformat(val)
+    except ValueError:
+        return None
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+
+from loguru import logger
+
+from ffrelay.core.journal import (
+    JobJournal,
+    make_job_key,
+)
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.tracing import (
+    TRACER,
+    current_request_id,
+)
+
+# Placed on the queue to tell a worker thread to exit
+_STOP = object()
+
+
+class WebhookQueue:
+    """Bounded queue of accepted webhook payloads, drained by a fixed pool of worker threads.
+
+        Routes call `submit` and answer Firefly right away; a full queue refuses the payload
+        so the route can push back (503) instead of piling up unbounded work in memory.
+        With a journal attached, accepted payloads are persisted until processed and replayed
+        after a restart.
+    """
+
+    def __init__(self, handler: Callable[[Union[Dict, TransactionEvent], bool], int], max_size: int = 500, workers: int = 2,
+                 name: str = 'ffr-webhook', journal: Optional[JobJournal] = None):
+        self.handler = handler
+        self.journal = journal
+        self.max_size = max_size
+        self.n_workers = max(1, workers)
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_size)
+        self._threads: List[threading.Thread] = []
+        self._accepting = threading.Event()
+        self._lock = threading.Lock()
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.replayed = 0
+        self.in_flight = 0
+        self.peak_depth = 0
+
+    def start(self):
+        if self._threads:
+            return
+        logger.info(f'Starting {self.n_workers} webhook worker(s) (queue max size: {self.max_size})')
+        for i in range(self.n_workers):
+            t = threading.Thread(target=self._work, name=f'{self.name}-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        self._accepting.set()
+
+    @property
+    def is_accepting(self) -> bool:
+        return self._accepting.is_set()
+
+    def submit(self, data: Union[Dict, TransactionEvent], is_new: bool) -> bool:
+        """Enqueues a webhook payload. Returns False if the queue is full or shutting down.
+            A payload the journal has already accepted counts as accepted, but isn't queued again."""
+        if not self.is_accepting:
+            with self._lock:
+                self.rejected += 1
+            return False
+        job_key = None
+        if self.journal is not None:
+            job_key = make_job_key(data=data, is_new=is_new)
+            if not self.journal.record(job_key=job_key, data=data, is_new=is_new):
+                logger.info(f'Job {job_key} was already accepted - not queueing it again')
+                with self._lock:
+                    self.duplicates += 1
+                return True
+        try:
+            self.queue.put_nowait((data, is_new, job_key, current_request_id()))
+        except queue.Full:
+            if job_key is not None:
+                self.journal.discard(job_key)
+            with self._lock:
+                self.rejected += 1
+            logger.warning(f'Webhook queue full ({self.max_size}) - rejecting payload')
+            return False
+        with self._lock:
+            self.accepted += 1
+            self.peak_depth = max(self.peak_depth, self.queue.qsize())
+        return True
+
+    def replay_journal(self) -> threading.Thread:
+        """Requeues (in the background) the jobs left pending in the journal by a worker that's since died"""
+        def _replay():
+            for job_key, data, is_new in self.journal.claim_pending():
+                self.queue.put((data, is_new, job_key, None))
+                with self._lock:
+                    self.replayed += 1
+
+        t = threading.Thread(target=_replay, name=f'{self.name}-replay', daemon=True)
+        t.start()
+        return t
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                break
+            data, is_new, job_key, request_id = item
+            with self._lock:
+                self.in_flight += 1
+            ok = False
+            try:
+                # Traced under the id of the request that queued it
+                with TRACER.span('webhook_queue.job', request_id=request_id, is_new=is_new):
+                    self.handler(data, is_new)
+                ok = True
+            except Exception as e:
+                logger.exception(e)
+                with self._lock:
+                    self.failed += 1
+            else:
+                with self._lock:
+                    self.processed += 1
+            finally:
+                if job_key is not None:
+                    self.journal.complete(job_key=job_key, ok=ok)
+                with self._lock:
+                    self.in_flight -= 1
+                self.queue.task_done()
+
+    def shutdown(self, timeout: float = 30.0) -> bool:
+        """Stops accepting new payloads and waits (up to timeout seconds) for the queue to drain.
+            Returns True if everything queued was processed."""
+        self._accepting.clear()
+        if not self._threads:
+            return self.queue.unfinished_tasks == 0
+        logger.info(f'Draining webhook queue ({self.queue.qsize()} waiting, {self.in_flight} in flight)...')
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        drained = self.queue.unfinished_tasks == 0
+        if not drained:
+            logger.warning(f'Webhook queue not drained after {timeout}s; '
+                           f'{self.queue.unfinished_tasks} payload(s) abandoned')
+            return False
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for t in self._threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+        if self.journal is not None:
+            self.journal.close()
+        return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_size': self.max_size,
+                'peak_depth': self.peak_depth,
+                'workers': self.n_workers,
+                'in_flight': self.in_flight,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+                'duplicates': self.duplicates,
+                'replayed': self.replayed,
+            }
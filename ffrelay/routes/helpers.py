@@ -1,4 +1,5 @@
 import time
+from typing import Optional
 
 from flask import (
     current_app,
@@ -8,7 +9,14 @@ from flask import (
 )
 from pukr import PukrLog
 
+from ffrelay.core.coalesce import WebhookCoalescer
 from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.metrics import (
+    HTTP_IN_FLIGHT,
+    HTTP_LATENCY,
+)
+from ffrelay.core.tracing import TRACER
+from ffrelay.core.webhook_queue import WebhookQueue
 
 
 def get_app_logger() -> PukrLog:
@@ -19,17 +27,42 @@ def get_ffr_core() -> FireFlyRelayCore:
     return current_app.extensions['ffr-core']
 
 
+def get_webhook_queue() -> Optional[WebhookQueue]:
+    """Returns the background webhook queue if the app is running in async mode"""
+    return current_app.extensions.get('webhook-queue')
+
+
+def get_coalescer() -> Optional[WebhookCoalescer]:
+    """Returns the update webhook coalescer if a coalescing window is set"""
+    return current_app.extensions.get('webhook-coalescer')
+
+
 def log_before():
     g.start_time = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.span = TRACER.begin(f'{request.method} {route}', request_id=request.headers.get('X-Request-ID'),
+                          path=request.path)
 
 
 def log_after(response):
     total_time = time.perf_counter() - g.start_time
     time_ms = int(total_time * 1000)
-    get_app_logger().info(f'Timing: {time_ms}ms [{request.method}] -> {request.path}')
+    get_app_logger().debug('Timing: {}ms [{}] -> {}', time_ms, request.method, request.path)
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_LATENCY.observe(total_time, method=request.method, route=route, status=response.status_code)
+    if (span := g.get('span')) is not None:
+        span.args['status'] = response.status_code
+        response.headers['X-Request-ID'] = span.request_id
     return response
 
 
+def track_teardown(exc):
+    if 'start_time' in g:
+        HTTP_IN_FLIGHT.dec()
+    TRACER.end(g.pop('span', None))
+
+
 def clear_trailing_slash():
     req_path = request.path
     if req_path != '/' and req_path.endswith('/'):
@@ -1,9 +1,19 @@
 from flask import (
     Blueprint,
+    Response,
     current_app,
     jsonify,
 )
 
+from ffrelay.config import get_version
+from ffrelay.core.metrics import METRICS
+from ffrelay.core.tracing import TRACER
+from ffrelay.routes.helpers import (
+    get_coalescer,
+    get_ffr_core,
+    get_webhook_queue,
+)
+
 bp_main = Blueprint('main', __name__)
 
 
@@ -11,5 +21,39 @@ bp_main = Blueprint('main', __name__)
 def index():
     return jsonify({
         'app_name': current_app.name,
-        'version': current_app.config.get('VERSION')
+        'version': get_version()
     }), 200
+
+
+@bp_main.route('/stats', methods=['GET'])
+def stats():
+    ffrcore = get_ffr_core()
+    stats_dict = {
+        'http_pool': ffrcore.pool_stats(),
+        'throttle': ffrcore.throttle_stats(),
+        'resilience': ffrcore.resilience_stats(),
+        'prop_cache': ffrcore.prop_cache.stats(),
+        'link_index': ffrcore.link_index.stats(),
+        'dedup': ffrcore.dedup_stats(),
+        'tx_locks': ffrcore.tx_lock_stats(),
+        'tag_rules': ffrcore.tag_rules.cache_info(),
+    }
+    if (wqueue := get_webhook_queue()) is not None:
+        stats_dict['webhook_queue'] = wqueue.stats()
+        if wqueue.journal is not None:
+            stats_dict['job_journal'] = wqueue.journal.stats()
+    if TRACER.enabled:
+        stats_dict['tracing'] = TRACER.stats()
+    if (coalescer := get_coalescer()) is not None:
+        stats_dict['coalescer'] = coalescer.stats()
+    if (poller := current_app.extensions.get('sync-poller')) is not None:
+        stats_dict['sync'] = poller.stats()
+    if (log_sink := current_app.extensions.get('log-sink')) is not None:
+        stats_dict['log_sink'] = log_sink.stats()
+    return jsonify(stats_dict), 200
+
+
+@bp_main.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus scrape endpoint - added up across all workers when `metrics-dir` is set"""
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
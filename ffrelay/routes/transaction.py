@@ -1,3 +1,6 @@
+import random
+import time
+
 from flask import (
     Blueprint,
     current_app,
@@ -5,64 +8,81 @@ from flask import (
     request,
 )
 
+from ffrelay.core.metrics import (
+    STAGE_LATENCY,
+    TRANSACTIONS,
+)
+from ffrelay.core.payload import (
+    PayloadError,
+    parse_webhook,
+)
 from ffrelay.routes.helpers import (
     get_app_logger,
+    get_coalescer,
     get_ffr_core,
+    get_webhook_queue,
 )
 
 bp_trans = Blueprint('transaction', __name__, url_prefix='/transaction')
 
 
-@bp_trans.route('/add', methods=['GET', 'POST'])
-def add_transaction():
+def _handle_webhook(is_new: bool):
     log = get_app_logger()
     ffrcore = get_ffr_core()
 
-    data = request.get_json()
-    tx_data = data['content']
-
-    triggered_tx_id = tx_data['id']
-    if triggered_tx_id in ffrcore.new_txs:
-        # Transaction already handled - skip
-        log.info(f'Skipping new transaction - already worked on tx id: {triggered_tx_id}')
+    body = request.get_data()
+    coalescer = get_coalescer()
+    # Most webhooks have no proportion tag - answer those before parsing or deduplicating anything.
+    #   Not so for updates held by the coalescer: an untagged edit still has to replace a tagged one pending
+    if (is_new or coalescer is None) and not ffrcore.tag_rules.may_match(body):
+        TRANSACTIONS.inc(outcome='prefiltered')
         return 'OK', 200
 
-    new_txs = ffrcore.handle_incoming_transaction_data(data=data, is_new=True)
-
-    if len(new_txs) == 0:
-        log.debug('No transactions with matching tags found!')
+    start = time.perf_counter()
+    try:
+        event = parse_webhook(body)
+    except PayloadError as e:
+        log.warning(f'Unable to read webhook payload: {e} (body starts: {body[:200]!r})')
+        return jsonify({'message': str(e)}), 400
+    STAGE_LATENCY.observe(time.perf_counter() - start, stage='parse')
+    if ffrcore.payload_log_rate and random.random() < ffrcore.payload_log_rate:
+        log.info('Webhook payload for tx id {}: {}', event.id, body.decode(errors='replace'))
+
+    triggered_tx_id = event.id
+    if coalescer is not None and not is_new:
+        # Hold it for the window - only the latest event of a burst gets processed (and marked seen)
+        if ffrcore.is_seen(tx_id=triggered_tx_id, is_new=is_new, updated_at=event.updated_at):
+            log.info(f'Skipping updated transaction - already worked on tx id: {triggered_tx_id}')
+            TRANSACTIONS.inc(outcome='deduped')
+            return 'OK', 200
+        coalescer.submit(event=event, is_new=is_new)
+        return 'Accepted', 202
+
+    if not ffrcore.mark_seen(tx_id=triggered_tx_id, is_new=is_new, updated_at=event.updated_at):
+        # Transaction already handled (possibly by another worker) - skip
+        log.info(f'Skipping {"new" if is_new else "updated"} transaction - '
+                 f'already worked on tx id: {triggered_tx_id}')
+        TRANSACTIONS.inc(outcome='deduped')
         return 'OK', 200
 
-    ffrcore.process_new_splits(
-        new_splits=new_txs,
-        transaction_data=tx_data
-    )
-    return 'OK', 200
-
+    wqueue = get_webhook_queue()
+    if wqueue is not None:
+        # Async mode - hand off to the worker pool and let Firefly go
+        if not wqueue.submit(data=event, is_new=is_new):
+            log.warning(f'Webhook queue unavailable - asking Firefly to retry tx id: {triggered_tx_id}')
+            ffrcore.release(tx_id=triggered_tx_id, is_new=is_new, updated_at=event.updated_at)
+            return 'Busy', 503, {'Retry-After': '5'}
+        return 'Accepted', 202
 
-@bp_trans.route('/update', methods=['GET', 'POST'])
-def update_transaction():
-    log = get_app_logger()
-    ffrcore = get_ffr_core()
-
-    data = request.get_json()
-    tx_data = data['content']
-
-    triggered_tx_id = tx_data['id']
-    if triggered_tx_id in ffrcore.updated_txs:
-        # Transaction already handled - skip
-        log.info(f'Skipping updated transaction - already worked on tx id: {triggered_tx_id}')
-        return 'OK', 200
+    ffrcore.process_accepted(data=event, is_new=is_new)
+    return 'OK', 200
 
-    new_txs = ffrcore.handle_incoming_transaction_data(data=data, is_new=False)
 
-    if len(new_txs) == 0:
-        log.debug('No transactions with matching tags found!')
-        return 'OK', 200
+@bp_trans.route('/add', methods=['GET', 'POST'])
+def add_transaction():
+    return _handle_webhook(is_new=True)
 
-    ffrcore.process_new_splits(
-        new_splits=new_txs,
-        transaction_data=tx_data
-    )
 
-    return 'OK', 200
+@bp_trans.route('/update', methods=['GET', 'POST'])
+def update_transaction():
+    return _handle_webhook(is_new=False)
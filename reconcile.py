@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Fixes proportional transactions that drifted from their originals - meant to run on a schedule
+    (e.g. ff-relay-reconcile.timer). Each run only looks at what changed since the last one:
+        python3 reconcile.py --report reconcile-report.json
+        python3 reconcile.py --full --dry-run
+"""
+import argparse
+import datetime
+
+from ffrelay.config import (
+    DevelopmentConfig,
+    ProductionConfig,
+)
+
+
+def parse_date(val: str) -> datetime.date:
+    return datetime.datetime.strptime(val, '%Y-%m-%d').date()
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Find & fix drift between original and proportional transactions')
+    parser.add_argument('--start', type=parse_date, help='First transaction date (YYYY-MM-DD)')
+    parser.add_argument('--end', type=parse_date, help='Last transaction date (YYYY-MM-DD)')
+    parser.add_argument('--tag', help='Only look at transactions with this tag')
+    parser.add_argument('--workers', type=int, default=4, help='Proportional transactions fetched concurrently')
+    parser.add_argument('--rate', type=float, default=5.0, help='Max Firefly calls per second (on top of paging)')
+    parser.add_argument('--page-size', type=int, default=100, help='Transactions fetched per page')
+    parser.add_argument('--state', default='reconcile-state.json',
+                        help='Where the last run\'s high-water mark is kept')
+    parser.add_argument('--report', default='reconcile-report.json', help='Where the report is written')
+    parser.add_argument('--full', action='store_true', help='Look at every transaction, not just the changed ones')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the drift')
+    parser.add_argument('--dev', action='store_true', help='Use the development config')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from ffrelay.core.ff_core import FireFlyRelayCore
+    from ffrelay.core.reconcile import Reconciler
+
+    args = get_args()
+    config_class = DevelopmentConfig if args.dev else ProductionConfig
+    config_class.load_secrets()
+
+    reconciler = Reconciler(
+        ffr_core=FireFlyRelayCore(props=dict(config_class.SECRETS)),
+        state_path=args.state,
+        report_path=args.report,
+        workers=args.workers,
+        rate=args.rate,
+        page_size=args.page_size,
+        dry_run=args.dry_run,
+        full=args.full,
+    )
+    stats = reconciler.run(start=args.start, end=args.end, tag=args.tag)
+    print(stats)
+    raise SystemExit(1 if stats['errors'] else 0)
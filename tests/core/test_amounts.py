@@ -0,0 +1,44 @@
+from decimal import Decimal
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.amounts import (
+    proportional_amount,
+    proportional_amounts,
+    same_amount,
+    to_decimal,
+)
+
+
+class TestAmounts(TestCase):
+
+    def test_proportional_amounts(self):
+        self.assertEqual(['36.00', '0.58', '2.68', '33.00', '1234.57'], proportional_amounts([
+            ('100.00', 36),
+            # Binary floats round these two down
+            ('1.15', 50),
+            (' 2.675 ', 100),
+            ('99.99', 33),
+            (Decimal('2469.135'), 50),
+        ]))
+        self.assertEqual('72.00', proportional_amount('200', 36))
+        self.assertEqual([], proportional_amounts([]))
+        with self.assertRaises(ValueError):
+            proportional_amounts([('100.00', 50), ('1,00', 50)])
+        with self.assertRaises(ValueError):
+            to_decimal(None)
+
+    def test_same_amount(self):
+        # Firefly keeps 12 decimal places
+        self.assertTrue(same_amount('36.000000000000', '36.00'))
+        self.assertTrue(same_amount('36.0', '36'))
+        self.assertFalse(same_amount('36.010000000000', '36.00'))
+        self.assertFalse(same_amount(None, '36.00'))
+        self.assertTrue(same_amount(None, None))
+        self.assertFalse(same_amount('n/a', '36.00'))
+
+
+if __name__ == '__main__':
+    main()
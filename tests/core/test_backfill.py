@@ -0,0 +1,118 @@
+import datetime
+import json
+import pathlib
+import tempfile
+from unittest import (
+    TestCase,
+    main,
+)
+from unittest.mock import MagicMock
+
+from ffrelay.core.backfill import Backfiller
+from ffrelay.core.ff_core import FireFlyRelayCore
+from tests.common import make_patcher
+from tests.mocks.transaction import (
+    DEFAULT_DEST_ID,
+    DEFAULT_SOURCE_ID,
+    make_new_transaction_event,
+)
+
+
+def make_page(tids, page: int, total_pages: int, tags=None):
+    data = []
+    for tid in tids:
+        content = make_new_transaction_event(txs=[{'tags': tags}], tid=tid)['content']
+        data.append({'type': 'transactions', 'id': str(tid),
+                     'attributes': {k: v for k, v in content.items() if k != 'id'}})
+    return {'data': data, 'meta': {'pagination': {'current_page': page, 'total_pages': total_pages}}}
+
+
+class TestBackfill(TestCase):
+
+    def setUp(self) -> None:
+        make_patcher(self, 'ffrelay.core.ff_core.requests')
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.checkpoint_path = pathlib.Path(tmp_dir.name).joinpath('checkpoint.json')
+        self.ffr = FireFlyRelayCore(props={
+            'ff-base-url': 'https://example.com',
+            'token': 'hello-token',
+            'owe-acct-id': DEFAULT_DEST_ID,
+            'inc-acct-id': DEFAULT_SOURCE_ID,
+        })
+        self.pages = {
+            1: make_page([10, 11], page=1, total_pages=3, tags=['shared-p50']),
+            2: make_page([12, 13], page=2, total_pages=3),
+            3: make_page([14], page=3, total_pages=3, tags=['shared-p25']),
+        }
+        self.ffr.list_transactions = MagicMock(side_effect=lambda page, **kwargs: self.pages[page])
+        self.ffr.process_new_splits = MagicMock()
+
+    def test_run(self):
+        backfiller = Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0)
+        stats = backfiller.run(start=datetime.date(2024, 1, 1), end=datetime.date(2024, 6, 30))
+        self.assertEqual(3, stats['pages'])
+        self.assertEqual(5, stats['transactions'])
+        self.assertEqual(3, stats['matched'])
+        self.assertEqual(3, stats['created'])
+        self.assertEqual(3, self.ffr.process_new_splits.call_count)
+        # Dated like the original, not the day of the backfill
+        new_tx = self.ffr.process_new_splits.call_args.kwargs['new_splits'][0]['new_tx']
+        self.assertEqual('2024-06-24T12:34:00-0500',
+                         self.ffr._tx_split(**{k: v for k, v in new_tx.items() if k != 'title'})['date'])
+        # Backfilled transactions don't count as seen for the webhook routes
+        self.assertNotIn(10, self.ffr.updated_txs)
+        with self.checkpoint_path.open() as f:
+            checkpoint = json.load(f)
+        self.assertTrue(checkpoint['done'])
+        self.assertEqual('2024-01-01', checkpoint['run']['start'])
+
+    def test_resume(self):
+        # Fail on the last page, then rerun
+        def _flaky_list(page, **kwargs):
+            if page == 3:
+                raise ConnectionError('Firefly went away')
+            return self.pages[page]
+
+        self.ffr.list_transactions.side_effect = _flaky_list
+        backfiller = Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0)
+        with self.assertRaises(ConnectionError):
+            backfiller.run()
+
+        self.ffr.list_transactions.side_effect = lambda page, **kwargs: self.pages[page]
+        self.ffr.list_transactions.reset_mock()
+        stats = Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0).run()
+        self.assertEqual(1, self.ffr.list_transactions.call_count)
+        self.assertEqual(3, stats['pages'])
+        self.assertEqual(3, stats['matched'])
+
+    def test_failed_group_retried(self):
+        def _flaky_process(new_splits, transaction_data):
+            if transaction_data.id == '11':
+                raise ConnectionError('Firefly went away')
+
+        self.ffr.process_new_splits.side_effect = _flaky_process
+        stats = Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0).run()
+        self.assertEqual((3, 1), (stats['pages'], stats['errors']))
+        with self.checkpoint_path.open() as f:
+            checkpoint = json.load(f)
+        # The run doesn't count as done, and the next one starts again at the page that failed
+        self.assertEqual((1, False), (checkpoint['next_page'], checkpoint['done']))
+
+        self.ffr.process_new_splits.side_effect = None
+        self.ffr.process_new_splits.reset_mock()
+        Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0).run()
+        self.assertIn('11', [x.kwargs['transaction_data'].id for x in self.ffr.process_new_splits.call_args_list])
+        with self.checkpoint_path.open() as f:
+            self.assertTrue(json.load(f)['done'])
+
+    def test_dry_run(self):
+        backfiller = Backfiller(ffr_core=self.ffr, checkpoint_path=self.checkpoint_path, rate=0, dry_run=True)
+        stats = backfiller.run()
+        self.assertEqual(3, stats['matched'])
+        self.assertEqual(0, stats['created'])
+        self.ffr.process_new_splits.assert_not_called()
+
+
+if __name__ == '__main__':
+    main()
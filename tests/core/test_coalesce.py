@@ -0,0 +1,63 @@
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.coalesce import WebhookCoalescer
+from ffrelay.core.payload import TransactionEvent
+from tests.mocks.transaction import make_new_transaction_event
+
+
+def make_update(tid: int, amount: str, updated_at: str) -> TransactionEvent:
+    data = make_new_transaction_event(txs=[{'amount': amount, 'tags': ['something-p50']}], tid=tid)
+    data['content']['updated_at'] = updated_at
+    return TransactionEvent.from_webhook(data)
+
+
+class TestWebhookCoalescer(TestCase):
+
+    def setUp(self) -> None:
+        self.handled = []
+        self.coalescer = WebhookCoalescer(handler=self._handler, window_secs=0.1)
+        self.coalescer.start()
+        self.addCleanup(self.coalescer.shutdown)
+
+    def _handler(self, event, is_new):
+        self.handled.append((event.id, event.transactions[0].amount, is_new))
+
+    def _wait_flushed(self, n: int):
+        deadline = time.monotonic() + 5
+        while len(self.handled) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_burst_keeps_latest(self):
+        self.assertFalse(self.coalescer.submit(make_update(5, '1.00', '2024-06-24T12:00:00-05:00'), is_new=False))
+        self.assertTrue(self.coalescer.submit(make_update(5, '2.00', '2024-06-24T12:00:01-05:00'), is_new=False))
+        self.assertTrue(self.coalescer.submit(make_update(5, '3.00', '2024-06-24T12:00:02-05:00'), is_new=False))
+        self.coalescer.submit(make_update(6, '9.00', '2024-06-24T12:00:00-05:00'), is_new=False)
+        self._wait_flushed(2)
+        self.assertCountEqual([(5, '3.00', False), (6, '9.00', False)], self.handled)
+        stats = self.coalescer.stats()
+        self.assertEqual(4, stats['submitted'])
+        self.assertEqual(2, stats['merged'])
+        self.assertEqual(2, stats['flushed'])
+        self.assertEqual(0, stats['pending'])
+
+    def test_out_of_order_ignored(self):
+        self.coalescer.submit(make_update(5, '2.00', '2024-06-24T12:00:02-05:00'), is_new=False)
+        self.coalescer.submit(make_update(5, '1.00', '2024-06-24T12:00:01-05:00'), is_new=False)
+        self._wait_flushed(1)
+        self.assertEqual([(5, '2.00', False)], self.handled)
+        self.assertEqual(1, self.coalescer.stats()['out_of_order'])
+
+    def test_shutdown_flushes(self):
+        coalescer = WebhookCoalescer(handler=self._handler, window_secs=60)
+        coalescer.start()
+        coalescer.submit(make_update(7, '1.00', '2024-06-24T12:00:00-05:00'), is_new=False)
+        coalescer.shutdown(timeout=5)
+        self.assertEqual([(7, '1.00', False)], self.handled)
+
+
+if __name__ == '__main__':
+    main()
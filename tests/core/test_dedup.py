@@ -0,0 +1,108 @@
+import pathlib
+import tempfile
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.dedup import (
+    DedupStore,
+    MemoryDedupStore,
+    SqliteDedupStore,
+    make_dedup_store,
+)
+
+
+class TestDedupStore(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.props = {
+            'dedup-backend': 'sqlite',
+            'dedup-path': str(pathlib.Path(tmp_dir.name).joinpath('dedup.db')),
+        }
+
+    def test_memory(self):
+        store = make_dedup_store({}, namespace='new')
+        self.assertIsInstance(store, MemoryDedupStore)
+        self.assertTrue(store.add(123))
+        self.assertFalse(store.add('123'))
+        self.assertIn(123, store)
+        self.assertNotIn(124, store)
+        store.discard(123)
+        self.assertNotIn(123, store)
+        stats = store.stats()
+        self.assertEqual(0, stats['size'])
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+
+    def test_memory_lru(self):
+        store = make_dedup_store({'dedup-max-size': '3'}, namespace='new')
+        for tx_id in range(3):
+            store.add(tx_id)
+        # Touch 0 so 1 becomes least recently used
+        self.assertIn(0, store)
+        store.add(3)
+        self.assertEqual(3, len(store))
+        self.assertNotIn(1, store)
+        self.assertIn(0, store)
+        self.assertEqual(1, store.stats()['evicted'])
+
+    def test_memory_ttl(self):
+        store = make_dedup_store({'dedup-updated-ttl-secs': '0.05'}, namespace='updated')
+        self.assertEqual(0.05, store.ttl_secs)
+        # New transactions keep the long default
+        self.assertEqual(86400, make_dedup_store({}, namespace='new').ttl_secs)
+        self.assertTrue(store.add(9))
+        self.assertFalse(store.add(9))
+        time.sleep(0.1)
+        # A later edit of the same transaction goes through again
+        self.assertTrue(store.add(9))
+        self.assertEqual(1, store.stats()['expired'])
+
+    def test_sqlite_shared(self):
+        # Two stores on the same file stand in for two gunicorn workers
+        worker_a = make_dedup_store(self.props, namespace='new')
+        worker_b = make_dedup_store(self.props, namespace='new')
+        other_ns = make_dedup_store(self.props, namespace='updated')
+        self.assertIsInstance(worker_a, SqliteDedupStore)
+
+        self.assertTrue(worker_a.add(55))
+        self.assertIn(55, worker_b)
+        self.assertFalse(worker_b.add(55))
+        self.assertNotIn(55, other_ns)
+        self.assertEqual(1, len(worker_b))
+        self.assertEqual(2, worker_b.stats()['hits'])
+
+    def test_sqlite_ttl(self):
+        store = make_dedup_store({**self.props, 'dedup-ttl-secs': '0.05'}, namespace='new')
+        self.assertTrue(store.add(7))
+        self.assertIn(7, store)
+        time.sleep(0.1)
+        self.assertNotIn(7, store)
+        # An expired id can be claimed again
+        self.assertTrue(store.add(7))
+        time.sleep(0.1)
+        self.assertEqual(1, store.purge_expired())
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            make_dedup_store({'dedup-backend': 'redis'}, namespace='new')
+
+    def test_backend_interface(self):
+        # A backend missing any of the storage methods can't be made
+        with self.assertRaises(TypeError):
+            DedupStore(namespace='new')
+
+        class _Partial(DedupStore):
+            def _contains(self, key: str) -> bool:
+                return False
+
+        with self.assertRaises(TypeError):
+            _Partial(namespace='new')
+
+
+if __name__ == '__main__':
+    main()
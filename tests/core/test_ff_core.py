@@ -7,8 +7,10 @@ from unittest import (
 from unittest.mock import MagicMock
 
 from pukr import get_logger
+from requests.exceptions import ConnectionError as RequestsConnectionError
 
 from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.resilience import CircuitOpenError
 from tests.common import (
     make_patcher,
     random_string,
@@ -37,11 +39,138 @@ class TestFFRCore(TestCase):
         }
 
         self.ffr = FireFlyRelayCore(props=self.props)
+        self.ffr.retry_policy.base_delay = 0.001
 
     def test_init(self):
 
         self.assertDictEqual(self.props, self.ffr.props)
 
+    def test_session_shared(self):
+        self.mock_req.Session.return_value.request.return_value.json.return_value = {'data': {'id': 1}}
+        self.ffr.get_transaction(1)
+        self.ffr.get_transaction(2)
+        # Both calls go through the one session built at init
+        self.mock_req.Session.assert_called_once()
+        session = self.mock_req.Session.return_value
+        self.assertEqual(2, session.request.call_count)
+        _, kwargs = session.request.call_args
+        self.assertEqual(self.ffr.timeout, kwargs['timeout'])
+        self.assertEqual(2, self.ffr.pool_stats()['requests_sent'])
+
+    def test_session_props(self):
+        props = {**self.props, 'token': 'hello-token', 'http-read-timeout': '12', 'http-pool-size': '4'}
+        ffr = FireFlyRelayCore(props=props)
+        stats = ffr.pool_stats()
+        self.assertEqual(12.0, stats['timeout']['read'])
+        self.assertEqual(4, stats['pool_maxsize'])
+
+    def test_overload_backs_off(self):
+        resp = self.mock_req.Session.return_value.request.return_value
+        resp.status_code = 429
+        resp.headers = {'Retry-After': '0.01'}
+        resp.raise_for_status.side_effect = RuntimeError('429 Too Many Requests')
+        limit_before = self.ffr.concurrency.limit
+        with self.assertRaises(RuntimeError):
+            self.ffr.get_transaction(1)
+        self.assertLess(self.ffr.concurrency.limit, limit_before)
+        # GETs are retried
+        self.assertEqual(self.ffr.retry_policy.max_attempts, resp.raise_for_status.call_count)
+        # The next call waits out the Retry-After
+        self.assertGreater(self.ffr.rate_limiter.acquire(), 0.0)
+
+    def test_retry_idempotent_only(self):
+        session = self.mock_req.Session.return_value
+        resp = session.request.return_value
+        resp.status_code = 200
+        resp.json.return_value = {'data': {'id': 3}}
+        # One dropped connection, then OK
+        session.request.side_effect = [RequestsConnectionError('reset'), resp]
+        self.assertDictEqual({'id': 3}, self.ffr.get_transaction(3))
+        self.assertEqual(1, self.ffr.retry_policy.stats()['retries'])
+
+        session.request.side_effect = [RequestsConnectionError('reset'), resp]
+        with self.assertRaises(RequestsConnectionError):
+            self.ffr._post('/transactions', data={})
+
+    def test_circuit_breaker(self):
+        session = self.mock_req.Session.return_value
+        session.request.side_effect = RequestsConnectionError('down')
+        self.ffr.retry_policy.max_attempts = 1
+        for _ in range(self.ffr.breaker.failure_threshold):
+            with self.assertRaises(RequestsConnectionError):
+                self.ffr.get_transaction(1)
+        calls_made = session.request.call_count
+        with self.assertRaises(CircuitOpenError):
+            self.ffr.get_transaction(1)
+        # Failed fast - Firefly wasn't called
+        self.assertEqual(calls_made, session.request.call_count)
+        self.assertEqual('open', self.ffr.breaker.stats()['state'])
+
+    def test_new_transaction_resumes(self):
+        session = self.mock_req.Session.return_value
+        resp = session.request.return_value
+        resp.status_code = 200
+        resp.json.return_value = {'data': {'id': '700'}}
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}])
+        new_txs = self.ffr.handle_incoming_transaction_data(data=tx_event, is_new=True)
+        self.ffr.retry_policy.max_attempts = 1
+
+        # POST goes through, the PUT linking it back doesn't
+        session.request.side_effect = [resp, RequestsConnectionError('reset')]
+        with self.assertRaises(RequestsConnectionError):
+            self.ffr.process_new_splits(new_splits=new_txs, transaction_data=tx_event['content'])
+        self.assertEqual(1, self.ffr.link_index.stats()['unlinked'])
+
+        # Next time round, only the PUT is made
+        session.request.side_effect = None
+        session.request.reset_mock()
+        self.ffr.process_new_splits(new_splits=new_txs, transaction_data=tx_event['content'])
+        self.assertEqual(1, session.request.call_count)
+        method, url = session.request.call_args[0]
+        self.assertEqual('PUT', method)
+        self.assertIn('/show/700', session.request.call_args[1]['json']['transactions'][0]['notes'])
+        self.assertEqual(0, self.ffr.link_index.stats()['unlinked'])
+
+        # The original transaction's next webhook is known to be an update without reading its notes
+        new_txs = self.ffr.handle_incoming_transaction_data(data=tx_event, is_new=False)
+        self.assertTrue(new_txs[0]['is_update'])
+        self.assertEqual('700', new_txs[0]['org_tx']['prop_tx_id'])
+
+    def test_update_served_from_cache(self):
+        session = self.mock_req.Session.return_value
+        resp = session.request.return_value
+        resp.status_code = 200
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36'], 'amount': '100.00'}], tid=50)
+        resp.json.return_value = {'data': {'id': '700', 'attributes': {'transactions': [{
+            'transaction_journal_id': 900,
+            # As Firefly keeps it
+            'amount': '36.000000000000',
+            'notes': 'From tx: https://example.com/transactions/show/50',
+        }]}}}
+        self.ffr.process_event(data=tx_event, is_new=True)
+        self.assertEqual(1, len(self.ffr.prop_cache))
+
+        # Firefly sends the update webhook; the amount hasn't changed as far as this worker knows,
+        #   but another one may have changed it since - so it's checked, and left alone
+        tx_event['content']['transactions'][0]['notes'] = 'Proportion tx: https://example.com/transactions/show/700'
+        session.request.reset_mock()
+        self.assertEqual(1, self.ffr.process_event(data=tx_event, is_new=False))
+        self.assertEqual(['GET'], [x[0][0] for x in session.request.call_args_list])
+
+        # The amount changes: a PUT, but no GET
+        session.request.reset_mock()
+        tx_event['content']['transactions'][0]['amount'] = '200.00'
+        self.ffr.process_event(data=tx_event, is_new=False)
+        self.assertEqual(1, session.request.call_count)
+        self.assertEqual('PUT', session.request.call_args[0][0])
+        self.assertEqual('72.00', self.ffr.prop_cache.get('700').splits[0].amount)
+
+        # With no other worker writing, an unchanged amount is settled from the cache
+        self.ffr.prop_cache.sole_writer = True
+        session.request.reset_mock()
+        self.ffr.process_event(data=tx_event, is_new=False)
+        session.request.assert_not_called()
+
     def test_handle_new_single_transaction_data(self):
         tx_info_list = [{'tags': ['something-p36']}]
         tx_event = make_new_transaction_event(txs=tx_info_list)
@@ -62,12 +191,129 @@ class TestFFRCore(TestCase):
         self.assertEqual(len(tx_info_list), len(new_txs))
         for new_tx in new_txs:
             self.assertTrue(new_tx['is_update'])
-            self.assertIn(new_tx['org_tx']['id'], self.ffr.updated_txs)
+            self.assertTrue(self.ffr.is_seen(new_tx['org_tx']['id'], is_new=False,
+                                             updated_at=tx_event['content']['updated_at']))
             # original transaction info
             org_tx = new_tx['org_tx']
             tx = tx_event['content']['transactions'][0]
             self.assertEqual(str(tx['transaction_journal_id']), org_tx['tx_jrnl_id'])
 
+    def test_update_dedup_per_edit(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=45)
+        updated_at = tx_event['content']['updated_at']
+        self.assertTrue(self.ffr.mark_seen(45, is_new=False, updated_at=updated_at))
+        # The same edit delivered again is skipped...
+        self.assertFalse(self.ffr.mark_seen(45, is_new=False, updated_at=updated_at))
+        # ...a later edit of the transaction isn't, however soon it comes
+        self.assertFalse(self.ffr.is_seen(45, is_new=False, updated_at='2024-06-24T12:34:41-05:00'))
+        self.assertTrue(self.ffr.mark_seen(45, is_new=False, updated_at='2024-06-24T12:34:41-05:00'))
+        self.ffr.release(45, is_new=False, updated_at=updated_at)
+        self.assertTrue(self.ffr.mark_seen(45, is_new=False, updated_at=updated_at))
+        # New transactions are seen once, whatever their update time
+        self.assertTrue(self.ffr.mark_seen(45, is_new=True, updated_at=updated_at))
+        self.assertFalse(self.ffr.mark_seen(45, is_new=True, updated_at='2024-06-24T12:34:41-05:00'))
+
+    def test_failed_event_released(self):
+        self.mock_req.Session.return_value.request.side_effect = ValueError('nope')
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=46)
+        updated_at = tx_event['content']['updated_at']
+        self.assertTrue(self.ffr.mark_seen(46, is_new=True, updated_at=updated_at))
+        with self.assertRaises(ValueError):
+            self.ffr.process_accepted(data=tx_event, is_new=True)
+        # Firefly's redelivery isn't taken for a duplicate
+        self.assertFalse(self.ffr.is_seen(46, is_new=True, updated_at=updated_at))
+
+    def test_own_updates_seen(self):
+        resp = self.mock_req.Session.return_value.request.return_value
+        resp.status_code = 200
+        resp.json.return_value = {'data': {'id': '45', 'attributes': {'updated_at': '2024-06-24T12:40:00-05:00',
+                                                                      'transactions': []}}}
+        self.ffr.update_transaction(45, transactions=[{'transaction_journal_id': '10', 'notes': 'Proportion tx'}])
+        # The edit our own write made isn't one to handle
+        self.assertTrue(self.ffr.is_seen(45, is_new=False, updated_at='2024-06-24T12:40:00-05:00'))
+        self.assertEqual(1, len(self.ffr.updated_txs))
+
+    def test_handle_tag_rule_accounts(self):
+        ffr = FireFlyRelayCore(props={**self.props, 'token': 'hello-token', 'tag-rules': 'rent:p=50:dest=77'})
+        tx_info_list = [{'tags': ['rent'], 'amount': '100.00'}, {'tags': ['untagged']}]
+        tx_event = make_new_transaction_event(txs=tx_info_list)
+
+        new_txs = ffr.handle_incoming_transaction_data(data=tx_event, is_new=True)
+        self.assertEqual(1, len(new_txs))
+        new_tx = new_txs[0]['new_tx']
+        self.assertEqual('50.00', new_tx['amount'])
+        self.assertEqual('77', new_tx['dest_acct_id'])
+        self.assertEqual(DEFAULT_SOURCE_ID, new_tx['source_acct_id'])
+
+    def test_plan_events(self):
+        events = [
+            make_new_transaction_event(txs=[{'tags': ['a-p50'], 'amount': '1.15'}], tid=60),
+            make_new_transaction_event(txs=[{'tags': ['groceries']}], tid=61),
+            make_new_transaction_event(txs=[{'tags': ['a-p33', 'b-p10'], 'amount': '10.00'}], tid=62),
+        ]
+        plans = self.ffr.plan_events(events, is_new=True, mark_seen=False)
+        # One plan per group, in order - rounded half-up to the cent (float rounding gives 0.57 for the first)
+        self.assertEqual([['0.58'], [], ['3.30', '1.00']], [[x['new_tx']['amount'] for x in p] for p in plans])
+        self.assertEqual([62, 62], [x['org_tx']['id'] for x in plans[2]])
+        self.assertEqual(plans[0], self.ffr.handle_incoming_transaction_data(data=events[0], is_new=True,
+                                                                             mark_seen=False))
+
+    def test_plan_tag_added(self):
+        self.ffr.link_index.add(orig_tx_id=63, journal_id=630, split_index=0, prop_tx_id=800, tag='a-p50')
+        event = make_new_transaction_event(txs=[{'tjid': 630, 'tags': ['a-p50', 'b-p10'], 'amount': '10.00'}],
+                                           tid=63)
+        plan, = self.ffr.plan_events([event], is_new=False, mark_seen=False)
+        # The newly added tag gets a proportional transaction of its own, rather than editing the other tag's
+        self.assertEqual([(True, '800'), (False, None)], [(x['is_update'], x['org_tx']['prop_tx_id']) for x in plan])
+        # A link from before tags were recorded still stands in for any of them
+        self.ffr.link_index.remove(800)
+        self.ffr.link_index.add(orig_tx_id=63, journal_id=630, split_index=0, prop_tx_id=801)
+        plan, = self.ffr.plan_events([event], is_new=False, mark_seen=False)
+        self.assertEqual(['801', '801'], [x['org_tx']['prop_tx_id'] for x in plan])
+
+    def test_batched_splits(self):
+        ffr = FireFlyRelayCore(props={**self.props, 'token': 'hello-token', 'batch-splits': 'true'})
+        session = self.mock_req.Session.return_value
+        resp = session.request.return_value
+        resp.status_code = 200
+        resp.json.return_value = {'data': {'id': '700', 'attributes': {'transactions': [{
+            'transaction_journal_id': 900 + i,
+            'order': i,
+            'amount': amount,
+            'notes': 'From tx: https://example.com/transactions/show/50',
+        } for i, amount in enumerate(['50.000000000000', '25.000000000000', '10.000000000000'])]}}}
+        tx_info_list = [{'tjid': 10 + i, 'tags': [f'shared-p{p}'], 'amount': '100.00'}
+                        for i, p in enumerate([50, 25, 10])]
+        tx_event = make_new_transaction_event(txs=tx_info_list, tid=50)
+        self.assertEqual(3, ffr.process_event(data=tx_event, is_new=True))
+
+        # One POST with all three splits, one PUT linking them all
+        self.assertEqual(['POST', 'PUT'], [x[0][0] for x in session.request.call_args_list])
+        self.assertEqual(3, len(session.request.call_args_list[0][1]['json']['transactions']))
+        put_splits = session.request.call_args_list[1][1]['json']['transactions']
+        self.assertTrue(all(x['notes'].endswith('/transactions/show/700') for x in put_splits))
+        self.assertEqual(0, ffr.link_index.stats()['unlinked'])
+
+        # The second split's amount changes - one PUT from the cache, changing only its proportional split
+        tx_event['content']['transactions'][1]['amount'] = '200.00'
+        session.request.reset_mock()
+        ffr.process_event(data=tx_event, is_new=False)
+        self.assertEqual(['PUT'], [x[0][0] for x in session.request.call_args_list])
+        put_splits = session.request.call_args_list[0][1]['json']['transactions']
+        self.assertEqual([{'transaction_journal_id': '900'}, {'transaction_journal_id': '901', 'amount': '50.00'},
+                          {'transaction_journal_id': '902'}], put_splits)
+
+        # After a restart the prop journal ids are unknown - the splits are told apart by their order
+        restarted = FireFlyRelayCore(props={**self.props, 'token': 'hello-token', 'batch-splits': 'true'})
+        for tx in tx_event['content']['transactions']:
+            tx['notes'] = 'Proportion tx: https://example.com/transactions/show/700'
+        session.request.reset_mock()
+        restarted.process_event(data=tx_event, is_new=False)
+        self.assertEqual(['GET', 'PUT'], [x[0][0] for x in session.request.call_args_list])
+        put_splits = session.request.call_args_list[1][1]['json']['transactions']
+        self.assertEqual([{'transaction_journal_id': '900'}, {'transaction_journal_id': '901', 'amount': '50.00'},
+                          {'transaction_journal_id': '902'}], put_splits)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,124 @@
+import pathlib
+import tempfile
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.journal import (
+    DONE,
+    FAILED,
+    PENDING,
+    JobJournal,
+    _process_started,
+    make_job_key,
+)
+from ffrelay.core.webhook_queue import WebhookQueue
+from tests.mocks.transaction import make_new_transaction_event
+
+# Well above any real pid_max, so never alive
+DEAD_PID = 2 ** 30
+
+
+class TestJobJournal(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name).joinpath('jobs.db')
+        self.journal = JobJournal(path=self.path, checkpoint_every=2)
+
+    def _orphan_pending(self):
+        """Makes the pending jobs look as if they belonged to a worker that died"""
+        self.journal.conn.execute('UPDATE jobs SET owner_pid = ?', (DEAD_PID, ))
+
+    def test_record_duplicate(self):
+        event = make_new_transaction_event()
+        key = make_job_key(event, is_new=True)
+        self.assertTrue(self.journal.record(job_key=key, data=event, is_new=True))
+        self.assertFalse(self.journal.record(job_key=key, data=event, is_new=True))
+        # The update webhook for the same transaction is its own job
+        self.assertNotEqual(key, make_job_key(event, is_new=False))
+        self.assertDictEqual({PENDING: 1}, self.journal.stats())
+
+    def test_claim_and_complete(self):
+        event = make_new_transaction_event(tid=12)
+        key = make_job_key(event, is_new=False)
+        self.journal.record(job_key=key, data=event, is_new=False)
+        # Jobs owned by a live worker (us) aren't claimed
+        self.assertListEqual([], self.journal.claim_pending())
+        self._orphan_pending()
+
+        # Another worker (re)opening the same file picks it up
+        other = JobJournal(path=self.path)
+        claimed = other.claim_pending()
+        self.assertEqual(1, len(claimed))
+        claimed_key, data, is_new = claimed[0]
+        self.assertEqual(key, claimed_key)
+        self.assertEqual(12, data['content']['id'])
+        self.assertFalse(is_new)
+        # Claimed once only
+        self.assertListEqual([], other.claim_pending())
+
+        other.complete(job_key=key)
+        self.assertDictEqual({DONE: 1}, other.stats())
+
+    def test_failed_taken_again(self):
+        event = make_new_transaction_event(tid=13)
+        key = make_job_key(event, is_new=True)
+        self.journal.record(job_key=key, data=event, is_new=True)
+        self.journal.complete(job_key=key, ok=False)
+        self.assertDictEqual({FAILED: 1}, self.journal.stats())
+        # The payload is kept for a failed job...
+        payload, = self.journal.conn.execute('SELECT payload FROM jobs WHERE job_key = ?', (key, )).fetchone()
+        self.assertIsNotNone(payload)
+        # ...and Firefly's redelivery is accepted, not refused as a duplicate
+        self.assertTrue(self.journal.record(job_key=key, data=event, is_new=True))
+        self.assertDictEqual({PENDING: 1}, self.journal.stats())
+        self.journal.complete(job_key=key)
+        self.assertFalse(self.journal.record(job_key=key, data=event, is_new=True))
+        self.assertDictEqual({DONE: 1}, self.journal.stats())
+
+    def test_claim_recycled_pid(self):
+        if _process_started(1) is None:
+            self.skipTest('No /proc to read process start times from')
+        event = make_new_transaction_event(tid=14)
+        self.journal.record(job_key=make_job_key(event, is_new=True), data=event, is_new=True)
+        # The owner's pid is alive (ours), but belongs to a process that started later than the owner
+        self.journal.conn.execute('UPDATE jobs SET owner_started = owner_started - 1')
+        claimed = JobJournal(path=self.path).claim_pending()
+        self.assertEqual([14], [x[1]['content']['id'] for x in claimed])
+
+    def test_compact(self):
+        self.journal.retention_secs = -1
+        for i in range(3):
+            event = make_new_transaction_event(tid=i)
+            key = make_job_key(event, is_new=True)
+            self.journal.record(job_key=key, data=event, is_new=True)
+            if i < 2:
+                self.journal.complete(job_key=key)
+        self.assertEqual(2, self.journal.compact())
+        self.assertDictEqual({PENDING: 1}, self.journal.stats())
+
+    def test_queue_replay(self):
+        handled = []
+        events = [make_new_transaction_event(tid=i) for i in range(3)]
+        for event in events:
+            self.journal.record(job_key=make_job_key(event, is_new=True), data=event, is_new=True)
+        self._orphan_pending()
+
+        wqueue = WebhookQueue(handler=lambda data, is_new: handled.append(data['content']['id']),
+                              journal=JobJournal(path=self.path))
+        wqueue.start()
+        wqueue.replay_journal().join(timeout=5)
+        # A retried delivery of a replayed webhook isn't queued again
+        self.assertTrue(wqueue.submit(data=events[0], is_new=True))
+        self.assertTrue(wqueue.shutdown(timeout=5))
+        self.assertCountEqual([0, 1, 2], handled)
+        self.assertEqual(3, wqueue.stats()['replayed'])
+        self.assertEqual(1, wqueue.stats()['duplicates'])
+        self.assertDictEqual({DONE: 3}, JobJournal(path=self.path).stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import pathlib
+import tempfile
+from unittest import (
+    TestCase,
+    main,
+)
+from unittest.mock import MagicMock
+
+from ffrelay.core.link_index import LinkIndex
+
+
+class TestLinkIndex(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = pathlib.Path(tmp_dir.name).joinpath('links.db')
+
+    def test_lookups(self):
+        index = LinkIndex()
+        index.add(orig_tx_id=10, journal_id=100, split_index=0, prop_tx_id=20, tag='rent')
+        index.add(orig_tx_id=10, journal_id=100, split_index=0, prop_tx_id=21, tag='groceries', linked=False)
+        self.assertEqual(['20', '21'], [x.prop_tx_id for x in index.links_for('10', '100')])
+        self.assertEqual([], index.links_for(10, 101))
+        self.assertEqual('10', index.orig_for(21).orig_tx_id)
+        self.assertEqual('21', index.unlinked_for(10, 100, tag='groceries'))
+        self.assertIsNone(index.unlinked_for(10, 100, tag='rent'))
+        index.mark_linked(21)
+        self.assertIsNone(index.unlinked_for(10, 100, tag='groceries'))
+        index.remove(20)
+        self.assertIsNone(index.orig_for(20))
+        self.assertDictEqual({'links': 1, 'unlinked': 0, 'persistent': False}, index.stats())
+
+    def test_survives_restart(self):
+        index = LinkIndex(path=self.path)
+        index.add(orig_tx_id=10, journal_id=100, split_index=1, prop_tx_id=20, linked=False)
+        index.conn.close()
+
+        index = LinkIndex(path=self.path)
+        entry = index.orig_for(20)
+        self.assertEqual(('10', '100', 1), (entry.orig_tx_id, entry.journal_id, entry.split_index))
+        self.assertFalse(entry.linked)
+
+    def test_shared_between_workers(self):
+        index_a = LinkIndex(path=self.path)
+        index_b = LinkIndex(path=self.path)
+        index_a.add(orig_tx_id=10, journal_id=100, split_index=0, prop_tx_id=20)
+        self.assertEqual('20', index_b.links_for(10, 100)[0].prop_tx_id)
+        # Already holding links for the split doesn't hide the ones written (or removed) since
+        index_a.add(orig_tx_id=10, journal_id=100, split_index=0, prop_tx_id=21, tag='rent')
+        self.assertEqual(['20', '21'], [x.prop_tx_id for x in index_b.links_for(10, 100)])
+        index_a.remove(20)
+        self.assertEqual(['21'], [x.prop_tx_id for x in index_b.links_for(10, 100)])
+
+    def test_rebuild(self):
+        ffr_core = MagicMock()
+        ffr_core.iter_transaction_pages.return_value = [(1, 1, [
+            {'id': '10', 'attributes': {'transactions': [
+                {'transaction_journal_id': 100, 'notes': 'Proportion tx: https://ff.local/transactions/show/20\n'
+                                                         'Proportion tx: https://ff.local/transactions/show/21'},
+                {'transaction_journal_id': 101, 'notes': None},
+            ]}},
+            # A proportional transaction links the other way - not indexed
+            {'id': '20', 'attributes': {'transactions': [
+                {'transaction_journal_id': 200, 'notes': 'From tx: https://ff.local/transactions/show/10'},
+            ]}},
+        ])]
+        index = LinkIndex()
+        index.add(orig_tx_id=10, journal_id=100, split_index=0, prop_tx_id=20, tag='rent', prop_journal_id=300)
+        self.assertEqual(2, index.rebuild(ffr_core))
+        # A link already known keeps its tag (and journal id), rather than gaining an untagged twin
+        self.assertEqual([('20', 'rent', '300'), ('21', None, None)],
+                         [(x.prop_tx_id, x.tag, x.prop_journal_id) for x in index.links_for(10, 100)])
+        self.assertIsNone(index.orig_for(10))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import json
+import pathlib
+import tempfile
+from unittest import (
+    TestCase,
+    main,
+)
+
+from loguru import logger
+
+from ffrelay.core.log_sink import QueuedJsonSink
+from ffrelay.core.tracing import Tracer
+
+
+class TestQueuedJsonSink(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = pathlib.Path(tmp_dir.name)
+        self.path = self.dir.joinpath('logs', 'ffrelay.jsonl')
+        self.sink = QueuedJsonSink(path=self.path, batch_size=3, flush_secs=0.05)
+        self.handler_id = logger.add(self.sink, level='INFO', format='{message}')
+        self.addCleanup(logger.remove, self.handler_id)
+
+    def read_lines(self):
+        return [json.loads(x) for x in self.path.read_text().splitlines()]
+
+    def test_written_in_batches(self):
+        self.sink.start()
+        for i in range(7):
+            logger.info('Message {}', i)
+        logger.debug('Below the level')
+        self.sink.shutdown()
+        lines = self.read_lines()
+        self.assertEqual([f'Message {i}' for i in range(7)], [x['message'] for x in lines])
+        self.assertEqual('INFO', lines[0]['level'])
+        self.assertEqual('test_written_in_batches', lines[0]['function'])
+        stats = self.sink.stats()
+        self.assertEqual(7, stats['written'])
+        self.assertGreaterEqual(stats['batches'], 3)
+
+    def test_request_id_and_exception(self):
+        tracer = Tracer()
+        tracer.configure(path=self.dir.joinpath('trace.json'))
+        self.sink.start()
+        with tracer.span('root', request_id='req-9'):
+            try:
+                raise ValueError('bad split')
+            except ValueError:
+                logger.exception('Failed')
+        self.sink.shutdown()
+        line = self.read_lines()[0]
+        self.assertEqual('req-9', line['request_id'])
+        self.assertIn('ValueError: bad split', line['exception'])
+
+    def test_full_queue_drops(self):
+        sink = QueuedJsonSink(path=self.path, max_size=2)
+        handler_id = logger.add(sink, level='INFO', format='{message}')
+        # Not started - nothing drains the queue
+        for i in range(5):
+            logger.info('Message {}', i)
+        logger.remove(handler_id)
+        self.assertEqual(3, sink.stats()['dropped'])
+        self.assertEqual(2, sink.stats()['queued'])
+
+
+if __name__ == '__main__':
+    main()
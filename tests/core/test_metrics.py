@@ -0,0 +1,79 @@
+import json
+import pathlib
+import tempfile
+import threading
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.ff_core import endpoint_label
+from ffrelay.core.metrics import MetricsRegistry
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self) -> None:
+        self.registry = MetricsRegistry()
+        self.counter = self.registry.counter('test_total', 'Things', labelnames=('kind', ))
+        self.gauge = self.registry.gauge('test_in_flight', 'In flight')
+        self.hist = self.registry.histogram('test_seconds', 'Durations', labelnames=('stage', ), buckets=(0.1, 1.0))
+
+    def test_threads_add_up(self):
+        def _work():
+            for _ in range(1000):
+                self.counter.inc(kind='a')
+
+        threads = [threading.Thread(target=_work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.counter.inc(2, kind='b')
+        # Shards of the exited threads are kept
+        self.assertDictEqual({('a', ): 4000.0, ('b', ): 2.0}, self.counter.collect())
+        self.assertDictEqual({('a', ): 4000.0, ('b', ): 2.0}, self.counter.collect())
+
+    def test_render(self):
+        self.counter.inc(kind='a"b')
+        self.gauge.inc()
+        self.gauge.inc()
+        self.gauge.dec()
+        for val in (0.05, 0.1, 0.5, 3.0):
+            self.hist.observe(val, stage='parse')
+        text = self.registry.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{kind="a\\"b"} 1', text)
+        self.assertIn('test_in_flight 1', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="1.0"} 3', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="+Inf"} 4', text)
+        self.assertIn('test_seconds_count{stage="parse"} 4', text)
+        self.assertIn('test_seconds_sum{stage="parse"} 3.65', text)
+
+    def test_multiprocess(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        path = pathlib.Path(tmp_dir.name)
+        self.registry.path = path
+        self.counter.inc(kind='a')
+        self.gauge.inc()
+        # Another worker that's still running, and one that has exited
+        other = {'test_total': [[['a'], 2.0]], 'test_in_flight': [[[], 3.0]], 'test_seconds': []}
+        path.joinpath('metrics-1.json').write_text(json.dumps(other))
+        path.joinpath('metrics-999999999.json').write_text(json.dumps(other))
+        collected = self.registry.collect_all()
+        self.assertEqual(5.0, collected['test_total'][('a', )])
+        self.assertEqual(4.0, collected['test_in_flight'][()])
+        # The exited worker's counters are folded into one file, and still count
+        self.assertFalse(path.joinpath('metrics-999999999.json').exists())
+        self.assertEqual(5.0, self.registry.collect_all()['test_total'][('a', )])
+
+    def test_endpoint_label(self):
+        self.assertEqual('/transactions/{id}', endpoint_label('/transactions/1234'))
+        self.assertEqual('/transactions', endpoint_label('/transactions?page=2&limit=100'))
+        self.assertEqual('/tags/rent-p50/transactions', endpoint_label('/tags/rent-p50/transactions?page=1'))
+
+
+if __name__ == '__main__':
+    main()
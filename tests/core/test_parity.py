@@ -0,0 +1,313 @@
+"""The same checks, run against the sync core & Flask routes and the async core & ASGI app"""
+import asyncio
+import json
+import time
+from typing import (
+    Dict,
+    Tuple,
+)
+from unittest import (
+    TestCase,
+    main,
+    skipIf,
+)
+
+from flask import Flask
+from loguru import logger
+
+from benchmarks.fake_firefly import FakeFirefly
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.routes.helpers import (
+    log_after,
+    log_before,
+    track_teardown,
+)
+from ffrelay.routes.main import bp_main
+from ffrelay.routes.transaction import bp_trans
+from tests.mocks.transaction import (
+    DEFAULT_DEST_ID,
+    DEFAULT_SOURCE_ID,
+    make_new_transaction_event,
+)
+
+try:
+    import httpx
+
+    from ffrelay.asgi import RelayASGIApp
+    from ffrelay.core.async_core import AsyncFireFlyRelayCore
+except ImportError:
+    httpx = None
+
+
+class _FakeFireflyCase:
+    """A core talking to a fake Firefly. The driver mixins say how to make & call the core"""
+
+    def setUp(self) -> None:
+        self.fake = FakeFirefly()
+        self.base_url = self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.props = {
+            'ff-base-url': self.base_url,
+            'token': 'hello-token',
+            'owe-acct-id': DEFAULT_DEST_ID,
+            'inc-acct-id': DEFAULT_SOURCE_ID,
+        }
+        self.core = self.make_core(dict(self.props))
+        self.core.retry_policy.base_delay = 0.001
+        self.addCleanup(self.close_core)
+
+    def make_core(self, props: Dict) -> FireFlyRelayCore:
+        raise NotImplementedError
+
+    def call(self, method: str, **kwargs):
+        raise NotImplementedError
+
+    def close_core(self):
+        raise NotImplementedError
+
+    def process(self, event: Dict, is_new: bool) -> int:
+        return self.call('process_event', data=event, is_new=is_new)
+
+    def group(self, group_id: str) -> Dict:
+        return self.fake.groups[str(group_id)]
+
+    def prop_tx_ids(self):
+        return [x for x, group in self.fake.groups.items() if (group['group_title'] or '').startswith('Prop - ')]
+
+
+class _CoreBehaviour(_FakeFireflyCase):
+    """Webhook handling"""
+
+    def test_untagged(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['groceries']}])
+        self.assertEqual(0, self.process(tx_event, is_new=True))
+        self.assertEqual(0, self.fake.stats()['calls'])
+
+    def test_new_transaction(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36'], 'amount': '100.00'}], tid=50)
+        self.assertEqual(1, self.process(tx_event, is_new=True))
+        self.assertDictEqual({'POST /transactions': 1, 'PUT /transactions/{id}': 1}, self.fake.stats()['by_endpoint'])
+        prop_tx_id, = self.prop_tx_ids()
+        prop_split = self.group(prop_tx_id)['transactions'][0]
+        self.assertEqual('36.00', prop_split['amount'])
+        self.assertEqual('deposit', prop_split['type'])
+        self.assertIn(f'{self.base_url}/transactions/show/50', prop_split['notes'])
+        self.assertEqual(f'Proportion tx: {self.base_url}/transactions/show/{prop_tx_id}',
+                         self.group(50)['transactions'][0]['notes'])
+        self.assertEqual(0, self.core.link_index.stats()['unlinked'])
+
+    def test_two_tags_one_split(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['a-p50', 'b-p25'], 'amount': '100.00'}], tid=51)
+        self.assertEqual(2, self.process(tx_event, is_new=True))
+        prop_tx_ids = self.prop_tx_ids()
+        self.assertEqual(2, len(prop_tx_ids))
+        notes = self.group(51)['transactions'][0]['notes']
+        for prop_tx_id in prop_tx_ids:
+            self.assertIn(f'/transactions/show/{prop_tx_id}', notes)
+
+    def test_batched_splits(self):
+        self.core.batch_splits = True
+        tx_event = make_new_transaction_event(txs=[
+            {'tags': ['a-p50'], 'amount': '10.00'},
+            {'tags': ['b-p50'], 'amount': '20.00'},
+        ], tid=52)
+        self.assertEqual(2, self.process(tx_event, is_new=True))
+        self.assertDictEqual({'POST /transactions': 1, 'PUT /transactions/{id}': 1}, self.fake.stats()['by_endpoint'])
+        prop_tx_id, = self.prop_tx_ids()
+        self.assertEqual(['5.00', '10.00'], [x['amount'] for x in self.group(prop_tx_id)['transactions']])
+
+    def test_update(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36'], 'amount': '100.00'}], tid=53)
+        self.process(tx_event, is_new=True)
+        prop_tx_id, = self.prop_tx_ids()
+        tx_event['content']['transactions'][0]['notes'] = self.group(53)['transactions'][0]['notes']
+        self.fake.calls.clear()
+
+        # Unchanged amount - checked with Firefly, as another worker may have changed it, and left alone
+        self.assertEqual(1, self.process(tx_event, is_new=False))
+        self.assertDictEqual({'GET /transactions/{id}': 1}, self.fake.stats()['by_endpoint'])
+        # ...unless nothing else writes them
+        self.core.prop_cache.sole_writer = True
+        self.fake.calls.clear()
+        self.process(tx_event, is_new=False)
+        self.assertEqual(0, self.fake.stats()['calls'])
+
+        tx_event['content']['transactions'][0]['amount'] = '200.00'
+        self.process(tx_event, is_new=False)
+        self.assertDictEqual({'PUT /transactions/{id}': 1}, self.fake.stats()['by_endpoint'])
+        self.assertEqual('72.00', self.group(prop_tx_id)['transactions'][0]['amount'])
+
+        # Without a cached copy, the proportional transaction is read first
+        self.core.prop_cache.invalidate(prop_tx_id)
+        self.fake.calls.clear()
+        tx_event['content']['transactions'][0]['amount'] = '50.00'
+        self.process(tx_event, is_new=False)
+        self.assertDictEqual({'GET /transactions/{id}': 1, 'PUT /transactions/{id}': 1},
+                             self.fake.stats()['by_endpoint'])
+        self.assertEqual('18.00', self.group(prop_tx_id)['transactions'][0]['amount'])
+
+    def test_retries_overload(self):
+        self.fake.throttle_rate = 1.0
+        self.fake.retry_after = 0.01
+        with self.assertRaises(Exception):
+            self.call('get_transaction', transaction_id=1)
+        self.assertEqual(self.core.retry_policy.max_attempts, self.fake.stats()['calls'])
+        self.assertEqual(self.core.retry_policy.max_attempts - 1, self.core.retry_policy.stats()['retries'])
+        # Nothing's retried for a POST
+        self.fake.calls.clear()
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}])
+        with self.assertRaises(Exception):
+            self.process(tx_event, is_new=True)
+        self.assertEqual(1, self.fake.stats()['calls'])
+
+
+class _SyncDriver:
+
+    def make_core(self, props: Dict) -> FireFlyRelayCore:
+        return FireFlyRelayCore(props=props)
+
+    def call(self, method: str, **kwargs):
+        return getattr(self.core, method)(**kwargs)
+
+    def close_core(self):
+        self.core.close()
+
+
+class _AsyncDriver:
+
+    def make_core(self, props: Dict) -> FireFlyRelayCore:
+        self.loop = asyncio.new_event_loop()
+        return AsyncFireFlyRelayCore(props=props)
+
+    def call(self, method: str, **kwargs):
+        return self.loop.run_until_complete(getattr(self.core, method)(**kwargs))
+
+    def close_core(self):
+        if not self.core.session.is_closed:
+            self.loop.run_until_complete(self.core.aclose())
+        self.loop.close()
+
+
+class TestSyncCore(_SyncDriver, _CoreBehaviour, TestCase):
+
+    def test_update_from_two_workers(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36'], 'amount': '100.00'}], tid=54)
+        self.process(tx_event, is_new=True)
+        prop_tx_id, = self.prop_tx_ids()
+        tx_event['content']['transactions'][0]['notes'] = self.group(54)['transactions'][0]['notes']
+
+        # Another worker handles an edit, leaving this worker's cached copy behind...
+        other = self.make_core(dict(self.props))
+        self.addCleanup(other.close)
+        tx_event['content']['transactions'][0]['amount'] = '200.00'
+        other.process_event(data=tx_event, is_new=False)
+        self.assertEqual('72.00', self.group(prop_tx_id)['transactions'][0]['amount'])
+        # ...then the edit is reverted here, back to the amount this worker has cached
+        tx_event['content']['transactions'][0]['amount'] = '100.00'
+        self.process(tx_event, is_new=False)
+        self.assertEqual('36.00', self.group(prop_tx_id)['transactions'][0]['amount'])
+
+
+@skipIf(httpx is None, 'httpx is not installed')
+class TestAsyncCore(_AsyncDriver, _CoreBehaviour, TestCase):
+
+    def test_concurrent_webhooks(self):
+        self.fake.latency_ms = 50
+        self.core.concurrency.limit = self.core.concurrency.max_limit = 16
+        self.core.rate_limiter.rate = 0
+        events = [make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=100 + i) for i in range(16)]
+
+        async def _all():
+            return await asyncio.gather(*(self.core.process_event(data=x, is_new=True) for x in events))
+
+        start = time.perf_counter()
+        self.assertEqual([1] * 16, self.loop.run_until_complete(_all()))
+        self.assertEqual(16, len(self.prop_tx_ids()))
+        # All waiting on Firefly at once - well under 16 x 2 calls x 50ms
+        self.assertLess(time.perf_counter() - start, 0.8)
+
+
+class _RouteBehaviour(_FakeFireflyCase):
+    """The webhook routes. Subclasses say how to send a request"""
+
+    def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, str]:
+        raise NotImplementedError
+
+    def test_webhook_routes(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=60)
+        self.assertEqual((200, 'OK'), self.request('POST', '/transaction/add', json.dumps(tx_event).encode()))
+        self.assertEqual(2, self.fake.stats()['calls'])
+        # Firefly delivered it twice
+        self.assertEqual((200, 'OK'), self.request('POST', '/transaction/add/', json.dumps(tx_event).encode()))
+        self.assertEqual(2, self.fake.stats()['calls'])
+
+        status, body = self.request('POST', '/transaction/update', b'{"content": 1, "tags": ["a-p50"]}')
+        self.assertEqual(400, status)
+        self.assertIn('message', json.loads(body))
+        self.assertEqual(404, self.request('GET', '/transaction/delete')[0])
+
+    def test_untagged_prefiltered(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['groceries']}], tid=63)
+        self.assertEqual((200, 'OK'), self.request('POST', '/transaction/add', json.dumps(tx_event).encode()))
+        # Answered without parsing - so also without being marked seen
+        self.assertEqual(1, self.core.tag_rules.cache_info()['prefilter']['skipped'])
+        self.assertEqual(0, self.core.dedup_stats()['new']['size'])
+        self.assertEqual(0, self.fake.stats()['calls'])
+
+
+class TestFlaskRoutes(_SyncDriver, _RouteBehaviour, TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.app = Flask('ffrelay.app')
+        self.app.url_map.strict_slashes = False
+        self.app.extensions['logg'] = logger
+        self.app.extensions['ffr-core'] = self.core
+        self.app.register_blueprint(bp_main)
+        self.app.register_blueprint(bp_trans)
+        self.app.before_request(log_before)
+        self.app.after_request(log_after)
+        self.app.teardown_request(track_teardown)
+        self.client = self.app.test_client()
+
+    def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, str]:
+        resp = self.client.open(path.rstrip('/'), method=method, data=body)
+        return resp.status_code, resp.get_data(as_text=True)
+
+
+@skipIf(httpx is None, 'httpx is not installed')
+class TestASGIRoutes(_AsyncDriver, _RouteBehaviour, TestCase):
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.app = RelayASGIApp(self.core)
+
+    def request(self, method: str, path: str, body: bytes = b'') -> Tuple[int, str]:
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        sent = []
+
+        async def _receive():
+            return messages.pop(0)
+
+        async def _send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'headers': []}
+        self.loop.run_until_complete(self.app(scope, _receive, _send))
+        return sent[0]['status'], sent[1]['body'].decode()
+
+    def test_async_mode(self):
+        self.app.async_mode = True
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=61)
+        self.assertEqual((202, 'Accepted'), self.request('POST', '/transaction/add', json.dumps(tx_event).encode()))
+        self.app.max_pending = 0
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36']}], tid=62)
+        self.assertEqual((503, 'Busy'), self.request('POST', '/transaction/add', json.dumps(tx_event).encode()))
+        # Shutting down waits for the accepted one
+        self.loop.run_until_complete(self.app.shutdown())
+        self.assertEqual(1, self.app.task_stats()['processed'])
+        self.assertEqual(1, len(self.prop_tx_ids()))
+
+
+if __name__ == '__main__':
+    main()
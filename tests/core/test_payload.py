@@ -0,0 +1,58 @@
+import json
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.payload import (
+    PayloadError,
+    SplitRecord,
+    TransactionEvent,
+    as_event,
+    parse_webhook,
+)
+from tests.mocks.transaction import make_new_transaction_event
+
+
+class TestPayload(TestCase):
+
+    def test_parse_webhook(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['something-p36'], 'notes': 'hi'}, {}], tid=321)
+        event = parse_webhook(json.dumps(tx_event).encode())
+        self.assertIsInstance(event, TransactionEvent)
+        self.assertEqual(321, event.id)
+        self.assertEqual(2, len(event.transactions))
+        split = event.transactions[0]
+        self.assertIsInstance(split, SplitRecord)
+        org_split = tx_event['content']['transactions'][0]
+        self.assertEqual(str(org_split['transaction_journal_id']), split.transaction_journal_id)
+        self.assertEqual(org_split['amount'], split.amount)
+        self.assertTupleEqual(('something-p36', ), split.tags)
+        self.assertEqual('hi', split.notes)
+        self.assertTupleEqual((), event.transactions[1].tags)
+        # Slotted - no per-instance dict
+        self.assertFalse(hasattr(split, '__dict__'))
+
+    def test_malformed(self):
+        for raw in [b'{not json', b'[]', b'{"content": {"transactions": []}}',
+                    b'{"content": {"id": 4}}', b'{"content": {"id": 4, "transactions": [1]}}', b'\xff']:
+            with self.assertRaises(PayloadError, msg=raw):
+                parse_webhook(raw)
+
+    def test_round_trip(self):
+        tx_event = make_new_transaction_event(txs=[{'tags': ['a-p5']}])
+        event = as_event(tx_event)
+        self.assertEqual(event, as_event(event.to_webhook()))
+        # Webhook content alone works too
+        self.assertEqual(event, as_event(tx_event['content']))
+
+    def test_from_group(self):
+        content = make_new_transaction_event(tid=99)['content']
+        tx_group = {'type': 'transactions', 'id': '99', 'attributes': {k: v for k, v in content.items() if k != 'id'}}
+        event = TransactionEvent.from_group(tx_group)
+        self.assertEqual('99', event.id)
+        self.assertEqual(1, len(event.transactions))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.prop_cache import (
+    PropTxCache,
+    PropTxRecord,
+)
+
+
+def make_prop_group(prop_tx_id: int, orig_tx_id: int = None, amount: str = '10.00') -> dict:
+    notes = f'From tx: http://ff.local/transactions/show/{orig_tx_id}' if orig_tx_id is not None else None
+    return {'id': str(prop_tx_id), 'attributes': {'transactions': [
+        {'transaction_journal_id': prop_tx_id * 10, 'amount': amount, 'notes': notes},
+    ]}}
+
+
+class TestPropTxCache(TestCase):
+
+    def test_record(self):
+        record = PropTxRecord.from_api(make_prop_group(5, orig_tx_id=4))
+        self.assertEqual('5', record.prop_tx_id)
+        self.assertEqual('50', record.split_for(4).journal_id)
+        self.assertIsNone(record.split_for(3))
+
+    def test_match_splits(self):
+        group = make_prop_group(5, orig_tx_id=4)
+        # A grouped proportional transaction, listed out of order
+        group['attributes']['transactions'] = [{**group['attributes']['transactions'][0], 'transaction_journal_id': x,
+                                                'order': x - 50} for x in (52, 50, 51)]
+        record = PropTxRecord.from_api(group)
+        self.assertEqual(['50', '51', '52'], [x.journal_id for x in record.splits])
+        # Known journal ids first, the rest in order
+        self.assertEqual(['52', '50', '51'],
+                         [x.journal_id for x in record.match_splits(4, ['52', None, None])])
+        self.assertEqual(['50', '51', '52'], [x.journal_id for x in record.match_splits(4, [None] * 3)])
+        # Not enough to go on - nothing is guessed
+        self.assertEqual([None, None], record.match_splits(4, [None, None]))
+        self.assertEqual([None], record.match_splits(3, [None]))
+
+    def test_observe_only_prop_txs(self):
+        cache = PropTxCache()
+        self.assertIsNotNone(cache.observe(make_prop_group(5, orig_tx_id=4)))
+        self.assertIsNone(cache.observe(make_prop_group(6)))
+        self.assertIsNone(cache.observe({'id': '7'}))
+        # An original transaction links the other way - not cached
+        original = make_prop_group(8)
+        original['attributes']['transactions'][0]['notes'] = 'Proportion tx: http://ff.local/transactions/show/5'
+        self.assertIsNone(cache.observe(original))
+        self.assertIsNotNone(cache.get(5))
+        self.assertIsNone(cache.get(6))
+        self.assertDictEqual({'size': 1, 'max_size': 2000, 'sole_writer': False, 'hits': 1, 'misses': 1, 'evicted': 0},
+                             cache.stats())
+
+    def test_lru_and_ttl(self):
+        cache = PropTxCache(max_size=2, ttl_secs=0.05)
+        for i in range(3):
+            cache.observe(make_prop_group(i, orig_tx_id=100 + i))
+        self.assertIsNone(cache.get(0))
+        self.assertEqual(1, cache.stats()['evicted'])
+        time.sleep(0.06)
+        self.assertIsNone(cache.get(2))
+
+    def test_write_through(self):
+        cache = PropTxCache()
+        cache.observe(make_prop_group(5, orig_tx_id=4))
+        cache.set_amount(5, journal_id='50', amount='12.50')
+        self.assertEqual('12.50', cache.get(5).splits[0].amount)
+        cache.invalidate(5)
+        self.assertIsNone(cache.get(5))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import datetime
+import json
+import pathlib
+import tempfile
+from typing import (
+    Dict,
+    List,
+)
+from unittest import (
+    TestCase,
+    main,
+)
+
+from benchmarks.fake_firefly import FakeFirefly
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.reconcile import Reconciler
+from tests.mocks.transaction import (
+    DEFAULT_DEST_ID,
+    DEFAULT_SOURCE_ID,
+    make_new_transaction_event,
+)
+
+UPDATED_AT = '2024-06-24T12:00:00+00:00'
+
+
+class TestReconciler(TestCase):
+
+    def setUp(self) -> None:
+        self.fake = FakeFirefly()
+        self.base_url = self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.ffr = FireFlyRelayCore(props={
+            'ff-base-url': self.base_url,
+            'token': 'hello-token',
+            'owe-acct-id': DEFAULT_DEST_ID,
+            'inc-acct-id': DEFAULT_SOURCE_ID,
+        })
+        self.addCleanup(self.ffr.close)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = pathlib.Path(tmp_dir.name)
+
+        # In sync, drifted, never linked, linked to one that's gone, untagged
+        self.add_original(1, amount='100.00', tags=['shared-p50'], prop_tx_id=101)
+        self.add_prop(101, orig_tx_id=1, amount='50.000000000000')
+        self.add_original(2, amount='80.00', tags=['shared-p50'], prop_tx_id=102)
+        self.add_prop(102, orig_tx_id=2, amount='30.000000000000')
+        self.add_original(3, amount='10.00', tags=['shared-p50'])
+        self.add_original(4, amount='10.00', tags=['shared-p50'], prop_tx_id=104)
+        self.add_original(5, amount='10.00', tags=['groceries'])
+
+    def add_original(self, tid: int, amount: str, tags: List[str], prop_tx_id: int = None,
+                     updated_at: str = UPDATED_AT):
+        notes = f'Proportion tx: {self.base_url}/transactions/show/{prop_tx_id}' if prop_tx_id else None
+        content = make_new_transaction_event(txs=[{'tjid': tid * 10, 'amount': amount, 'tags': tags,
+                                                   'notes': notes}], tid=tid)['content']
+        self.fake.groups[str(tid)] = {**{k: v for k, v in content.items() if k != 'id'}, 'updated_at': updated_at}
+
+    def add_prop(self, prop_tx_id: int, orig_tx_id: int, amount: str):
+        split = {
+            'transaction_journal_id': prop_tx_id * 10,
+            'amount': amount,
+            'notes': f'From tx: {self.base_url}/transactions/show/{orig_tx_id}',
+        }
+        self.fake.groups[str(prop_tx_id)] = {'group_title': 'Prop - test', 'updated_at': UPDATED_AT,
+                                             'transactions': [split]}
+
+    def make_reconciler(self, **kwargs) -> Reconciler:
+        return Reconciler(self.ffr, state_path=self.dir.joinpath('state.json'),
+                          report_path=self.dir.joinpath('report.json'), rate=0, **kwargs)
+
+    def report(self) -> Dict:
+        return json.loads(self.dir.joinpath('report.json').read_text())
+
+    def test_reconcile(self):
+        stats = self.make_reconciler().run()
+        self.assertDictEqual({'pages': 1, 'transactions': 7, 'changed': 7, 'checked': 2, 'in_sync': 1, 'drifted': 1,
+                              'fixed': 1, 'unlinked': 1, 'dangling': 1, 'errors': 0}, stats)
+        self.assertEqual('40.00', self.fake.groups['102']['transactions'][0]['amount'])
+        self.assertEqual('50.000000000000', self.fake.groups['101']['transactions'][0]['amount'])
+        # One GET per linked proportional transaction, one PUT for the drifted one - after reading both sides again
+        self.assertDictEqual({'GET /transactions': 1, 'GET /transactions/{id}': 5, 'PUT /transactions/{id}': 1},
+                             self.fake.stats()['by_endpoint'])
+        findings = {x['orig_tx_id']: x for x in self.report()['findings']}
+        self.assertEqual(('drifted', '40.00', '30.000000000000'),
+                         (findings['2']['status'], findings['2']['expected'], findings['2']['actual']))
+        self.assertEqual('unlinked', findings['3']['status'])
+        self.assertEqual('dangling', findings['4']['status'])
+
+    def test_dry_run_and_incremental(self):
+        stats = self.make_reconciler(dry_run=True).run()
+        self.assertEqual((1, 0), (stats['drifted'], stats['fixed']))
+        self.assertEqual('30.000000000000', self.fake.groups['102']['transactions'][0]['amount'])
+        self.assertFalse(self.dir.joinpath('state.json').exists())
+
+        self.make_reconciler().run()
+        self.fake.calls.clear()
+        # Nothing changed since but the proportional transaction the last run fixed - nothing fetched
+        stats = self.make_reconciler().run()
+        self.assertEqual((7, 1, 0), (stats['transactions'], stats['changed'], stats['checked']))
+        self.assertDictEqual({'GET /transactions': 1}, self.fake.stats()['by_endpoint'])
+
+        # The original is edited, but the update webhook never comes
+        self.add_original(2, amount='90.00', tags=['shared-p50'], prop_tx_id=102,
+                          updated_at=datetime.datetime.now(tz=datetime.timezone.utc).isoformat())
+        stats = self.make_reconciler().run()
+        self.assertEqual((1, 1, 1), (stats['changed'], stats['checked'], stats['fixed']))
+        self.assertEqual('45.00', self.fake.groups['102']['transactions'][0]['amount'])
+        # Unless it's a full run
+        self.assertEqual(7, self.make_reconciler(full=True).run()['changed'])
+
+    def test_watermark_per_run(self):
+        start = datetime.date(2024, 6, 1)
+        self.make_reconciler().run(start=start)
+        # What a run over a date range (or a tag) has seen says nothing about the rest
+        self.assertEqual(7, self.make_reconciler().run()['changed'])
+        # Each picks up from its own last run
+        self.assertEqual(1, self.make_reconciler().run(start=start)['changed'])
+        self.assertEqual(0, self.make_reconciler().run()['changed'])
+
+    def test_batched_group(self):
+        # One original with three tagged splits, and the grouped proportional transaction made for them
+        self.fake.groups.clear()
+        notes = f'Proportion tx: {self.base_url}/transactions/show/106'
+        content = make_new_transaction_event(txs=[{'tjid': 60 + i, 'amount': '100.00', 'tags': [f'shared-p{p}'],
+                                                   'notes': notes} for i, p in enumerate([50, 25, 10])],
+                                             tid=6)['content']
+        self.fake.groups['6'] = {**{k: v for k, v in content.items() if k != 'id'}, 'updated_at': UPDATED_AT}
+        self.fake.groups['106'] = {'group_title': 'Prop - test', 'updated_at': UPDATED_AT, 'transactions': [{
+            'transaction_journal_id': 900 + i,
+            'order': i,
+            'amount': amount,
+            'notes': f'From tx: {self.base_url}/transactions/show/6',
+        } for i, amount in enumerate(['50.00', '25.00', '10.00'])]}
+
+        # In sync - the index doesn't know the journal ids, so each split is told apart by its order
+        stats = self.make_reconciler(full=True).run()
+        self.assertEqual((3, 3, 0, 0), (stats['checked'], stats['in_sync'], stats['drifted'], stats['fixed']))
+        self.assertNotIn('PUT /transactions/{id}', self.fake.stats()['by_endpoint'])
+
+        # Only the drifted split is fixed
+        self.fake.groups['106']['transactions'][1]['amount'] = '30.00'
+        stats = self.make_reconciler(full=True).run()
+        self.assertEqual((1, 1), (stats['drifted'], stats['fixed']))
+        self.assertEqual(['50.00', '25.00', '10.00'], [x['amount'] for x in self.fake.groups['106']['transactions']])
+
+    def test_rereads_under_lock(self):
+        reconciler = self.make_reconciler()
+        _replan = reconciler._replan
+
+        def _fixed_meanwhile(orig_tx_ids: List[str], prop_tx_id: str) -> List[Dict]:
+            # The update webhook got there first, while we were waiting on the lock
+            self.assertIsNone(self.ffr.tx_locks.acquire(orig_tx_ids[0], blocking=False))
+            self.fake.groups['102']['transactions'][0]['amount'] = '40.00'
+            return _replan(orig_tx_ids, prop_tx_id)
+
+        reconciler._replan = _fixed_meanwhile
+        stats = reconciler.run()
+        self.assertEqual((1, 0), (stats['drifted'], stats['fixed']))
+        self.assertNotIn('PUT /transactions/{id}', self.fake.stats()['by_endpoint'])
+
+
+if __name__ == '__main__':
+    main()
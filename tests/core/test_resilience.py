@@ -0,0 +1,60 @@
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_secs=0.05)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        time.sleep(0.06)
+        # One probe goes through, others keep failing fast until it reports back
+        breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual('open', breaker.state)
+        time.sleep(0.06)
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual('closed', breaker.state)
+        breaker.before_call()
+        self.assertEqual(2, breaker.stats()['short_circuited'])
+
+
+class TestRetryPolicy(TestCase):
+
+    def test_backoff_bounds(self):
+        policy = RetryPolicy(base_delay=0.5, max_delay=2.0)
+        for attempt in range(1, 8):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0.0)
+            self.assertLessEqual(delay, min(2.0, 0.5 * 2 ** (attempt - 1)))
+
+    def test_budget(self):
+        policy = RetryPolicy(budget_ratio=0.5, budget_max=2)
+        self.assertTrue(policy.try_spend())
+        self.assertTrue(policy.try_spend())
+        self.assertFalse(policy.try_spend())
+        # Two more calls earn another retry
+        policy.record_call()
+        policy.record_call()
+        self.assertTrue(policy.try_spend())
+        self.assertEqual(1, policy.stats()['budget_exhausted'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import tempfile
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.config import (
+    BaseConfig,
+    DevelopmentConfig,
+    load_secret_key,
+)
+from tests.common import make_patcher
+
+ROOT = pathlib.Path(__file__).parent.parent.parent
+# Import + create_app in a fresh interpreter - takes ~0.25s on a laptop, almost all of it Flask, requests & loguru
+STARTUP_BUDGET_SECS = 1.5
+
+STARTUP_SCRIPT = '''
+import json, pathlib, sys, time
+
+start = time.perf_counter()
+import ffrelay.config
+config_imported = time.perf_counter()
+from ffrelay.app import create_app
+imported = time.perf_counter()
+
+
+class StartupConfig(ffrelay.config.DevelopmentConfig):
+    DEBUG = False
+    LOG_LEVEL = 'WARNING'
+    SECRET_KEY_PATH = pathlib.Path(sys.argv[1]).joinpath('secret-key')
+
+    @classmethod
+    def load_secrets(cls):
+        cls.SECRETS = {'ff-base-url': 'http://localhost:1', 'token': 'hello-token', 'inc-acct-id': '1',
+                       'owe-acct-id': '2'}
+
+
+version_lookups = ffrelay.config.get_version.cache_info().misses
+create_app(config_class=StartupConfig)
+done = time.perf_counter()
+print(json.dumps({
+    'config_import': config_imported - start,
+    'import': imported - start,
+    'create_app': done - imported,
+    'version_lookups': version_lookups,
+    'modules': [x for x in ('pandas', 'cProfile', 'httpx', 'uvicorn') if x in sys.modules],
+}))
+'''
+
+
+class TestStartup(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = pathlib.Path(tmp_dir.name)
+
+    def test_budget(self):
+        # A home of its own, to check nothing's written there when the config is imported
+        env = dict(os.environ, HOME=str(self.dir))
+        env['PYTHONPATH'] = os.pathsep.join(x for x in (str(ROOT), env.get('PYTHONPATH')) if x)
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, str(self.dir)], env=env, cwd=ROOT,
+                                capture_output=True, text=True, timeout=30)
+        self.assertEqual(0, result.returncode, result.stderr)
+        timings = json.loads(result.stdout.splitlines()[-1])
+        self.assertLess(timings['import'] + timings['create_app'], STARTUP_BUDGET_SECS, timings)
+        self.assertLess(timings['config_import'], 0.5, timings)
+        # Nothing looked up or written before it's needed, and nothing imported that isn't used
+        self.assertEqual(0, timings['version_lookups'])
+        self.assertEqual([], [x.name for x in self.dir.iterdir()])
+        self.assertEqual([], timings['modules'])
+
+    def test_secrets_loaded_once(self):
+        read_secrets = make_patcher(self, 'ffrelay.config.read_secrets')
+        read_secrets.return_value = {'token': 'hello-token'}
+
+        class OnceConfig(DevelopmentConfig):
+            SECRET_KEY_PATH = self.dir.joinpath('secret-key')
+
+        OnceConfig.load_secrets()
+        OnceConfig.load_secrets()
+        read_secrets.assert_called_once()
+        self.assertEqual({'token': 'hello-token'}, OnceConfig.SECRETS)
+        self.assertIsNone(BaseConfig.SECRETS)
+        # A new secret key is written the first time, then read back
+        self.assertEqual(32, len(OnceConfig.SECRET_KEY))
+        self.assertEqual(OnceConfig.SECRET_KEY, load_secret_key(OnceConfig.SECRET_KEY_PATH))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import datetime
+import pathlib
+import tempfile
+import time
+from typing import (
+    List,
+    Tuple,
+)
+from unittest import (
+    TestCase,
+    main,
+)
+from unittest.mock import patch
+
+from benchmarks.fake_firefly import FakeFirefly
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.sync import SyncPoller
+from tests.mocks.transaction import (
+    DEFAULT_DEST_ID,
+    DEFAULT_SOURCE_ID,
+    make_new_transaction_event,
+)
+
+
+def minutes_ago(minutes: float) -> str:
+    return (datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(minutes=minutes)).isoformat()
+
+
+class TestSyncPoller(TestCase):
+
+    def setUp(self) -> None:
+        self.fake = FakeFirefly()
+        self.base_url = self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.ffr = FireFlyRelayCore(props={
+            'ff-base-url': self.base_url,
+            'token': 'hello-token',
+            'owe-acct-id': DEFAULT_DEST_ID,
+            'inc-acct-id': DEFAULT_SOURCE_ID,
+        })
+        self.addCleanup(self.ffr.close)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.state_path = pathlib.Path(tmp_dir.name).joinpath('sync.json')
+        self.handled: List[Tuple[str, bool]] = []
+
+        self.add_group(1, tags=['shared-p50'], created_at=minutes_ago(60))
+        self.add_group(2, tags=['groceries'], created_at=minutes_ago(50))
+
+    def add_group(self, tid: int, tags: List[str], created_at: str, updated_at: str = None):
+        content = make_new_transaction_event(txs=[{'tjid': tid * 10, 'amount': '10.00', 'tags': tags}],
+                                             tid=tid)['content']
+        self.fake.groups[str(tid)] = {**{k: v for k, v in content.items() if k != 'id'},
+                                      'created_at': created_at, 'updated_at': updated_at or created_at}
+
+    def handler(self, event: TransactionEvent, is_new: bool):
+        self.handled.append((str(event.id), is_new))
+
+    def make_poller(self, **kwargs) -> SyncPoller:
+        return SyncPoller(self.ffr, handler=kwargs.pop('handler', self.handler), state_path=self.state_path,
+                          **kwargs)
+
+    def test_poll(self):
+        poller = self.make_poller()
+        # The first poll only sets the mark
+        self.assertEqual(0, poller.poll_once())
+        self.assertEqual([], self.handled)
+        self.assertTrue(self.state_path.exists())
+
+        # Missed webhooks: a new transaction, an edit, an untagged one - and one too recent to touch yet
+        self.add_group(3, tags=['shared-p50'], created_at=minutes_ago(10))
+        self.add_group(1, tags=['shared-p50'], created_at=minutes_ago(60), updated_at=minutes_ago(5))
+        self.add_group(4, tags=['groceries'], created_at=minutes_ago(4))
+        self.add_group(5, tags=['shared-p50'], created_at=minutes_ago(0))
+        # One that did get its webhook
+        self.add_group(6, tags=['shared-p50'], created_at=minutes_ago(70), updated_at=minutes_ago(3))
+        self.ffr.mark_seen(6, is_new=False, updated_at=self.fake.groups['6']['updated_at'])
+
+        self.assertEqual(2, poller.poll_once())
+        self.assertEqual([('3', True), ('1', False)], self.handled)
+        self.assertEqual((1, 1), (poller.untagged, poller.deduped))
+        # Each change is handled once - even by another process picking up the state
+        self.assertEqual(0, self.make_poller().poll_once())
+        self.assertEqual(2, len(self.handled))
+
+        # Once settled, the recent one goes through
+        self.assertEqual(1, self.make_poller(settle_secs=0).poll_once())
+        self.assertEqual(('5', True), self.handled[-1])
+
+    def test_retry(self):
+        self.make_poller().poll_once()
+        self.add_group(3, tags=['shared-p50'], created_at=minutes_ago(10))
+        self.add_group(4, tags=['shared-p50'], created_at=minutes_ago(5))
+        failures = []
+
+        def _failing(event: TransactionEvent, is_new: bool):
+            if str(event.id) == '3' and len(failures) < 2:
+                failures.append(event.id)
+                raise ConnectionError('Firefly is down')
+            self.handler(event, is_new)
+
+        poller = self.make_poller(handler=_failing, max_attempts=3)
+        # Nothing past a failed change is handled, and its dedup mark is released for the retry
+        self.assertEqual(0, poller.poll_once())
+        self.assertEqual([], self.handled)
+        self.assertFalse(self.ffr.is_seen(3, is_new=True))
+        self.assertEqual(0, poller.poll_once())
+        self.assertEqual(2, poller.poll_once())
+        self.assertEqual([('3', True), ('4', True)], self.handled)
+
+        # A change that keeps failing is given up on after max_attempts
+        self.add_group(5, tags=['shared-p50'], created_at=minutes_ago(2))
+
+        def _broken(event: TransactionEvent, is_new: bool):
+            raise ValueError('Bad transaction')
+
+        poller.handler = _broken
+        self.assertEqual([0, 0, 0], [poller.poll_once() for _ in range(3)])
+        self.assertEqual((1, 5), (poller.gave_up, poller.failed))
+        self.assertFalse(poller._is_past_mark((poller.mark, '5')))
+
+    def test_webhooks_not_repeated(self):
+        poller = self.make_poller(handler=self.ffr.process_event, settle_secs=0)
+        poller.poll_once()
+        # Handled by their webhooks: a new transaction, then an edit of it
+        self.add_group(3, tags=['shared-p50'], created_at=minutes_ago(2))
+        for is_new in (True, False):
+            if not is_new:
+                self.fake.groups['3']['transactions'][0]['amount'] = '30.00'
+                self.fake.groups['3']['updated_at'] = minutes_ago(1)
+            event = TransactionEvent.from_group({'id': '3', 'attributes': self.fake.groups['3']})
+            self.assertTrue(self.ffr.mark_seen(3, is_new=is_new, updated_at=event.updated_at))
+            self.ffr.process_event(event, is_new=is_new)
+        prop_tx_id = next(x for x in self.fake.groups if x not in ('1', '2', '3'))
+        self.assertEqual('15.00', self.fake.groups[prop_tx_id]['transactions'][0]['amount'])
+
+        # Long after the plain update-dedup window - neither they nor our own writes are handled again
+        self.fake.calls.clear()
+        real_monotonic = time.monotonic
+        with patch('ffrelay.core.dedup.time.monotonic', side_effect=lambda: real_monotonic() + 120):
+            self.assertEqual(0, poller.poll_once())
+        self.assertDictEqual({'GET /transactions': 1}, self.fake.stats()['by_endpoint'])
+        self.assertEqual(1, poller.deduped)
+
+    def test_interval(self):
+        poller = self.make_poller(min_interval_secs=10, max_interval_secs=80)
+        self.assertEqual(10, poller.interval_secs)
+        # Backs off while idle...
+        for expected in [20, 40, 80, 80]:
+            poller.interval_secs = poller._next_interval(0)
+            self.assertEqual(expected, poller.interval_secs)
+        # ...and speeds up while changes turn up
+        for expected in [40, 20, 10, 10]:
+            poller.interval_secs = poller._next_interval(3)
+            self.assertEqual(expected, poller.interval_secs)
+
+    def test_one_leader(self):
+        first, second = self.make_poller(), self.make_poller()
+        self.assertTrue(first._try_lead())
+        self.assertFalse(second._try_lead())
+        first.shutdown()
+        self.assertTrue(second._try_lead())
+        second.shutdown()
+
+    def test_state_path_required(self):
+        self.assertRaises(ValueError, SyncPoller, self.ffr, handler=self.handler, state_path=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import json
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.tag_rules import (
+    TagMatch,
+    TagRule,
+    TagRuleEngine,
+    parse_tag_rules,
+)
+from tests.mocks.transaction import make_new_transaction_event
+
+
+class TestTagRules(TestCase):
+
+    def test_parse(self):
+        rules = parse_tag_rules('rent:p=50:dest=12, groceries:dest=15:src=3,,')
+        self.assertListEqual([
+            TagRule(name='rent', proportion=50, dest_acct_id='12'),
+            TagRule(name='groceries', dest_acct_id='15', source_acct_id='3'),
+        ], rules)
+        with self.assertRaises(ValueError):
+            parse_tag_rules('rent:pct=50')
+
+    def test_generic_prefix(self):
+        engine = TagRuleEngine()
+        self.assertTupleEqual((TagMatch(tag='something-p36', proportion=36), ),
+                              engine.match_tags(('other', 'something-p36')))
+        self.assertTupleEqual((), engine.match_tags(('plain', 'no-pe', 'a-b-p3')))
+
+    def test_configured_rules(self):
+        engine = TagRuleEngine.from_props({
+            'tag-rules': 'rent:p=50:dest=12,groceries:dest=15',
+            'tag-rules-match-any': 'false',
+        })
+        matches = engine.match_tags(('rent', 'groceries-p20', 'something-p36'))
+        self.assertTupleEqual((
+            TagMatch(tag='rent', proportion=50, dest_acct_id='12'),
+            TagMatch(tag='groceries-p20', proportion=20, dest_acct_id='15'),
+        ), matches)
+
+    def test_memoized(self):
+        engine = TagRuleEngine()
+        tags = ('a-p10', 'b', 'c')
+        engine.match_tags(tags)
+        engine.match_tags(tags)
+        engine.match_tags(('b', 'a-p10'))
+        info = engine.cache_info()
+        self.assertEqual(1, info['tag_set_cache']['hits'])
+        # Each distinct tag is only worked out once
+        self.assertEqual(3, info['tag_cache']['misses'])
+
+    def test_prefilter(self):
+        def body(*tags):
+            return json.dumps(make_new_transaction_event(txs=[{'tags': list(tags)}])).encode()
+
+        engine = TagRuleEngine()
+        self.assertTrue(engine.may_match(body('other', 'something-p36')))
+        self.assertFalse(engine.may_match(body('groceries')))
+        self.assertEqual({'enabled': True, 'checked': 2, 'skipped': 1}, engine.cache_info()['prefilter'])
+
+        engine = TagRuleEngine.from_props({
+            'tag-rules': 'rent:p=50:dest=12,groceries:dest=15',
+            'tag-rules-match-any': 'false',
+        })
+        self.assertTrue(engine.may_match(body('rent')))
+        self.assertTrue(engine.may_match(body('groceries-p20')))
+        self.assertFalse(engine.may_match(body('something-p36', 'rental')))
+        # A body may get through without a matching tag, but never the other way round
+        for tags in [('rent', 'x'), ('groceries-p20', ), ('rent-p5', ), ('something-p36', ), ('plain', )]:
+            if engine.match_tags(tags):
+                self.assertTrue(engine.may_match(body(*tags)), tags)
+
+        # A tag the JSON might escape can't be looked for
+        engine = TagRuleEngine(rules=[TagRule(name='café', proportion=50)], match_any_prefix=False)
+        self.assertTrue(engine.may_match(body('groceries')))
+        self.assertFalse(engine.cache_info()['prefilter']['enabled'])
+        engine = TagRuleEngine.from_props({'tag-prefilter': 'false'})
+        self.assertTrue(engine.may_match(body('groceries')))
+
+
+if __name__ == '__main__':
+    main()
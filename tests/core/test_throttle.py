@@ -0,0 +1,90 @@
+import threading
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.throttle import (
+    AdaptiveConcurrencyLimiter,
+    TokenBucket,
+)
+
+
+class TestTokenBucket(TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=50, burst=3)
+        start = time.perf_counter()
+        for _ in range(3):
+            self.assertEqual(0.0, bucket.acquire())
+        # Burst spent - the next token is ~1/50th of a second away
+        self.assertGreater(bucket.acquire(), 0.0)
+        self.assertGreaterEqual(time.perf_counter() - start, 0.015)
+        self.assertEqual(1, bucket.stats()['throttled'])
+        self.assertEqual(4, bucket.stats()['acquired'])
+
+    def test_unlimited(self):
+        bucket = TokenBucket(rate=0)
+        for _ in range(100):
+            self.assertEqual(0.0, bucket.acquire())
+        self.assertEqual(0, bucket.stats()['throttled'])
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=0)
+        bucket.pause(0.05)
+        self.assertGreaterEqual(bucket.acquire(), 0.04)
+
+
+class TestAdaptiveConcurrencyLimiter(TestCase):
+
+    def test_additive_increase(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, max_limit=3, window=5)
+        for _ in range(10):
+            with limiter.slot():
+                pass
+        # Capped at the max
+        self.assertEqual(3, limiter.limit)
+        self.assertEqual(1, limiter.stats()['increases'])
+
+    def test_multiplicative_decrease(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=8, window=3)
+        with limiter.slot() as outcome:
+            outcome.overloaded = True
+        self.assertEqual(4, limiter.limit)
+        # Further errors within the same window don't pile on
+        with self.assertRaises(ConnectionError):
+            with limiter.slot():
+                raise ConnectionError()
+        self.assertEqual(4, limiter.limit)
+        self.assertEqual(1, limiter.stats()['decreases'])
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_slow_calls_back_off(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4, latency_target=0.0, window=1)
+        with limiter.slot():
+            time.sleep(0.001)
+        self.assertEqual(2, limiter.limit)
+
+    def test_caps_in_flight(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=2, max_limit=2)
+        peak = []
+        lock = threading.Lock()
+
+        def _call():
+            with limiter.slot():
+                with lock:
+                    peak.append(limiter.in_flight)
+                time.sleep(0.02)
+
+        threads = [threading.Thread(target=_call) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(max(peak), 2)
+        self.assertGreater(limiter.stats()['throttled'], 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import json
+import pathlib
+import tempfile
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.profiling import SlowRequestProfiler
+from ffrelay.core.tracing import (
+    Tracer,
+    current_request_id,
+)
+
+
+def read_trace(path: pathlib.Path) -> list:
+    # Close off the array the way the trace viewers do
+    return json.loads(path.read_text().rstrip().rstrip(',') + ']')
+
+
+class TestTracer(TestCase):
+
+    def setUp(self) -> None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = pathlib.Path(tmp_dir.name)
+        self.tracer = Tracer()
+
+    def test_disabled(self):
+        with self.tracer.span('root') as span:
+            self.assertIsNone(span)
+            self.assertIsNone(current_request_id())
+
+    def test_spans_written(self):
+        path = self.dir.joinpath('trace.json')
+        self.tracer.configure(path=path)
+
+        @self.tracer.wrap('inner')
+        def _inner():
+            return current_request_id()
+
+        with self.tracer.span('root', request_id='req-1', route='/transaction/add'):
+            self.assertEqual('req-1', _inner())
+        self.assertIsNone(current_request_id())
+        with self.tracer.span('other'):
+            pass
+
+        events = read_trace(path)
+        self.assertEqual(['inner', 'root', 'other'], [x['name'] for x in events])
+        self.assertEqual('req-1', events[0]['args']['request_id'])
+        self.assertEqual('/transaction/add', events[1]['args']['route'])
+        self.assertNotEqual('req-1', events[2]['args']['request_id'])
+        self.assertTrue(all(x['ph'] == 'X' for x in events))
+        # The child sits within its root
+        self.assertGreaterEqual(events[0]['ts'], events[1]['ts'])
+        self.assertLessEqual(events[0]['dur'], events[1]['dur'])
+
+    def test_request_id_cleaned(self):
+        self.tracer.configure(path=self.dir.joinpath('trace.json'))
+        with self.tracer.span('root', request_id='../../etc/cron.d/x\r\nSet-Cookie: a=b' + 'z' * 100):
+            request_id = current_request_id()
+        self.assertEqual('.._.._etc_cron.d_x__Set-Cookie__a_b', request_id[:35])
+        self.assertEqual(64, len(request_id))
+
+    def test_sampling(self):
+        path = self.dir.joinpath('trace.json')
+        self.tracer.configure(path=path, sample_rate=0.0)
+        with self.tracer.span('root'):
+            self.assertIsNotNone(current_request_id())
+        self.assertFalse(path.exists())
+
+    def test_slow_request_profiled(self):
+        profiler = SlowRequestProfiler(out_dir=self.dir, threshold_ms=50, interval_ms=1)
+        self.tracer.configure(profiler=profiler)
+        with self.tracer.span('fast', request_id='fast-1'):
+            pass
+        with self.tracer.span('slow', request_id='slow-1'):
+            time.sleep(0.1)
+        dumped = list(self.dir.glob('*.folded'))
+        self.assertEqual(1, len(dumped))
+        self.assertIn('slow-1', dumped[0].name)
+        self.assertIn('test_slow_request_profiled', dumped[0].read_text())
+        self.assertEqual(2, profiler.stats()['profiled'])
+
+    def test_profile_name_cleaned(self):
+        profiler = SlowRequestProfiler(out_dir=self.dir.joinpath('profiles'), threshold_ms=0, interval_ms=1)
+        profiler.start()
+        path = profiler.finish(request_id='../escaped', duration_ms=10)
+        self.assertEqual(self.dir.joinpath('profiles'), path.parent)
+        self.assertTrue(path.name.endswith('-.._escaped.folded'))
+
+    def test_cprofile_mode(self):
+        profiler = SlowRequestProfiler(out_dir=self.dir, threshold_ms=0, mode='cprofile', sample_rate=1.0)
+        self.tracer.configure(profiler=profiler)
+        with self.tracer.span('slow', request_id='slow-2'):
+            sum(range(1000))
+        self.assertEqual(1, len(list(self.dir.glob('*-slow-2.prof'))))
+
+
+if __name__ == '__main__':
+    main()
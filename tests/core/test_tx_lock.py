@@ -0,0 +1,146 @@
+import asyncio
+import pathlib
+import tempfile
+import threading
+import time
+from unittest import (
+    TestCase,
+    main,
+)
+
+from benchmarks.fake_firefly import FakeFirefly
+from ffrelay.core.ff_core import FireFlyRelayCore
+from ffrelay.core.payload import TransactionEvent
+from ffrelay.core.tx_lock import (
+    KeyedLock,
+    TxLockTimeout,
+)
+from tests.mocks.transaction import (
+    DEFAULT_DEST_ID,
+    DEFAULT_SOURCE_ID,
+    make_new_transaction_event,
+)
+
+
+class TestKeyedLock(TestCase):
+
+    def test_per_key(self):
+        locks = KeyedLock()
+        order = []
+        holding = threading.Event()
+
+        def _worker(key: int, name: str):
+            with locks.hold(key) as waited:
+                order.append((name, waited))
+                holding.set()
+                time.sleep(0.1)
+
+        first = threading.Thread(target=_worker, args=(1, 'first'))
+        first.start()
+        holding.wait(5)
+        # Another transaction goes right ahead, the same one waits its turn
+        start = time.monotonic()
+        with locks.hold(2) as waited:
+            self.assertFalse(waited)
+        self.assertLess(time.monotonic() - start, 0.05)
+        self.assertIsNone(locks.acquire(1, blocking=False))
+        _worker(1, 'second')
+        first.join()
+        self.assertEqual([('first', False), ('second', True)], order)
+
+        stats = locks.stats()
+        self.assertEqual((3, 1, 0), (stats['acquired'], stats['contended'], stats['active_keys']))
+        self.assertGreater(stats['wait_secs_max'], 0.02)
+
+    def test_timeout(self):
+        locks = KeyedLock(timeout_secs=0.05)
+        locks.acquire(1)
+        thread = threading.Thread(target=lambda: self.assertRaises(TxLockTimeout, locks.acquire, 1))
+        thread.start()
+        thread.join()
+        locks.release(1)
+        self.assertEqual(1, locks.stats()['timeouts'])
+        self.assertFalse(locks.acquire(1))
+
+    def test_cancelled_while_waiting(self):
+        locks = KeyedLock()
+        locks.acquire(1)
+
+        async def _cancel_waiter():
+            async def _waiter():
+                async with locks.hold_async(1):
+                    self.fail('Cancelled before the lock was free')
+
+            task = asyncio.create_task(_waiter())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The waiting thread takes the lock once it's free, and hands it straight back
+            locks.release(1)
+            for _ in range(100):
+                if locks.stats()['active_keys'] == 0:
+                    break
+                await asyncio.sleep(0.01)
+
+        asyncio.run(_cancel_waiter())
+        self.assertEqual(0, locks.stats()['active_keys'])
+        self.assertFalse(locks.acquire(1, blocking=False))
+
+    def test_file_locks(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        lock_dir = pathlib.Path(tmp_dir.name).joinpath('locks')
+        # Each stands in for a gunicorn worker
+        worker_a = KeyedLock(lock_dir=lock_dir, timeout_secs=0.05)
+        worker_b = KeyedLock(lock_dir=lock_dir, timeout_secs=0.05)
+        # Nothing's made until a lock is taken
+        self.assertFalse(lock_dir.exists())
+
+        self.assertFalse(worker_a.acquire(1))
+        self.assertIsNone(worker_b.acquire(1, blocking=False))
+        self.assertRaises(TxLockTimeout, worker_b.acquire, 1)
+        self.assertFalse(worker_b.acquire(2))
+        worker_a.release(1)
+        self.assertFalse(worker_b.acquire(1))
+        worker_b.release(1)
+        worker_b.release(2)
+        self.assertEqual([], list(lock_dir.iterdir()))
+
+
+class TestConcurrentWebhooks(TestCase):
+
+    def setUp(self) -> None:
+        self.fake = FakeFirefly(latency_ms=30)
+        base_url = self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.ffr = FireFlyRelayCore(props={
+            'ff-base-url': base_url,
+            'token': 'hello-token',
+            'owe-acct-id': DEFAULT_DEST_ID,
+            'inc-acct-id': DEFAULT_SOURCE_ID,
+        })
+        self.addCleanup(self.ffr.close)
+
+    def test_new_and_update_at_once(self):
+        content = make_new_transaction_event(txs=[{'tjid': 10, 'amount': '100.00', 'tags': ['shared-p50']}],
+                                             tid=1)['content']
+        self.fake.groups['1'] = {k: v for k, v in content.items() if k != 'id'}
+        event = TransactionEvent.from_content(content)
+
+        # The add & update webhooks for the same transaction land at the same moment
+        threads = [threading.Thread(target=self.ffr.process_event, args=(event, is_new)) for is_new in (True, False)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        prop_txs = [x for x in self.fake.groups if x != '1']
+        self.assertEqual(1, len(prop_txs))
+        self.assertEqual(1, self.fake.groups['1']['transactions'][0]['notes'].count('Proportion tx'))
+        stats = self.ffr.tx_lock_stats()
+        self.assertEqual((2, 1), (stats['acquired'], stats['contended']))
+
+
+if __name__ == '__main__':
+    main()
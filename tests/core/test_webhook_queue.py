@@ -0,0 +1,61 @@
+import threading
+from unittest import (
+    TestCase,
+    main,
+)
+
+from ffrelay.core.webhook_queue import WebhookQueue
+from tests.mocks.transaction import make_new_transaction_event
+
+
+class TestWebhookQueue(TestCase):
+
+    def setUp(self) -> None:
+        self.handled = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def _handler(self, data, is_new) -> int:
+        self.release.wait(timeout=5)
+        self.handled.append((data['content']['id'], is_new))
+        return 1
+
+    def test_submit_and_drain(self):
+        wqueue = WebhookQueue(handler=self._handler, max_size=10, workers=3)
+        wqueue.start()
+        events = [make_new_transaction_event(tid=i) for i in range(8)]
+        for event in events:
+            self.assertTrue(wqueue.submit(data=event, is_new=True))
+        self.assertTrue(wqueue.shutdown(timeout=5))
+        self.assertCountEqual([(i, True) for i in range(8)], self.handled)
+        stats = wqueue.stats()
+        self.assertEqual(8, stats['accepted'])
+        self.assertEqual(8, stats['processed'])
+        self.assertEqual(0, stats['depth'])
+        # No longer accepting after shutdown
+        self.assertFalse(wqueue.submit(data=events[0], is_new=True))
+
+    def test_backpressure(self):
+        self.release.clear()
+        wqueue = WebhookQueue(handler=self._handler, max_size=2, workers=1)
+        wqueue.start()
+        results = [wqueue.submit(data=make_new_transaction_event(tid=i), is_new=False) for i in range(6)]
+        # One may be picked up by the worker, the queue holds two more; the rest are refused
+        self.assertIn(results.count(True), (2, 3))
+        self.assertGreaterEqual(wqueue.stats()['rejected'], 3)
+        self.release.set()
+        self.assertTrue(wqueue.shutdown(timeout=5))
+
+    def test_handler_error_counted(self):
+        def _boom(data, is_new):
+            raise ValueError('nope')
+
+        wqueue = WebhookQueue(handler=_boom, max_size=5, workers=1)
+        wqueue.start()
+        wqueue.submit(data=make_new_transaction_event(), is_new=True)
+        self.assertTrue(wqueue.shutdown(timeout=5))
+        self.assertEqual(1, wqueue.stats()['failed'])
+
+
+if __name__ == '__main__':
+    main()